@@ -1,26 +1,45 @@
+import contextvars
+import csv
+import gzip
+import hmac
+import io
 import json
 import os
 import secrets
+import tempfile
+import threading
 import time
-import uuid as uuid_mod
+import zlib
 
 import stripe
 
 from dotenv import load_dotenv
 load_dotenv()
-from datetime import datetime, timedelta, timezone
-from typing import Annotated
+from contextlib import asynccontextmanager, contextmanager
+from datetime import date, datetime, timedelta, timezone
+from typing import Annotated, NamedTuple
 
+import anyio
+import anyio.to_thread
 import bcrypt
 import httpx
 import psycopg2
 import psycopg2.extras
-from fastapi import Depends, FastAPI, HTTPException, Request, status
-from fastapi.responses import FileResponse, JSONResponse, Response
+import psycopg2.pool
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, Request, status
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from jose import JWTError, jwt
 from pydantic import BaseModel
+from starlette.datastructures import MutableHeaders
+
+from billing import BillingClient, BillingUnavailable, CircuitBreaker
+from cards import TOP_TASKS, CardCache, CardRenderer, card_key
+from degraded import DatabaseUnavailable, Document, JournalFull, SnapshotCache, WriteJournal
+from digest import unsubscribe_sig
+from profiling import AllocationLogMiddleware, MemoryProfiler, folded, sample
+from shards import ShardMap, fence
 
 SECRET_KEY = os.getenv("SECRET_KEY", "dev-secret-change-in-production")
 DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://localhost/tt")
@@ -30,13 +49,56 @@ RESEND_API_KEY       = os.getenv("RESEND_API_KEY", "")
 RESEND_FROM          = os.getenv("RESEND_FROM", "noreply@doingit.online")
 APP_URL              = os.getenv("APP_URL", "https://doingit.online")
 RESET_EXPIRE_MINUTES = 60
+# Optional read replicas (comma-separated); read-only endpoints are routed to them.
+DATABASE_REPLICA_URLS  = [u.strip() for u in os.getenv(
+    "DATABASE_REPLICA_URLS", os.getenv("DATABASE_REPLICA_URL", "")
+).split(",") if u.strip()]
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "5"))
+REPLICA_PIN_SECONDS     = float(os.getenv("REPLICA_PIN_SECONDS", "10"))
+# Optional user-data shards 1.. (comma-separated); shard 0 is DATABASE_URL. See shards.py.
+DATABASE_SHARD_URLS    = [u.strip() for u in os.getenv("DATABASE_SHARD_URLS", "").split(",") if u.strip()]
 GOOGLE_CLIENT_ID       = os.getenv("GOOGLE_CLIENT_ID", "")
 STRIPE_SECRET_KEY      = os.getenv("STRIPE_SECRET_KEY", "")
 STRIPE_WEBHOOK_SECRET  = os.getenv("STRIPE_WEBHOOK_SECRET", "")
 STRIPE_PRICE_ID        = os.getenv("STRIPE_PRICE_ID", "")
-
-if STRIPE_SECRET_KEY:
-    stripe.api_key = STRIPE_SECRET_KEY
+# Outgoing Stripe calls (billing.py): per-attempt timeout, extra attempts after
+# a transient failure, and an alternative API host (e.g. stripe-mock).
+STRIPE_TIMEOUT_SECONDS = float(os.getenv("STRIPE_TIMEOUT_SECONDS", "5"))
+STRIPE_RETRIES         = int(os.getenv("STRIPE_RETRIES", "2"))
+STRIPE_API_BASE        = os.getenv("STRIPE_API_BASE", "")
+# memory (per process, default), postgres (shared across instances) or off.
+RATE_LIMIT_BACKEND     = os.getenv("RATE_LIMIT_BACKEND", "memory")
+METRICS_TOKEN          = os.getenv("METRICS_TOKEN", "")
+# Bearer token for the /admin/profile endpoints (profiling.py); off when unset.
+PROFILING_TOKEN        = os.getenv("PROFILING_TOKEN", "")
+# Background housekeeping (maintenance.housekeep) cadence; 0 disables it.
+MAINTENANCE_INTERVAL_HOURS = float(os.getenv("MAINTENANCE_INTERVAL_HOURS", "24"))
+# Serving profile (gunicorn.conf.py). WEB_CONCURRENCY is the worker process
+# count; THREADPOOL_SIZE caps the threads each worker runs sync handlers on;
+# DB_MAX_CONNECTIONS is this machine's share of Postgres max_connections,
+# split across workers (see db_pool_size).
+WEB_CONCURRENCY        = int(os.getenv("WEB_CONCURRENCY", "1"))
+THREADPOOL_SIZE        = int(os.getenv("THREADPOOL_SIZE", "8"))
+DB_MAX_CONNECTIONS     = int(os.getenv("DB_MAX_CONNECTIONS", "20"))
+DB_POOL_TIMEOUT        = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# Database outages (degraded.py): how long connecting may take, how long a pool
+# fails fast after losing its database, and the local copies of /data that
+# GET /data answers from and POST /data journals to meanwhile. The journal is
+# off unless JOURNAL_DIR is set, and must then be on storage that outlives the
+# machine (a volume): a journaled save has already been answered 202.
+DB_CONNECT_TIMEOUT     = int(os.getenv("DB_CONNECT_TIMEOUT", "3"))
+DB_RETRY_SECONDS       = float(os.getenv("DB_RETRY_SECONDS", "5"))
+SNAPSHOT_DIR           = os.getenv("SNAPSHOT_DIR", os.path.join(tempfile.gettempdir(), "tt-snapshots"))
+SNAPSHOT_MAX_MB        = float(os.getenv("SNAPSHOT_MAX_MB", "256"))
+JOURNAL_DIR            = os.getenv("JOURNAL_DIR", "")
+JOURNAL_MAX_MB         = float(os.getenv("JOURNAL_MAX_MB", "256"))
+# Weekly share cards (cards.py): render processes per worker (0 = render in a
+# thread) and the on-disk cache shared by all workers.
+CARD_WORKERS           = int(os.getenv("CARD_WORKERS", "1"))
+CARD_CACHE_DIR         = os.getenv("CARD_CACHE_DIR", os.path.join(tempfile.gettempdir(), "tt-cards"))
+CARD_CACHE_MAX_MB      = float(os.getenv("CARD_CACHE_MAX_MB", "64"))
+# Embed the signed-in user's /data and billing state in GET / (see index_response).
+INLINE_BOOTSTRAP       = os.getenv("INLINE_BOOTSTRAP", "1") == "1"
 
 bearer = HTTPBearer()
 
@@ -53,96 +115,568 @@ app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 CANONICAL_HOST = "doingit.online"
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "testserver")
+
+
+class CanonicalHostMiddleware:
+    """
+    301s requests for any other host (e.g. the fly.dev name) to
+    canonical_host, keeping scheme, port, path and query, and marks /static/
+    responses no-cache. Plain ASGI: requests pass straight through to the app,
+    with no extra task or body buffering as with @app.middleware("http"), so
+    streamed exports reach the client chunk by chunk.
+    """
+
+    def __init__(self, app, canonical_host: str, local_hosts=LOCAL_HOSTS):
+        self.app = app
+        self.canonical_host = canonical_host
+        self.allowed = frozenset({canonical_host, *local_hosts})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        for name, value in scope["headers"]:
+            if name == b"host":
+                host, sep, port = value.decode("latin-1").partition(":")
+                if host and host not in self.allowed:
+                    await self.redirect(scope, sep + port)(scope, receive, send)
+                    return
+                break
+        if scope["path"].startswith("/static/"):
+            await self.app(scope, receive, self.no_cache(send))
+        else:
+            await self.app(scope, receive, send)
 
-@app.middleware("http")
-async def redirect_to_canonical(request: Request, call_next):
-    host = request.headers.get("host", "").split(":")[0]
-    if host and host != CANONICAL_HOST and host not in ("localhost", "127.0.0.1", "testserver"):
-        url = str(request.url).replace(f"://{host}", f"://{CANONICAL_HOST}", 1)
-        from fastapi.responses import RedirectResponse
+    def redirect(self, scope, port: str) -> RedirectResponse:
+        url = f"{scope['scheme']}://{self.canonical_host}{port}{scope['path']}"
+        if scope.get("query_string"):
+            url += "?" + scope["query_string"].decode("latin-1")
         return RedirectResponse(url, status_code=301)
-    response = await call_next(request)
-    if request.url.path.startswith("/static/"):
-        response.headers["Cache-Control"] = "no-cache"
-    return response
+
+    @staticmethod
+    def no_cache(send):
+        async def send_no_cache(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message)["Cache-Control"] = "no-cache"
+            await send(message)
+        return send_no_cache
+
+
+app.add_middleware(CanonicalHostMiddleware, canonical_host=CANONICAL_HOST)
+
+
+# ── Later item ordering ──────────────────────────────────────────────────────
+# later_items.position holds fractional keys: strings over POSITION_DIGITS
+# compared bytewise (COLLATE "C"). There is always a key between any two
+# others, so an insert or move writes only the row that changed.
+POSITION_DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+POSITION_MAX_LEN = 24
+
+
+def position_between(a: str | None, b: str | None) -> str:
+    """A key strictly between a and b (None = open end). Keys never end in '0'."""
+    a = a or ""
+    if b is not None:
+        n = 0
+        while n < len(b) and (a[n] if n < len(a) else "0") == b[n]:
+            n += 1
+        if n:
+            return b[:n] + position_between(a[n:], b[n:])
+    da = POSITION_DIGITS.index(a[0]) if a else 0
+    db = POSITION_DIGITS.index(b[0]) if b is not None else len(POSITION_DIGITS)
+    if db - da > 1:
+        return POSITION_DIGITS[(da + db) // 2]
+    if b is not None and len(b) > 1:
+        return b[0]
+    return POSITION_DIGITS[da] + position_between(a[1:], None)
+
+
+def positions_between(a: str | None, b: str | None, n: int) -> list[str]:
+    """n ascending keys between a and b, split evenly so key length grows with log(n)."""
+    if n <= 0:
+        return []
+    mid = position_between(a, b)
+    left = n // 2
+    return positions_between(a, mid, left) + [mid] + positions_between(mid, b, n - left - 1)
+
+
+def _longest_increasing(seq: list[int]) -> set[int]:
+    """Indices into seq of one longest strictly increasing subsequence."""
+    tails, prev = [], [None] * len(seq)  # tails[k]: index ending the best run of length k+1
+    for i, v in enumerate(seq):
+        lo, hi = 0, len(tails)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if seq[tails[mid]] < v:
+                lo = mid + 1
+            else:
+                hi = mid
+        prev[i] = tails[lo - 1] if lo else None
+        if lo == len(tails):
+            tails.append(i)
+        else:
+            tails[lo] = i
+    keep, i = set(), tails[-1] if tails else None
+    while i is not None:
+        keep.add(i)
+        i = prev[i]
+    return keep
+
+
+def rekey_later_items(cur):
+    """Give every user's later items fresh, evenly spaced keys in their current order."""
+    with cur.connection.cursor(cursor_factory=psycopg2.extensions.cursor) as plain:
+        plain.execute("SELECT user_id, id FROM later_items ORDER BY user_id, position")
+        by_user: dict[int, list[str]] = {}
+        for uid, item_id in plain.fetchall():
+            by_user.setdefault(uid, []).append(item_id)
+        rows = [
+            (uid, item_id, key)
+            for uid, ids in by_user.items()
+            for item_id, key in zip(ids, positions_between(None, None, len(ids)))
+        ]
+        psycopg2.extras.execute_values(plain, """
+            UPDATE later_items l SET position = v.position
+            FROM (VALUES %s) v(user_id, id, position)
+            WHERE l.user_id = v.user_id AND l.id = v.id
+        """, rows)
+
+
+# ── Daily rollup ─────────────────────────────────────────────────────────────
+# What daily_task_totals should hold, derived from hot and archived sessions.
+DAILY_TOTALS_SQL = """
+    SELECT s.user_id, local_day(s.start_ts, u.time_zone) AS day, s.task_id,
+           COALESCE(SUM(s.end_ts - s.start_ts), 0) AS total_ms, COUNT(*) AS session_count
+    FROM (
+        SELECT user_id, task_id, start_ts, end_ts FROM sessions
+        UNION ALL
+        SELECT a.user_id, a.task_id, x.start_ts, x.end_ts
+        FROM sessions_archive a, unnest(a.starts, a.ends) AS x(start_ts, end_ts)
+    ) s
+    JOIN users u ON u.id = s.user_id
+    WHERE %(all)s OR s.user_id = ANY(%(uids)s)
+    GROUP BY 1, 2, 3
+"""
+
+
+def rebuild_daily_totals(cur, user_ids: list[int] | None = None) -> int:
+    """Recompute daily_task_totals from sessions, for everyone or just user_ids."""
+    params = {"all": user_ids is None, "uids": user_ids or []}
+    cur.execute(
+        "DELETE FROM daily_task_totals WHERE %(all)s OR user_id = ANY(%(uids)s)", params
+    )
+    cur.execute(
+        "INSERT INTO daily_task_totals (user_id, day, task_id, total_ms, session_count) "
+        + DAILY_TOTALS_SQL, params
+    )
+    return cur.rowcount
+
+
+def verify_daily_totals(cur, user_ids: list[int] | None = None) -> list[dict]:
+    """Rows where daily_task_totals disagrees with the sessions; empty when consistent."""
+    params = {"all": user_ids is None, "uids": user_ids or []}
+    cur.execute(f"""
+        SELECT COALESCE(e.user_id, d.user_id) AS user_id, COALESCE(e.day, d.day) AS day,
+               COALESCE(e.task_id, d.task_id) AS task_id,
+               e.total_ms AS expected_ms, d.total_ms AS stored_ms,
+               e.session_count AS expected_count, d.session_count AS stored_count
+        FROM ({DAILY_TOTALS_SQL}) e
+        FULL JOIN (
+            SELECT * FROM daily_task_totals WHERE %(all)s OR user_id = ANY(%(uids)s)
+        ) d ON d.user_id = e.user_id AND d.day = e.day AND d.task_id = e.task_id
+        WHERE e.total_ms IS DISTINCT FROM d.total_ms
+           OR e.session_count IS DISTINCT FROM d.session_count
+        ORDER BY 1, 2, 3
+    """, params)
+    return cur.fetchall()
+
+
+def create_schema(cur):
+    """Create or upgrade every table. Idempotent; shared by init_db and the test suite."""
+    # ── Existing tables (unchanged) ──────────────────────────
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id            SERIAL PRIMARY KEY,
+            email         TEXT UNIQUE NOT NULL,
+            password_hash TEXT,
+            created_at    TIMESTAMPTZ DEFAULT NOW()
+        )
+    """)
+    cur.execute("ALTER TABLE users ALTER COLUMN password_hash DROP NOT NULL")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id    INTEGER PRIMARY KEY REFERENCES users(id),
+            tasks_json TEXT NOT NULL DEFAULT '{"tasks":[]}'
+        )
+    """)
+    # Plan B: mark which rows have been migrated to normalized tables.
+    # Revert by pointing GET/POST back at user_data. Migrated blobs not
+    # refreshed by a save for a long time are pruned by `maintenance.py
+    # housekeep`; unmigrated ones are never touched.
+    cur.execute(
+        "ALTER TABLE user_data ADD COLUMN IF NOT EXISTS migrated_at TIMESTAMPTZ"
+    )
+    cur.execute(
+        "ALTER TABLE user_data ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()"
+    )
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS password_reset_tokens (
+            token      TEXT PRIMARY KEY,
+            user_id    INTEGER NOT NULL REFERENCES users(id),
+            expires_at TIMESTAMPTZ NOT NULL,
+            used       BOOLEAN NOT NULL DEFAULT FALSE
+        )
+    """)
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS password_reset_tokens_expires ON password_reset_tokens(expires_at)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS password_reset_tokens_user ON password_reset_tokens(user_id)"
+    )
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS stripe_customer_id TEXT")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS subscription_status TEXT DEFAULT 'free'")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS subscription_id TEXT")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS subscription_current_period_end TIMESTAMPTZ")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS trial_started_at TIMESTAMPTZ")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS is_comped BOOLEAN DEFAULT FALSE")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS time_zone TEXT NOT NULL DEFAULT 'UTC'")
+    # The free-tier day stays in the first zone the user set (NULL: not set
+    # yet, time_zone applies); time_zone itself may change once per
+    # TIME_ZONE_CHANGE_MINUTES.
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS quota_time_zone TEXT")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS time_zone_changed_at TIMESTAMPTZ")
+    # Opaque id in the public share-card URL; NULL until the user turns sharing on.
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS share_token TEXT")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS users_share_token ON users(share_token)")
+    # Weekly summary email (digest.py): opted in, and the last week sent.
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS weekly_digest BOOLEAN NOT NULL DEFAULT FALSE")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS digest_sent_for DATE")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS digest_batch TEXT")
+    cur.execute("CREATE INDEX IF NOT EXISTS users_weekly_digest ON users(id) WHERE weekly_digest")
+    # Emails match case-insensitively: lookups use lower(email) = normalize_email(...).
+    # Older rows keep the case they were stored in. If two of them differ only
+    # in case, the unique index can't be built until they are merged.
+    cur.execute("""
+        DO $$
+        BEGIN
+            IF to_regclass('users_email_lower') IS NULL THEN
+                IF EXISTS (SELECT 1 FROM users GROUP BY lower(email) HAVING count(*) > 1) THEN
+                    RAISE NOTICE 'users_email_lower not created: some emails differ only in case '
+                                 '(SELECT lower(email) FROM users GROUP BY 1 HAVING count(*) > 1)';
+                ELSE
+                    CREATE UNIQUE INDEX users_email_lower ON users (lower(email));
+                END IF;
+            END IF;
+        END $$
+    """)
+
+    # ── New normalized tables ────────────────────────────────
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS tasks (
+            id      TEXT    NOT NULL,
+            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            name    TEXT    NOT NULL,
+            PRIMARY KEY (id, user_id)
+        )
+    """)
+    # Sessions are identified by (task_id, user_id, start_ts). Older databases
+    # also carry a surrogate TEXT id with its own index; `maintenance.py
+    # compact-keys` drops it, and until then it defaults to a random UUID so
+    # the app never has to generate one.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            task_id  TEXT   NOT NULL,
+            user_id  INTEGER NOT NULL,
+            start_ts BIGINT NOT NULL,
+            end_ts   BIGINT,
+            PRIMARY KEY (task_id, user_id, start_ts),
+            FOREIGN KEY (task_id, user_id) REFERENCES tasks(id, user_id) ON DELETE CASCADE
+        )
+    """)
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'sessions' AND column_name = 'id'
+    """)
+    if cur.fetchone() is not None:
+        cur.execute("ALTER TABLE sessions ALTER COLUMN id SET DEFAULT gen_random_uuid()::text")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS later_items (
+            id       TEXT    NOT NULL,
+            user_id  INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            text     TEXT    NOT NULL,
+            position TEXT COLLATE "C" NOT NULL,
+            PRIMARY KEY (id, user_id)
+        )
+    """)
+    # Positions are fractional keys (see position_between), so reordering
+    # writes one row. Older databases stored the list index; re-key them.
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'later_items' AND column_name = 'position' AND data_type = 'integer'
+    """)
+    if cur.fetchone() is not None:
+        cur.execute("ALTER TABLE later_items ALTER COLUMN position DROP DEFAULT")
+        cur.execute("""
+            ALTER TABLE later_items ALTER COLUMN position TYPE TEXT COLLATE "C"
+            USING lpad(position::text, 10, '0')
+        """)
+        rekey_later_items(cur)
+    cur.execute("CREATE INDEX IF NOT EXISTS sessions_user_start ON sessions(user_id, start_ts)")
+
+    # ── Denormalized per-task activity ───────────────────────
+    # Kept current by the sessions_task_stats trigger so task lists can be
+    # ordered and summarised without aggregating sessions.
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'tasks' AND column_name = 'last_started_at'
+    """)
+    needs_backfill = cur.fetchone() is None
+    cur.execute("ALTER TABLE tasks ADD COLUMN IF NOT EXISTS last_started_at BIGINT")
+    cur.execute("ALTER TABLE tasks ADD COLUMN IF NOT EXISTS total_ms BIGINT NOT NULL DEFAULT 0")
+    cur.execute("ALTER TABLE tasks ADD COLUMN IF NOT EXISTS session_count INTEGER NOT NULL DEFAULT 0")
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS tasks_user_last_started "
+        "ON tasks(user_id, last_started_at DESC NULLS LAST)"
+    )
+    if needs_backfill:
+        cur.execute("""
+            UPDATE tasks t SET
+                last_started_at = s.last_started_at,
+                total_ms        = s.total_ms,
+                session_count   = s.session_count
+            FROM (
+                SELECT task_id, user_id,
+                       MAX(start_ts)                          AS last_started_at,
+                       COALESCE(SUM(end_ts - start_ts), 0)    AS total_ms,
+                       COUNT(*)                               AS session_count
+                FROM sessions
+                GROUP BY task_id, user_id
+            ) s
+            WHERE t.id = s.task_id AND t.user_id = s.user_id
+        """)
+    # ── Cold session history ─────────────────────────────────
+    # maintenance.py archive moves whole monthly partitions here: one row per
+    # (user, task, month) with the timestamps packed into arrays, which TOAST
+    # compresses. Rows leave the hot sessions table, so sync and aggregation
+    # stop touching them; GET /data?history=full still reads them.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS sessions_archive (
+            user_id     INTEGER NOT NULL,
+            task_id     TEXT    NOT NULL,
+            month_start BIGINT  NOT NULL,
+            starts      BIGINT[] NOT NULL,
+            ends        BIGINT[] NOT NULL,
+            PRIMARY KEY (user_id, task_id, month_start),
+            FOREIGN KEY (task_id, user_id) REFERENCES tasks(id, user_id) ON DELETE CASCADE
+        )
+    """)
+    # Token buckets for RATE_LIMIT_BACKEND=postgres. Losing them in a crash
+    # only resets the limits, so skip the WAL.
+    cur.execute("""
+        CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_buckets (
+            key        TEXT PRIMARY KEY,
+            tokens     DOUBLE PRECISION NOT NULL,
+            updated_at DOUBLE PRECISION NOT NULL
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS app_state (
+            key   TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    """)
+    # ── Shards (shards.py) ───────────────────────────────────
+    # user_shards is the directory, read on the primary: no row = shard 0.
+    # previous is set while a move is switched over but not yet cleaned up.
+    # moved_users holds a tombstone on each shard a user has left.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_shards (
+            user_id  INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+            shard    SMALLINT NOT NULL,
+            previous SMALLINT
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS moved_users (
+            user_id  INTEGER PRIMARY KEY,
+            shard    SMALLINT NOT NULL,
+            moved_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS import_jobs (
+            id             TEXT PRIMARY KEY,
+            user_id        INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            format         TEXT NOT NULL,
+            status         TEXT NOT NULL DEFAULT 'queued',
+            bytes          BIGINT NOT NULL DEFAULT 0,
+            rows_parsed    INTEGER NOT NULL DEFAULT 0,
+            rows_rejected  INTEGER NOT NULL DEFAULT 0,
+            rows_inserted  INTEGER NOT NULL DEFAULT 0,
+            rows_duplicate INTEGER NOT NULL DEFAULT 0,
+            tasks_created  INTEGER NOT NULL DEFAULT 0,
+            error          TEXT,
+            created_at     TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            finished_at    TIMESTAMPTZ
+        )
+    """)
+
+    # ── Daily rollup ─────────────────────────────────────────
+    # Per (user, local day, task) totals kept current by the
+    # sessions_daily_totals trigger, so quota checks and history charts read
+    # O(days) rows. Days are in users.time_zone, a session counts on the day
+    # it started, and, as with tasks.total_ms, archived sessions stay counted.
+    cur.execute("SELECT 1 FROM information_schema.tables WHERE table_name = 'daily_task_totals'")
+    needs_rollup_backfill = cur.fetchone() is None
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS daily_task_totals (
+            user_id       INTEGER NOT NULL,
+            day           DATE    NOT NULL,
+            task_id       TEXT    NOT NULL,
+            total_ms      BIGINT  NOT NULL DEFAULT 0,
+            session_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day, task_id),
+            FOREIGN KEY (task_id, user_id) REFERENCES tasks(id, user_id) ON DELETE CASCADE
+        )
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION local_day(ts BIGINT, tz TEXT) RETURNS DATE AS $$
+            SELECT (to_timestamp(ts / 1000.0) AT TIME ZONE COALESCE(tz, 'UTC'))::date
+        $$ LANGUAGE sql STABLE
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION sessions_daily_totals() RETURNS trigger AS $$
+        DECLARE
+            tz TEXT;
+        BEGIN
+            IF TG_OP = 'UPDATE' AND OLD.task_id = NEW.task_id AND OLD.user_id = NEW.user_id
+               AND OLD.start_ts = NEW.start_ts AND OLD.end_ts IS NOT DISTINCT FROM NEW.end_ts THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP <> 'INSERT' THEN
+                SELECT time_zone INTO tz FROM users WHERE id = OLD.user_id;
+                UPDATE daily_task_totals SET
+                    total_ms      = total_ms - COALESCE(OLD.end_ts - OLD.start_ts, 0),
+                    session_count = session_count - 1
+                WHERE user_id = OLD.user_id AND task_id = OLD.task_id
+                  AND day = local_day(OLD.start_ts, tz);
+                DELETE FROM daily_task_totals
+                WHERE user_id = OLD.user_id AND task_id = OLD.task_id
+                  AND day = local_day(OLD.start_ts, tz) AND session_count <= 0;
+            END IF;
+            IF TG_OP <> 'DELETE' THEN
+                SELECT time_zone INTO tz FROM users WHERE id = NEW.user_id;
+                INSERT INTO daily_task_totals (user_id, day, task_id, total_ms, session_count)
+                VALUES (NEW.user_id, local_day(NEW.start_ts, tz), NEW.task_id,
+                        COALESCE(NEW.end_ts - NEW.start_ts, 0), 1)
+                ON CONFLICT (user_id, day, task_id) DO UPDATE SET
+                    total_ms      = daily_task_totals.total_ms + EXCLUDED.total_ms,
+                    session_count = daily_task_totals.session_count + 1;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    cur.execute("""
+        CREATE OR REPLACE TRIGGER sessions_daily_totals
+        AFTER INSERT OR UPDATE OR DELETE ON sessions
+        FOR EACH ROW EXECUTE FUNCTION sessions_daily_totals()
+    """)
+    if needs_rollup_backfill:
+        rebuild_daily_totals(cur)
+
+    # ── Search ───────────────────────────────────────────────
+    # Trigram indexes turn GET /search's ILIKE '%q%' into an index lookup.
+    # pg_trgm ships with Postgres but isn't installable everywhere; without it
+    # search still works by walking the user's tasks in recency order.
+    cur.execute("""
+        DO $$ BEGIN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        EXCEPTION WHEN OTHERS THEN
+            RAISE NOTICE 'pg_trgm unavailable, search runs without trigram indexes: %', SQLERRM;
+        END $$
+    """)
+    cur.execute("""
+        DO $$ BEGIN
+            IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+                EXECUTE 'CREATE INDEX IF NOT EXISTS tasks_name_trgm ON tasks USING gin (name gin_trgm_ops)';
+                EXECUTE 'CREATE INDEX IF NOT EXISTS later_items_text_trgm ON later_items USING gin (text gin_trgm_ops)';
+            END IF;
+        END $$
+    """)
+
+    # total_ms only counts closed sessions; a running session adds to it when it ends.
+    # Archived sessions stay counted: archiving detaches partitions, which fires no triggers.
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION sessions_task_stats() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE' AND OLD.task_id = NEW.task_id
+               AND OLD.user_id = NEW.user_id AND OLD.start_ts = NEW.start_ts THEN
+                UPDATE tasks SET total_ms = total_ms
+                    + COALESCE(NEW.end_ts - NEW.start_ts, 0)
+                    - COALESCE(OLD.end_ts - OLD.start_ts, 0)
+                WHERE id = NEW.task_id AND user_id = NEW.user_id;
+                RETURN NULL;
+            END IF;
+            IF TG_OP <> 'INSERT' THEN
+                UPDATE tasks SET
+                    total_ms        = total_ms - COALESCE(OLD.end_ts - OLD.start_ts, 0),
+                    session_count   = session_count - 1,
+                    last_started_at = CASE WHEN last_started_at = OLD.start_ts THEN COALESCE(
+                        (SELECT MAX(start_ts) FROM sessions
+                         WHERE task_id = OLD.task_id AND user_id = OLD.user_id),
+                        (SELECT MAX(ts) FROM sessions_archive a, unnest(a.starts) ts
+                         WHERE a.task_id = OLD.task_id AND a.user_id = OLD.user_id)
+                    ) ELSE last_started_at END
+                WHERE id = OLD.task_id AND user_id = OLD.user_id;
+            END IF;
+            IF TG_OP <> 'DELETE' THEN
+                UPDATE tasks SET
+                    total_ms        = total_ms + COALESCE(NEW.end_ts - NEW.start_ts, 0),
+                    session_count   = session_count + 1,
+                    last_started_at = GREATEST(last_started_at, NEW.start_ts)
+                WHERE id = NEW.task_id AND user_id = NEW.user_id;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    cur.execute("""
+        CREATE OR REPLACE TRIGGER sessions_task_stats
+        AFTER INSERT OR UPDATE OR DELETE ON sessions
+        FOR EACH ROW EXECUTE FUNCTION sessions_task_stats()
+    """)
+
+
+# Transaction-level advisory lock: every gunicorn worker runs startup, and
+# concurrent DDL on the same objects would otherwise fail or deadlock.
+SCHEMA_LOCK = 7_447_002
 
 
 def init_db():
-    for attempt in range(10):
+    """The schema on the primary and, when sharded, on every shard."""
+    for url in shard_map.urls:
+        with psycopg2.connect(url, connect_timeout=DB_CONNECT_TIMEOUT) as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK,))
+                create_schema(cur)
+        conn.close()
+
+
+def prepare_db(max_delay: float = 60):
+    """init_db, retried with backoff until every database answers, then migrate_blobs."""
+    delay = 1
+    while True:
         try:
-            with psycopg2.connect(DATABASE_URL) as conn:
-                with conn.cursor() as cur:
-                    # ── Existing tables (unchanged) ──────────────────────────
-                    cur.execute("""
-                        CREATE TABLE IF NOT EXISTS users (
-                            id            SERIAL PRIMARY KEY,
-                            email         TEXT UNIQUE NOT NULL,
-                            password_hash TEXT,
-                            created_at    TIMESTAMPTZ DEFAULT NOW()
-                        )
-                    """)
-                    cur.execute("ALTER TABLE users ALTER COLUMN password_hash DROP NOT NULL")
-                    cur.execute("""
-                        CREATE TABLE IF NOT EXISTS user_data (
-                            user_id    INTEGER PRIMARY KEY REFERENCES users(id),
-                            tasks_json TEXT NOT NULL DEFAULT '{"tasks":[]}'
-                        )
-                    """)
-                    # Plan B: mark which rows have been migrated to normalized tables.
-                    # The blob is never deleted — revert by pointing GET/POST back at user_data.
-                    cur.execute(
-                        "ALTER TABLE user_data ADD COLUMN IF NOT EXISTS migrated_at TIMESTAMPTZ"
-                    )
-                    cur.execute("""
-                        CREATE TABLE IF NOT EXISTS password_reset_tokens (
-                            token      TEXT PRIMARY KEY,
-                            user_id    INTEGER NOT NULL REFERENCES users(id),
-                            expires_at TIMESTAMPTZ NOT NULL,
-                            used       BOOLEAN NOT NULL DEFAULT FALSE
-                        )
-                    """)
-                    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS stripe_customer_id TEXT")
-                    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS subscription_status TEXT DEFAULT 'free'")
-                    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS subscription_id TEXT")
-                    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS subscription_current_period_end TIMESTAMPTZ")
-                    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS trial_started_at TIMESTAMPTZ")
-                    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS is_comped BOOLEAN DEFAULT FALSE")
-
-                    # ── New normalized tables ────────────────────────────────
-                    cur.execute("""
-                        CREATE TABLE IF NOT EXISTS tasks (
-                            id      TEXT    NOT NULL,
-                            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-                            name    TEXT    NOT NULL,
-                            PRIMARY KEY (id, user_id)
-                        )
-                    """)
-                    cur.execute("""
-                        CREATE TABLE IF NOT EXISTS sessions (
-                            id       TEXT   NOT NULL PRIMARY KEY,
-                            task_id  TEXT   NOT NULL,
-                            user_id  INTEGER NOT NULL,
-                            start_ts BIGINT NOT NULL,
-                            end_ts   BIGINT,
-                            FOREIGN KEY (task_id, user_id) REFERENCES tasks(id, user_id) ON DELETE CASCADE,
-                            UNIQUE (task_id, user_id, start_ts)
-                        )
-                    """)
-                    cur.execute("""
-                        CREATE TABLE IF NOT EXISTS later_items (
-                            id       TEXT    NOT NULL,
-                            user_id  INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-                            text     TEXT    NOT NULL,
-                            position INTEGER NOT NULL DEFAULT 0,
-                            PRIMARY KEY (id, user_id)
-                        )
-                    """)
-                    cur.execute("CREATE INDEX IF NOT EXISTS sessions_user_start ON sessions(user_id, start_ts)")
-            return
-        except psycopg2.OperationalError:
-            if attempt == 9:
-                raise
-            time.sleep(2 ** attempt)
+            init_db()
+            break
+        except psycopg2.OperationalError as e:
+            print(f"[startup] database unreachable, retrying in {delay}s: {str(e).strip()}")
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+    print("[startup] database schema ready")
+    migrate_blobs()
 
 
 def migrate_blobs():
@@ -175,17 +709,18 @@ def migrate_blobs():
                         )
                         for s in task.get("sessions", []):
                             cur.execute(
-                                "INSERT INTO sessions (id, task_id, user_id, start_ts, end_ts) "
-                                "VALUES (%s, %s, %s, %s, %s) "
+                                "INSERT INTO sessions (task_id, user_id, start_ts, end_ts) "
+                                "VALUES (%s, %s, %s, %s) "
                                 "ON CONFLICT (task_id, user_id, start_ts) DO NOTHING",
-                                (str(uuid_mod.uuid4()), task["id"], uid, s["start"], s.get("end")),
+                                (task["id"], uid, s["start"], s.get("end")),
                             )
-                    for i, item in enumerate(payload.get("later", [])):
+                    later = payload.get("later", [])
+                    for item, key in zip(later, positions_between(None, None, len(later))):
                         cur.execute(
                             "INSERT INTO later_items (id, user_id, text, position) "
                             "VALUES (%s, %s, %s, %s) "
                             "ON CONFLICT (id, user_id) DO NOTHING",
-                            (item["id"], uid, item["text"], i),
+                            (item["id"], uid, item["text"], key),
                         )
                     cur.execute(
                         "UPDATE user_data SET migrated_at = NOW() WHERE user_id = %s",
@@ -197,193 +732,2031 @@ def migrate_blobs():
             print(f"[migration] user {uid} FAILED: {e}")
 
 
-@app.on_event("startup")
-def startup():
-    init_db()
-    migrate_blobs()
+def housekeeping_loop(check_every: float = 600):
+    """
+    Every instance checks periodically; the advisory lock and the last-run
+    stamp in app_state make sure housekeeping runs once per interval overall,
+    even though machines stop when idle and rarely live a full interval.
+    Each shard is its own database with its own lock and stamp.
+    """
+    from maintenance import housekeep
+
+    while True:
+        time.sleep(check_every)
+        for url in shard_map.urls:
+            try:
+                conn = psycopg2.connect(url, cursor_factory=psycopg2.extras.RealDictCursor)
+                conn.autocommit = True
+                try:
+                    with conn.cursor() as cur:
+                        housekeep(cur, min_interval_hours=MAINTENANCE_INTERVAL_HOURS, full_rollup_check=False)
+                finally:
+                    conn.close()
+            except Exception as e:
+                print(f"[maintenance] housekeeping failed: {e}")
+
+
+@app.on_event("startup")
+def startup():
+    # Sync handlers and dependencies run on AnyIO's default limiter (40 threads);
+    # size it to the serving profile so threads don't outnumber connections.
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    print(f"[serving] pid {os.getpid()}: {THREADPOOL_SIZE} threads, "
+          f"{db_pool.size} pooled connections per database ({WEB_CONCURRENCY} workers, "
+          f"{len(shard_pools)} databases)")
+    # Don't hold up serving while the database is down: GET and POST /data can
+    # answer from the local snapshots and journal (degraded.py) meanwhile.
+    try:
+        init_db()
+    except psycopg2.OperationalError:
+        threading.Thread(target=prepare_db, daemon=True).start()
+    else:
+        migrate_blobs()
+    if journal is not None:
+        threading.Thread(target=journal_replay_loop, daemon=True).start()
+    if MAINTENANCE_INTERVAL_HOURS > 0:
+        threading.Thread(target=housekeeping_loop, daemon=True).start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    for pool in shard_pools:
+        pool.close()
+    shard_map.close()
+    card_renderer.close()
+    await billing_client.aclose()
+
+
+# ── Connection pool ──────────────────────────────────────────────────────────
+# Connections opened outside the pool per worker: the housekeeping thread,
+# the postgres rate-limit backend, export streams and background jobs.
+DB_RESERVED_PER_WORKER = 2
+
+
+def db_pool_size(workers: int = WEB_CONCURRENCY, threads: int = THREADPOOL_SIZE,
+                 budget: int = DB_MAX_CONNECTIONS) -> int:
+    """
+    Primary connections one worker may hold: its share of the machine's
+    budget less the reserved ones, and never more than it has threads to use.
+    """
+    share = budget // max(1, workers) - DB_RESERVED_PER_WORKER
+    return max(1, min(threads, share))
+
+
+class ConnectionPool:
+    """
+    Per-process pool of primary connections for request handlers. It is
+    opened lazily and keyed by pid, so a pool touched before gunicorn forks
+    its workers (preload_app) is never shared with a child.
+
+    Requests take a slot (db_slot) before a connection. Slots are waited for
+    on the event loop rather than in a worker thread: a thread blocked on a
+    busy pool would be one the connection holders need to finish, so with
+    more requests than connections the worker would stall.
+
+    When the database can't be reached, or a connection is lost mid-request,
+    the pool raises DatabaseUnavailable and its circuit opens: for
+    retry_seconds slots are refused at once, then one request tries again.
+    A lost connection also retires the pool's other connections, which
+    didn't survive the restart either; in-flight ones close as they return.
+    """
+
+    def __init__(self, url: str, size: int, timeout: float = DB_POOL_TIMEOUT,
+                 retry_seconds: float = DB_RETRY_SECONDS):
+        self.url = url
+        self.size = size
+        self.timeout = timeout
+        self.breaker = CircuitBreaker(threshold=1, reset_seconds=retry_seconds)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._slots = None
+
+    def _open(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # psycopg2 only keeps minconn connections idle, so min == max.
+                self._pool = psycopg2.pool.ThreadedConnectionPool(
+                    self.size, self.size, self.url, cursor_factory=psycopg2.extras.RealDictCursor,
+                    connect_timeout=DB_CONNECT_TIMEOUT,
+                )
+                self._pid = os.getpid()
+
+    @asynccontextmanager
+    async def slot(self):
+        if not self.breaker.allow():
+            raise DatabaseUnavailable("database unreachable; not retrying yet")
+        if self._slots is None or self._slots_pid != os.getpid():
+            self._slots, self._slots_pid = anyio.Semaphore(self.size), os.getpid()
+        slots = self._slots
+        try:
+            with anyio.fail_after(self.timeout):
+                await slots.acquire()
+        except TimeoutError:
+            self.breaker.release()
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Database busy, try again")
+        try:
+            yield
+        finally:
+            slots.release()
+            self.breaker.release()
+
+    @contextmanager
+    def connection(self):
+        """A pooled connection; callers must hold a slot, so one is always free."""
+        if self._pid != os.getpid():
+            try:
+                self._open()
+            except psycopg2.OperationalError as e:
+                self.breaker.record_failure()
+                raise DatabaseUnavailable(str(e).strip()) from e
+        pool = self._pool
+        conn = pool.getconn()
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            broken = True  # e.g. the server restarted; don't hand this one out again
+            if conn.closed and not isinstance(e, DatabaseUnavailable):
+                self.breaker.record_failure()
+                with self._lock:
+                    if self._pool is pool:
+                        self._pid = None
+                raise DatabaseUnavailable(str(e).strip()) from e
+            raise
+        else:
+            self.breaker.record_success()
+        finally:
+            # putconn rolls back anything left uncommitted.
+            pool.putconn(conn, close=broken or bool(conn.closed))
+
+    def close(self):
+        if self._pid == os.getpid():
+            self._pool.closeall()
+            self._pid = None
+
+
+db_pool = ConnectionPool(DATABASE_URL, db_pool_size())
+
+
+async def db_slot():
+    async with db_pool.slot():
+        yield
+
+
+def _db_session(conn, home_of: int | None = None, write: bool = False):
+    cur = conn.cursor()
+    if home_of is not None:
+        check_home(cur, home_of, write)
+    yield cur
+    conn.commit()
+
+
+def get_db(_slot: Annotated[None, Depends(db_slot)]):
+    with db_pool.connection() as conn:
+        yield from _db_session(conn)
+
+
+def replica_lag_seconds(url: str) -> float:
+    """Replay lag of a standby; 0 when it has replayed everything it received."""
+    with psycopg2.connect(url, connect_timeout=2) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+                       END
+            """)
+            lag = cur.fetchone()[0]
+    conn.close()
+    return float(lag or 0)
+
+
+READ_PIN_COOKIE = "tt_pin"
+
+# The calling request's read pin state, set by ReadPinMiddleware: "pinned" is
+# the (user_id, until) a valid tt_pin cookie carried in, and "wrote" is the pin
+# to send back after this request wrote. Both times are wall clock, so any
+# worker can honor them.
+_read_pin: contextvars.ContextVar[dict | None] = contextvars.ContextVar("read_pin", default=None)
+
+
+def read_pin_sig(user_id: int, until_ms: int) -> str:
+    return hmac.new(SECRET_KEY.encode(), f"pin:{user_id}.{until_ms}".encode(), "sha256").hexdigest()[:32]
+
+
+def parse_read_pin(value: str) -> tuple[int, float] | None:
+    """The (user_id, until) of a tt_pin cookie value, or None if it is malformed or forged."""
+    try:
+        user_id, until_ms, sig = value.split(".")
+        user_id, until_ms = int(user_id), int(until_ms)
+    except ValueError:
+        return None
+    if not hmac.compare_digest(sig, read_pin_sig(user_id, until_ms)):
+        return None
+    return user_id, until_ms / 1000
+
+
+class ReplicaRouter:
+    """
+    Chooses a replica for read-only requests, or None for the primary.
+
+    Users are pinned to the primary for pin_seconds after they write. The pin
+    is kept in this process and, inside a request, also handed to the client
+    as a signed tt_pin cookie (see ReadPinMiddleware), so the browser reads its
+    own writes whichever worker serves the next request. Clients that drop
+    cookies only get the per-process pin. Each replica's lag is probed at most
+    every check_interval seconds, by one thread at a time and without holding
+    the lock; replicas that lag beyond max_lag or fail to answer are skipped
+    until the next probe.
+    """
+
+    def __init__(self, urls, max_lag=REPLICA_MAX_LAG_SECONDS, pin_seconds=REPLICA_PIN_SECONDS,
+                 check_interval=2.0, probe=replica_lag_seconds, max_pins=10_000):
+        self.urls = list(urls)
+        self.max_lag = max_lag
+        self.pin_seconds = pin_seconds
+        self.check_interval = check_interval
+        self.probe = probe
+        self.max_pins = max_pins
+        self._pins: dict[int, float] = {}
+        self._prune_at = max_pins
+        self._health: dict[str, tuple[float, bool]] = {}
+        self._probing: set[str] = set()
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def pin(self, user_id: int):
+        if not self.urls:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._pins[user_id] = now + self.pin_seconds
+            if len(self._pins) > self._prune_at:
+                self._prune(now)
+        state = _read_pin.get()
+        if state is not None:
+            state["wrote"] = (user_id, time.time() + self.pin_seconds)
+
+    def _prune(self, now: float):
+        """Drops expired pins; the next prune waits until the dict doubles, so it stays amortized O(1)."""
+        self._pins = {uid: until for uid, until in self._pins.items() if until > now}
+        self._prune_at = max(self.max_pins, 2 * len(self._pins))
+
+    def mark_down(self, url: str):
+        with self._lock:
+            self._health[url] = (time.monotonic(), False)
+
+    def _healthy(self, url: str, now: float) -> bool:
+        with self._lock:
+            checked_at, ok = self._health.get(url, (float("-inf"), False))
+            if now - checked_at < self.check_interval or url in self._probing:
+                return ok
+            self._probing.add(url)
+        try:
+            ok = self.probe(url) <= self.max_lag
+        except psycopg2.Error:
+            ok = False
+        finally:
+            with self._lock:
+                self._probing.discard(url)
+        with self._lock:
+            self._health[url] = (now, ok)
+        return ok
+
+    def pinned(self, user_id: int) -> bool:
+        state = _read_pin.get()
+        if state is not None and state["pinned"] is not None:
+            uid, until = state["pinned"]
+            if uid == user_id and time.time() < until:
+                return True
+        now = time.monotonic()
+        with self._lock:
+            until = self._pins.get(user_id)
+            if until is None:
+                return False
+            if now < until:
+                return True
+            del self._pins[user_id]
+        return False
+
+    def choose(self, user_id: int) -> str | None:
+        if not self.urls or self.pinned(user_id):
+            return None
+        now = time.monotonic()
+        with self._lock:
+            start = self._next
+            self._next += 1
+        for i in range(len(self.urls)):
+            url = self.urls[(start + i) % len(self.urls)]
+            if self._healthy(url, now):
+                return url
+        return None
+
+
+class ReadPinMiddleware:
+    """
+    Carries read-your-writes pins between workers in a signed tt_pin cookie.
+    Reads the incoming cookie for ReplicaRouter.choose, and when the request
+    wrote (ReplicaRouter.pin) sets a fresh one on the response. Plain ASGI,
+    like CanonicalHostMiddleware.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        state = {"pinned": self.incoming(scope), "wrote": None}
+        token = _read_pin.set(state)
+
+        async def send_with_pin(message):
+            if message["type"] == "http.response.start" and state["wrote"] is not None:
+                MutableHeaders(scope=message).append("Set-Cookie", self.cookie(scope, *state["wrote"]))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_pin)
+        finally:
+            _read_pin.reset(token)
+
+    @staticmethod
+    def incoming(scope) -> tuple[int, float] | None:
+        for name, value in scope["headers"]:
+            if name == b"cookie":
+                for part in value.decode("latin-1").split(";"):
+                    key, _, val = part.strip().partition("=")
+                    if key == READ_PIN_COOKIE:
+                        return parse_read_pin(val)
+        return None
+
+    @staticmethod
+    def cookie(scope, user_id: int, until: float) -> str:
+        until_ms = int(until * 1000)
+        max_age = max(1, round(until - time.time()))
+        value = f"{user_id}.{until_ms}.{read_pin_sig(user_id, until_ms)}"
+        secure = "; Secure" if scope.get("scheme") == "https" else ""
+        return f"{READ_PIN_COOKIE}={value}; Max-Age={max_age}; Path=/; HttpOnly; SameSite=Strict{secure}"
+
+
+replicas = ReplicaRouter(DATABASE_REPLICA_URLS)
+app.add_middleware(ReadPinMiddleware)
+
+
+def current_user_id(
+    credentials: Annotated[HTTPAuthorizationCredentials, Depends(bearer)],
+) -> int:
+    try:
+        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+        user_id = payload.get("sub")
+        if user_id is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+        return int(user_id)
+    except JWTError:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+
+
+def connect_replica(user_id: int):
+    """A healthy replica connection when one is configured, else None."""
+    url = replicas.choose(user_id)
+    if url is not None:
+        try:
+            return psycopg2.connect(url, connect_timeout=2, cursor_factory=psycopg2.extras.RealDictCursor)
+        except psycopg2.OperationalError:
+            replicas.mark_down(url)
+    return None
+
+
+def connect_for_read(user_id: int):
+    """A healthy replica connection when one is configured, else the primary."""
+    return connect_replica(user_id) or psycopg2.connect(
+        DATABASE_URL, cursor_factory=psycopg2.extras.RealDictCursor
+    )
+
+
+def _read_session(user_id: int, fenced: bool = False):
+    """A replica or pooled primary session; fenced when it reads the user's own rows (see check_home)."""
+    home_of = user_id if fenced else None
+    conn = connect_replica(user_id)
+    if conn is None:
+        with db_pool.connection() as conn:
+            yield from _db_session(conn, home_of)
+        return
+    try:
+        yield from _db_session(conn, home_of)
+    finally:
+        conn.close()
+
+
+def get_read_db(user_id: Annotated[int, Depends(current_user_id)],
+                _slot: Annotated[None, Depends(db_slot)]):
+    """Cursor for read-only handlers: a replica (see connect_replica), else a pooled primary one."""
+    yield from _read_session(user_id)
+
+
+def get_stream_db(user_id: Annotated[int, Depends(current_user_id)]):
+    """
+    Connection opener for streaming responses. Dependency teardown runs before
+    the body is streamed, so the response's generator opens and closes the
+    connection itself.
+    """
+    @contextmanager
+    def open_conn():
+        conn = connect_home(user_id, write=False)
+        try:
+            yield conn
+        finally:
+            conn.close()
+    return open_conn
+
+
+def get_job_db(user_id: Annotated[int, Depends(current_user_id)]):
+    """Connection opener for background jobs, which run after the request's own connection is gone."""
+    @contextmanager
+    def open_conn():
+        conn = connect_home(user_id, write=True)
+        try:
+            yield conn
+        finally:
+            conn.close()
+    return open_conn
+
+
+def _run_in_db(fn, *args):
+    with db_pool.connection() as conn:
+        with conn.cursor() as cur:
+            result = fn(cur, *args)
+        conn.commit()
+        return result
+
+
+async def run_in_db(fn, *args):
+    """
+    fn(cursor, *args) as one transaction on a pooled connection, in a thread.
+    For async handlers that wait on another service between queries and must
+    not hold a connection meanwhile.
+    """
+    async with db_pool.slot():
+        return await anyio.to_thread.run_sync(_run_in_db, fn, *args)
+
+
+async def get_db_runner():
+    return run_in_db
+
+
+# ── Shards ───────────────────────────────────────────────────────────────────
+# Handlers that only touch the user's own rows take get_user_db or
+# get_user_read_db, a session on the user's home shard (shards.py). Handlers
+# that also need the users row take get_db or get_read_db for it plus
+# get_home_db or get_home_read_db, which hand back that same cursor while the
+# user lives on shard 0. Without DATABASE_SHARD_URLS everyone lives there and
+# none of this costs a query.
+shard_map = ShardMap(DATABASE_URL, DATABASE_SHARD_URLS)
+shard_pools = [db_pool] + [ConnectionPool(url, db_pool_size()) for url in DATABASE_SHARD_URLS]
+USER_MOVED = "Your data has just moved to another database; try again"
+
+
+async def home_shard(user_id: int) -> int:
+    shard = shard_map.cached(user_id)
+    if shard is None:
+        try:
+            shard = await anyio.to_thread.run_sync(shard_map.home, user_id)
+        except psycopg2.OperationalError as e:
+            raise DatabaseUnavailable(str(e).strip()) from e
+    return shard
+
+
+def check_home(cur, user_id: int, write: bool):
+    """
+    fence() a session on the shard the user was last seen on. If they have
+    been moved since, forget that and answer 503; the retry looks them up
+    afresh. Pooled sessions can't follow the move themselves: the request
+    holds a slot for this shard, not the new one.
+    """
+    if shard_map.enabled and fence(cur, user_id, write):
+        shard_map.forget(user_id)
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail=USER_MOVED, headers={"Retry-After": "1"})
+
+
+async def user_slot(user_id: Annotated[int, Depends(current_user_id)]):
+    """db_slot on the user's home shard; yields the shard."""
+    shard = await home_shard(user_id)
+    async with shard_pools[shard].slot():
+        yield shard
+
+
+def get_user_db(user_id: Annotated[int, Depends(current_user_id)],
+                shard: Annotated[int, Depends(user_slot)]):
+    """Cursor on the user's home shard, for handlers that only touch the user's own rows."""
+    with shard_pools[shard].connection() as conn:
+        yield from _db_session(conn, user_id, write=True)
+
+
+def _user_read_session(user_id: int, shard: int):
+    if shard == 0:
+        yield from _read_session(user_id, fenced=True)
+        return
+    with shard_pools[shard].connection() as conn:
+        yield from _db_session(conn, user_id)
+
+
+def get_user_read_db(user_id: Annotated[int, Depends(current_user_id)],
+                     shard: Annotated[int, Depends(user_slot)]):
+    """get_user_db for read-only handlers; on shard 0 a replica may answer (see get_read_db)."""
+    yield from _user_read_session(user_id, shard)
+
+
+async def home_slot(user_id: Annotated[int, Depends(current_user_id)],
+                    _slot: Annotated[None, Depends(db_slot)]):
+    """user_slot next to a primary connection: taken after db_slot, and not at all on shard 0."""
+    shard = await home_shard(user_id)
+    if shard == 0:
+        yield 0
+        return
+    async with shard_pools[shard].slot():
+        yield shard
+
+
+def _home_session(main, user_id: int, shard: int, write: bool):
+    if shard == 0:
+        check_home(main, user_id, write)
+        yield main
+        return
+    with shard_pools[shard].connection() as conn:
+        yield from _db_session(conn, user_id, write)
+
+
+def get_home_db(user_id: Annotated[int, Depends(current_user_id)],
+                shard: Annotated[int, Depends(home_slot)],
+                db: Annotated[psycopg2.extensions.cursor, Depends(get_db)]):
+    """The user's home-shard cursor beside get_db's; the same cursor on shard 0."""
+    yield from _home_session(db, user_id, shard, write=True)
+
+
+def get_home_read_db(user_id: Annotated[int, Depends(current_user_id)],
+                     shard: Annotated[int, Depends(home_slot)],
+                     db: Annotated[psycopg2.extensions.cursor, Depends(get_read_db)]):
+    """The user's home-shard cursor beside get_read_db's; the same cursor on shard 0."""
+    yield from _home_session(db, user_id, shard, write=False)
+
+
+def connect_home(user_id: int, write: bool):
+    """
+    An unpooled connection to the user's home shard, for streams and jobs; on
+    shard 0 reads may go to a replica. These can follow a move, so they do.
+    """
+    for _ in range(3):
+        shard = shard_map.home(user_id)
+        if shard == 0 and not write:
+            conn = connect_for_read(user_id)
+        else:
+            conn = psycopg2.connect(shard_map.urls[shard], connect_timeout=DB_CONNECT_TIMEOUT,
+                                    cursor_factory=psycopg2.extras.RealDictCursor)
+        if not shard_map.enabled:
+            return conn
+        with conn.cursor() as cur:
+            moved = fence(cur, user_id, write)
+        if not moved:
+            return conn
+        conn.close()
+        shard_map.forget(user_id)
+    raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        detail=USER_MOVED, headers={"Retry-After": "1"})
+
+
+def _run_in_home(shard: int, user_id: int, fn, *args):
+    with shard_pools[shard].connection() as conn:
+        with conn.cursor() as cur:
+            check_home(cur, user_id, write=True)
+            result = fn(cur, *args)
+        conn.commit()
+        return result
+
+
+async def run_in_home(user_id: int, fn, *args):
+    """run_in_db on the user's home shard."""
+    shard = await home_shard(user_id)
+    async with shard_pools[shard].slot():
+        return await anyio.to_thread.run_sync(_run_in_home, shard, user_id, fn, *args)
+
+
+async def get_home_runner():
+    return run_in_home
+
+
+def _run_read_in_home(shard: int, user_id: int, fn, *args):
+    with contextmanager(_user_read_session)(user_id, shard) as cur:
+        return fn(cur, *args)
+
+
+async def run_read_in_home(user_id: int, fn, *args):
+    """run_in_home for reads, in get_user_read_db's session."""
+    shard = await home_shard(user_id)
+    async with shard_pools[shard].slot():
+        return await anyio.to_thread.run_sync(_run_read_in_home, shard, user_id, fn, *args)
+
+
+async def get_home_read_runner():
+    return run_read_in_home
+
+
+def normalize_email(email: str) -> str:
+    """The form emails are stored and looked up in (see users_email_lower)."""
+    return email.strip().lower()
+
+
+def make_token(user_id: int) -> str:
+    expire = datetime.now(timezone.utc) + timedelta(days=TOKEN_EXPIRE_DAYS)
+    return jwt.encode({"sub": str(user_id), "exp": expire}, SECRET_KEY, algorithm=ALGORITHM)
+
+
+# ── Rate limiting ────────────────────────────────────────────────────────────
+class RateLimit(NamedTuple):
+    """A token bucket: `capacity` requests at once, refilled over `period` seconds."""
+    scope: str  # "ip" or "email"
+    capacity: int
+    period: float
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / self.period
+
+
+RATE_LIMITS: dict[str, list[RateLimit]] = {
+    "login":           [RateLimit("ip", 30, 60), RateLimit("email", 10, 300)],
+    "signup":          [RateLimit("ip", 10, 600)],
+    "google":          [RateLimit("ip", 30, 60)],
+    "forgot-password": [RateLimit("ip", 10, 600), RateLimit("email", 3, 3600)],
+    "time-zone":       [RateLimit("ip", 60, 60)],
+}
+
+
+class MemoryBuckets:
+    """
+    Per-process buckets; each instance enforces the limits on its own. A
+    bucket untouched for max_period (the longest limit's period) is full again
+    and is dropped once there are more than max_keys; while more than that are
+    live, the next sweep waits until their number has doubled.
+    """
+
+    def __init__(self, clock=time.monotonic,
+                 max_period: float = max(limit.period for limits in RATE_LIMITS.values() for limit in limits),
+                 max_keys: int = 100_000):
+        self.clock = clock
+        self.max_period = max_period
+        self.max_keys = max_keys
+        self._prune_at = max_keys
+        self._buckets: dict[str, tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, limit: RateLimit) -> float:
+        """Spend one token; returns 0 if allowed, else seconds until one is available."""
+        now = self.clock()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (limit.capacity, now))
+            tokens = min(limit.capacity, tokens + (now - updated) * limit.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                return (1 - tokens) / limit.rate
+            self._buckets[key] = (tokens - 1, now)
+            if len(self._buckets) > self._prune_at:
+                self._prune(now)
+            return 0.0
+
+    def _prune(self, now: float):
+        stale = [k for k, (_, updated) in self._buckets.items() if now - updated > self.max_period]
+        for k in stale:
+            del self._buckets[k]
+        self._prune_at = max(self.max_keys, 2 * len(self._buckets))
+
+
+class PostgresBuckets:
+    """
+    Buckets in the rate_limit_buckets table, shared by every instance. One
+    statement refills and spends atomically, timed by the database clock.
+    After a connection failure, take() fails fast for DB_RETRY_SECONDS
+    instead of waiting out a connect timeout per request.
+    """
+
+    TAKE_SQL = """
+        WITH now AS (SELECT extract(epoch FROM clock_timestamp()) AS t)
+        INSERT INTO rate_limit_buckets AS b (key, tokens, updated_at)
+        SELECT %(key)s, %(cap)s - 1, now.t FROM now
+        ON CONFLICT (key) DO UPDATE SET
+            tokens     = LEAST(%(cap)s, b.tokens + (EXCLUDED.updated_at - b.updated_at) * %(rate)s) - 1,
+            updated_at = EXCLUDED.updated_at
+        WHERE LEAST(%(cap)s, b.tokens + (EXCLUDED.updated_at - b.updated_at) * %(rate)s) >= 1
+        RETURNING tokens
+    """
+
+    def __init__(self, url: str, retry_seconds: float = DB_RETRY_SECONDS):
+        self.url = url
+        self.breaker = CircuitBreaker(threshold=1, reset_seconds=retry_seconds)
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _cursor(self):
+        if self._conn is None or self._conn.closed:
+            self._conn = psycopg2.connect(self.url, connect_timeout=2)
+            self._conn.autocommit = True
+        return self._conn.cursor()
+
+    def take(self, key: str, limit: RateLimit) -> float:
+        with self._lock:
+            if not self.breaker.allow():
+                raise psycopg2.OperationalError("rate-limit database unreachable; not retrying yet")
+            try:
+                with self._cursor() as cur:
+                    cur.execute(self.TAKE_SQL, {"key": key, "cap": limit.capacity, "rate": limit.rate})
+                    if cur.fetchone() is not None:
+                        wait = 0.0
+                    else:
+                        cur.execute("""
+                            SELECT tokens + (extract(epoch FROM clock_timestamp()) - updated_at) * %s
+                            FROM rate_limit_buckets WHERE key = %s
+                        """, (limit.rate, key))
+                        row = cur.fetchone()
+                        wait = (1 - (row[0] if row else 0.0)) / limit.rate
+            except psycopg2.Error:
+                if self._conn is not None:
+                    self._conn.close()
+                self.breaker.record_failure()
+                raise
+            except BaseException:
+                self.breaker.release()
+                raise
+            self.breaker.record_success()
+            return wait
+
+
+class RateLimiter:
+    """
+    Checks RATE_LIMITS for an endpoint by client IP and submitted email.
+    Used as a dependency declared ahead of get_db, so a throttled request is
+    turned away with 429 before a connection is opened or bcrypt runs. If the
+    backend itself fails the request is let through (and counted as an error).
+    Backends other than MemoryBuckets block on I/O, so they are checked in a
+    thread rather than on the event loop.
+    """
+
+    def __init__(self, backend, limits=RATE_LIMITS):
+        self.backend = backend
+        self.limits = limits
+        self.counters: dict[tuple[str, str, str], int] = {}
+        self._lock = threading.Lock()
+
+    def _count(self, endpoint: str, scope: str, outcome: str):
+        with self._lock:
+            key = (endpoint, scope, outcome)
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def check(self, endpoint: str, ip: str, email: str | None):
+        if self.backend is None:
+            return
+        for limit in self.limits.get(endpoint, []):
+            subject = ip if limit.scope == "ip" else (email or "").strip().lower()
+            if not subject:
+                continue
+            try:
+                wait = self.backend.take(f"{endpoint}:{limit.scope}:{subject}", limit)
+            except psycopg2.Error:
+                self._count(endpoint, limit.scope, "error")
+                continue
+            if wait:
+                self._count(endpoint, limit.scope, "limited")
+                raise HTTPException(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail="Too many attempts — try again shortly",
+                    headers={"Retry-After": str(max(1, round(wait)))},
+                )
+            self._count(endpoint, limit.scope, "allowed")
+
+    def reset(self):
+        if isinstance(self.backend, MemoryBuckets):
+            self.backend = MemoryBuckets(self.backend.clock, self.backend.max_period, self.backend.max_keys)
+        with self._lock:
+            self.counters.clear()
+
+    def __call__(self, endpoint: str):
+        async def dependency(request: Request):
+            try:
+                body = await request.json()
+            except ValueError:
+                body = None
+            email = body.get("email") if isinstance(body, dict) else None
+            args = (endpoint, client_ip(request), email if isinstance(email, str) else None)
+            if self.backend is None or isinstance(self.backend, MemoryBuckets):
+                self.check(*args)
+            else:
+                await anyio.to_thread.run_sync(self.check, *args)
+        return Depends(dependency)
+
+
+def client_ip(request: Request) -> str:
+    # Fly's proxy sets Fly-Client-IP (overwriting any client-supplied value).
+    return request.headers.get("fly-client-ip") or (request.client.host if request.client else "")
+
+
+def _rate_limit_backend(kind: str):
+    if kind == "off":
+        return None
+    if kind == "postgres":
+        return PostgresBuckets(DATABASE_URL)
+    return MemoryBuckets()
+
+
+rate_limiter = RateLimiter(_rate_limit_backend(RATE_LIMIT_BACKEND))
+
+
+@app.get("/metrics")
+def metrics(request: Request):
+    """Prometheus text counters; disabled unless METRICS_TOKEN is set."""
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404)
+    if not secrets.compare_digest(request.headers.get("authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401)
+    lines = ["# TYPE rate_limit_checks_total counter"]
+    for (endpoint, scope, outcome), n in sorted(rate_limiter.counters.items()):
+        lines.append(f'rate_limit_checks_total{{endpoint="{endpoint}",scope="{scope}",outcome="{outcome}"}} {n}')
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
+# ── Profiling ────────────────────────────────────────────────────────────────
+# Admin-only and off unless PROFILING_TOKEN is set. Each call profiles the
+# worker process that serves it (X-Profile-Pid says which).
+PROFILE_MAX_SECONDS = 60
+memory_profiler = MemoryProfiler()
+app.add_middleware(AllocationLogMiddleware, memory=memory_profiler)
+_cpu_profile_lock = threading.Lock()
+_cpu_profile_thread = anyio.CapacityLimiter(1)  # so a profile never takes a request thread
+
+
+def require_profiling_token(request: Request):
+    if not PROFILING_TOKEN:
+        raise HTTPException(status_code=404)
+    if not secrets.compare_digest(request.headers.get("authorization", ""), f"Bearer {PROFILING_TOKEN}"):
+        raise HTTPException(status_code=401)
+
+
+def _pid_header() -> dict:
+    return {"X-Profile-Pid": str(os.getpid())}
+
+
+@app.post("/admin/profile/cpu")
+async def profile_cpu(
+    _admin: Annotated[None, Depends(require_profiling_token)],
+    seconds: float = 10,
+    interval_ms: float = 10,
+    idle: bool = False,
+):
+    """Sample every thread's stack for `seconds`; folded stacks for flamegraph.pl or speedscope."""
+    if not 0 < seconds <= PROFILE_MAX_SECONDS or interval_ms < 1:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {PROFILE_MAX_SECONDS}], interval_ms >= 1")
+    if not _cpu_profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    try:
+        stacks = await anyio.to_thread.run_sync(sample, seconds, interval_ms / 1000, idle,
+                                                limiter=_cpu_profile_thread)
+    finally:
+        _cpu_profile_lock.release()
+    return Response(folded(stacks), media_type="text/plain", headers=_pid_header())
+
+
+@app.get("/admin/profile/memory")
+def profile_memory_status(_admin: Annotated[None, Depends(require_profiling_token)]):
+    return memory_profiler.status()
+
+
+@app.post("/admin/profile/memory/start")
+def profile_memory_start(
+    _admin: Annotated[None, Depends(require_profiling_token)],
+    frames: int = 10,
+    log_over_kib: float = 0,
+):
+    """Start tracemalloc; with log_over_kib, also log requests whose allocations peak above it."""
+    if not 1 <= frames <= 100 or log_over_kib < 0:
+        raise HTTPException(status_code=400, detail="frames must be 1-100, log_over_kib >= 0")
+    memory_profiler.start(frames, log_over_kib)
+    return memory_profiler.status()
+
+
+@app.post("/admin/profile/memory/snapshot")
+def profile_memory_snapshot(_admin: Annotated[None, Depends(require_profiling_token)], limit: int = 25):
+    """Take the baseline for /diff and list its largest allocation sites."""
+    try:
+        return JSONResponse({"top": memory_profiler.snapshot(limit)}, headers=_pid_header())
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@app.get("/admin/profile/memory/diff")
+def profile_memory_diff(_admin: Annotated[None, Depends(require_profiling_token)], limit: int = 25):
+    try:
+        return JSONResponse({"diff": memory_profiler.diff(limit)}, headers=_pid_header())
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@app.post("/admin/profile/memory/stop")
+def profile_memory_stop(_admin: Annotated[None, Depends(require_profiling_token)]):
+    memory_profiler.stop()
+    return memory_profiler.status()
+
+
+class AuthRequest(BaseModel):
+    email: str
+    password: str
+
+
+class GoogleAuthRequest(BaseModel):
+    credential: str
+
+
+class ForgotPasswordRequest(BaseModel):
+    email: str
+
+
+class ResetPasswordRequest(BaseModel):
+    token: str
+    password: str
+
+
+@app.get("/auth/google/client-id")
+def google_client_id_endpoint():
+    return {"client_id": GOOGLE_CLIENT_ID}
+
+
+@app.post("/auth/google")
+def google_auth(
+    req: GoogleAuthRequest,
+    _limit: Annotated[None, rate_limiter("google")],
+    db=Depends(get_db),
+):
+    from google.oauth2 import id_token
+    from google.auth.transport import requests as grequests
+    if not GOOGLE_CLIENT_ID:
+        raise HTTPException(status_code=501, detail="Google auth not configured")
+    try:
+        idinfo = id_token.verify_oauth2_token(req.credential, grequests.Request(), GOOGLE_CLIENT_ID)
+    except ValueError:
+        raise HTTPException(status_code=401, detail="Invalid Google token")
+    email = normalize_email(idinfo["email"])
+    # Sign in or sign up in one statement; the SELECT arm sees only rows that
+    # existed before it, so at most one arm answers. Neither does when a
+    # concurrent first sign-in inserted the row after this statement's
+    # snapshot: the INSERT waits for it and skips, so look again in a new
+    # statement, which sees the committed row.
+    db.execute("""
+        WITH created AS (
+            INSERT INTO users (email, password_hash) VALUES (%s, NULL)
+            ON CONFLICT DO NOTHING
+            RETURNING id
+        )
+        SELECT id, TRUE AS created FROM created
+        UNION ALL
+        SELECT id, FALSE FROM users WHERE lower(email) = %s
+        LIMIT 1
+    """, (email, email))
+    row = db.fetchone()
+    if row is None:
+        db.execute("SELECT id, FALSE AS created FROM users WHERE lower(email) = %s", (email,))
+        row = db.fetchone()
+    if row["created"]:
+        shard_map.place(db, row["id"], email)
+    return {"token": make_token(row["id"])}
+
+
+@app.post("/auth/signup")
+def signup(
+    req: AuthRequest,
+    _limit: Annotated[None, rate_limiter("signup")],
+    db: Annotated[psycopg2.extensions.cursor, Depends(get_db)],
+):
+    # Claim the email first: a taken one costs one statement and no bcrypt.
+    # The row stays uncommitted (and a concurrent signup for it waits) until
+    # the hash is written.
+    email = normalize_email(req.email)
+    db.execute(
+        "INSERT INTO users (email, password_hash) VALUES (%s, NULL) ON CONFLICT DO NOTHING RETURNING id",
+        (email,),
+    )
+    row = db.fetchone()
+    if not row:
+        raise HTTPException(status_code=409, detail="Email already registered")
+    db.execute("UPDATE users SET password_hash = %s WHERE id = %s", (hash_password(req.password), row["id"]))
+    shard_map.place(db, row["id"], email)
+    return {"token": make_token(row["id"])}
+
+
+@app.post("/auth/login")
+def login(
+    req: AuthRequest,
+    _limit: Annotated[None, rate_limiter("login")],
+    db: Annotated[psycopg2.extensions.cursor, Depends(get_db)],
+):
+    db.execute("SELECT id, password_hash FROM users WHERE lower(email) = %s", (normalize_email(req.email),))
+    row = db.fetchone()
+    if not row or not row["password_hash"] or not verify_password(req.password, row["password_hash"]):
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    return {"token": make_token(row["id"])}
+
+
+@app.post("/auth/forgot-password")
+async def forgot_password(
+    req: ForgotPasswordRequest,
+    _limit: Annotated[None, rate_limiter("forgot-password")],
+    db=Depends(get_db),
+):
+    db.execute("SELECT id, email FROM users WHERE lower(email) = %s", (normalize_email(req.email),))
+    row = db.fetchone()
+    if row:
+        token = secrets.token_urlsafe(32)
+        expires_at = datetime.now(timezone.utc) + timedelta(minutes=RESET_EXPIRE_MINUTES)
+        db.execute(
+            "INSERT INTO password_reset_tokens (token, user_id, expires_at) VALUES (%s, %s, %s)",
+            (token, row["id"], expires_at),
+        )
+        reset_url = f"{APP_URL}/?token={token}"
+        async with httpx.AsyncClient() as client:
+            await client.post(
+                "https://api.resend.com/emails",
+                headers={"Authorization": f"Bearer {RESEND_API_KEY}", "Content-Type": "application/json"},
+                json={
+                    "from": RESEND_FROM,
+                    "to": [row["email"]],
+                    "subject": "Reset your Doing It password",
+                    "html": f"<p>Reset your Doing It password (expires in 1 hour):</p><p><a href='{reset_url}'>{reset_url}</a></p><p>If you didn't request this, ignore this email.</p>",
+                },
+            )
+    return {"ok": True}
+
+
+@app.post("/auth/reset-password")
+def reset_password(req: ResetPasswordRequest, db=Depends(get_db)):
+    db.execute(
+        "SELECT user_id, expires_at, used FROM password_reset_tokens WHERE token = %s",
+        (req.token,),
+    )
+    row = db.fetchone()
+    if not row or row["used"] or row["expires_at"] < datetime.now(timezone.utc):
+        raise HTTPException(status_code=400, detail="Invalid or expired token")
+    if len(req.password) < 8:
+        raise HTTPException(status_code=400, detail="Password must be at least 8 characters")
+    db.execute("UPDATE users SET password_hash = %s WHERE id = %s", (hash_password(req.password), row["user_id"]))
+    db.execute("UPDATE password_reset_tokens SET used = TRUE WHERE token = %s", (req.token,))
+    return {"ok": True}
+
+
+ARCHIVED_SESSIONS_SQL = """
+    SELECT a.task_id, a.user_id, x.start_ts, x.end_ts
+    FROM sessions_archive a, unnest(a.starts, a.ends) AS x(start_ts, end_ts)
+    WHERE a.user_id = %s
+"""
+
+
+def archive_horizon(db) -> int:
+    """Sessions starting before this ms timestamp live in sessions_archive (0 = nothing archived)."""
+    db.execute("SELECT value FROM app_state WHERE key = 'sessions_archived_before'")
+    row = db.fetchone()
+    return int(row["value"]) if row else 0
+
+
+# ── /data wire formats ───────────────────────────────────────────────────────
+# GET and POST /data speak the row document by default: {"tasks": [{"id",
+# "name", "sessions": [{"start", "end"}]}], "later": [...]}. Clients that send
+# or accept COLUMNAR_TYPE get the same document with each task's sessions as
+# two integer columns instead: "starts" holds the first start and then the
+# difference from the previous start, "lengths" holds end - start (null while
+# running). Bodies may be gzipped in either direction.
+COLUMNAR_TYPE = "application/vnd.doingit.columnar+json"
+DATA_MAX_BYTES = 32 * 1024 * 1024  # a decompressed POST /data body
+GZIP_MIN_BYTES = 1024
+
+
+def to_columnar(doc: dict) -> dict:
+    tasks = []
+    for task in doc["tasks"]:
+        starts, lengths, prev = [], [], 0
+        for s in task["sessions"]:
+            starts.append(s["start"] - prev)
+            lengths.append(None if s.get("end") is None else s["end"] - s["start"])
+            prev = s["start"]
+        tasks.append({"id": task["id"], "name": task["name"], "starts": starts, "lengths": lengths})
+    return {"tasks": tasks, "later": doc["later"]}
+
+
+def from_columnar(doc: dict) -> dict:
+    if not isinstance(doc, dict):
+        raise ValueError("columnar document must be an object")
+    tasks = []
+    for task in doc.get("tasks", []):
+        if not isinstance(task, dict):
+            raise ValueError("columnar tasks must be objects")
+        starts, lengths = task.get("starts", []), task.get("lengths", [])
+        if len(starts) != len(lengths):
+            raise ValueError(f"task {task['id']}: starts and lengths differ in length")
+        sessions, start = [], 0
+        for delta, length in zip(starts, lengths):
+            start += delta
+            sessions.append({"start": start, "end": None if length is None else start + length})
+        tasks.append({"id": task["id"], "name": task["name"], "sessions": sessions})
+    return {"tasks": tasks, "later": doc.get("later", [])}
+
+
+def _gunzip(body: bytes) -> bytes:
+    inflate = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)  # gzip framing only
+    try:
+        out = inflate.decompress(body, DATA_MAX_BYTES)
+    except zlib.error:
+        raise HTTPException(status_code=400, detail="Invalid gzip body")
+    if inflate.unconsumed_tail:
+        raise HTTPException(status_code=413, detail="Data document too large")
+    return out
+
+
+def decode_data_body(body: bytes, headers) -> tuple[dict, str]:
+    """
+    The row document posted to /data, and its JSON text for the user_data
+    blob (the body itself when it was plain JSON, so the common case never
+    re-serializes).
+    """
+    encoding = headers.get("content-encoding", "identity").strip().lower()
+    if encoding == "gzip":
+        body = _gunzip(body)
+    elif encoding != "identity":
+        raise HTTPException(status_code=415, detail="Content-Encoding must be gzip or identity")
+    columnar = headers.get("content-type", "").split(";")[0].strip() == COLUMNAR_TYPE
+    try:
+        payload = json.loads(body)
+        if columnar:
+            payload = from_columnar(payload)
+        elif not isinstance(payload, dict):
+            raise ValueError("data document must be an object")
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid data document")
+    blob = json.dumps(payload, separators=(",", ":")) if columnar else body.decode()
+    return payload, blob
+
+
+def data_response(doc: dict, request: Request) -> Response:
+    """doc in the format the client accepts, gzipped when it is worth it and accepted."""
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if COLUMNAR_TYPE in request.headers.get("accept", ""):
+        media_type, doc = COLUMNAR_TYPE, to_columnar(doc)
+    else:
+        media_type = "application/json"
+    body = json.dumps(doc, ensure_ascii=False, separators=(",", ":")).encode()
+    if len(body) >= GZIP_MIN_BYTES and "gzip" in request.headers.get("accept-encoding", ""):
+        body = gzip.compress(body, compresslevel=6, mtime=0)
+        headers["Content-Encoding"] = "gzip"
+    return Response(body, media_type=media_type, headers=headers)
+
+
+def load_data(db, user_id: int, history: str = "recent") -> dict:
+    """The body of GET /data; also embedded in the index page by index_response."""
+    # Default reads only the hot sessions table; history=full adds archived months.
+    sessions_sql = "SELECT task_id, user_id, start_ts, end_ts FROM sessions WHERE user_id = %s"
+    params = [user_id]
+    if history == "full":
+        sessions_sql += " UNION ALL " + ARCHIVED_SESSIONS_SQL
+        params.append(user_id)
+    db.execute(f"""
+        SELECT
+            t.id,
+            t.name,
+            COALESCE(
+                json_agg(
+                    json_build_object('start', s.start_ts, 'end', s.end_ts)
+                    ORDER BY s.start_ts ASC
+                ) FILTER (WHERE s.start_ts IS NOT NULL),
+                '[]'::json
+            ) AS sessions
+        FROM tasks t
+        LEFT JOIN ({sessions_sql}) s ON s.task_id = t.id AND s.user_id = t.user_id
+        WHERE t.user_id = %s
+        GROUP BY t.id, t.name, t.last_started_at
+        ORDER BY t.last_started_at DESC NULLS LAST
+    """, (*params, user_id))
+    tasks = [
+        {"id": r["id"], "name": r["name"], "sessions": r["sessions"] or []}
+        for r in db.fetchall()
+    ]
+
+    db.execute(
+        "SELECT id, text FROM later_items WHERE user_id = %s ORDER BY position",
+        (user_id,),
+    )
+    later = [{"id": r["id"], "text": r["text"]} for r in db.fetchall()]
+    return {"tasks": tasks, "later": later}
+
+
+# ── Degraded mode ────────────────────────────────────────────────────────────
+# While the user's database is unreachable (degraded.py), GET /data answers
+# from a local snapshot of their document and POST /data journals the save to
+# disk for journal_replay_loop. Every other endpoint answers 503, as does
+# POST /data when no journal is configured.
+snapshots = SnapshotCache(SNAPSHOT_DIR, int(SNAPSHOT_MAX_MB * 1024 * 1024))
+journal = WriteJournal(JOURNAL_DIR, int(JOURNAL_MAX_MB * 1024 * 1024)) if JOURNAL_DIR else None
+DB_UNAVAILABLE = "The database is unreachable right now; try again shortly"
+
+
+@app.exception_handler(DatabaseUnavailable)
+async def database_unavailable(request: Request, exc: DatabaseUnavailable):
+    if request.method == "GET" and request.url.path in ("/", "/billing/success"):
+        return index_response(None, None, None)  # without the bootstrap; load() asks /data
+    return JSONResponse({"detail": DB_UNAVAILABLE}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        headers={"Retry-After": str(max(1, round(DB_RETRY_SECONDS)))})
+
+
+def snapshot_response(user_id: int, request: Request) -> Response:
+    """GET /data without the database: the journaled save, else the snapshot."""
+    doc = (journal and journal.get(user_id)) or snapshots.get(user_id)
+    if doc is None:
+        raise DatabaseUnavailable(f"no snapshot of user {user_id}")
+    payload, _ = decode_data_body(doc.body, doc.headers)
+    response = data_response(payload, request)
+    response.headers["Cache-Control"] = "no-store"
+    response.headers["X-Snapshot-Saved-At"] = str(int(doc.saved_at * 1000))
+    return response
+
+
+def data_version(db, user_id: int) -> str | None:
+    """user_data.updated_at as snapshots and the journal record it; None before the first save."""
+    db.execute("SELECT updated_at FROM user_data WHERE user_id = %s", (user_id,))
+    row = db.fetchone()
+    return row["updated_at"].isoformat() if row else None
+
+
+def check_data_document(payload: dict):
+    """
+    The fields save_data reads, so a journaled save that was answered 202
+    cannot fail on replay. Raises ValueError naming the first one missing.
+    """
+    for task in _list_field(payload, "tasks"):
+        _require(task, "task", "id", "name")
+        for s in _list_field(task, "sessions"):
+            _require(s, "session", "start")
+            if not isinstance(s["start"], (int, float)) or not isinstance(s.get("end"), (int, float, type(None))):
+                raise ValueError(f"task {task['id']}: session times must be numbers")
+    for item in _list_field(payload, "later"):
+        _require(item, "later item", "id", "text")
+
+
+def _list_field(obj: dict, name: str) -> list:
+    value = obj.get(name, [])
+    if not isinstance(value, list):
+        raise ValueError(f"{name} must be a list")
+    return value
+
+
+def _require(obj, kind: str, *fields: str):
+    if not isinstance(obj, dict) or any(f not in obj for f in fields):
+        raise ValueError(f"each {kind} needs {', '.join(fields)}")
+
+
+def journal_data(user_id: int, body: bytes, headers):
+    """
+    POST /data without the database: decoded and checked for the fields
+    save_data reads (see check_data_document), then journaled over the
+    version this machine last saw. Without a journal, or without a snapshot
+    to tell which version the save was made over, it is refused.
+    """
+    payload, _ = decode_data_body(body, headers)
+    try:
+        check_data_document(payload)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid data document: {e}")
+    if journal is None:
+        raise DatabaseUnavailable("no journal configured (JOURNAL_DIR)")
+    base = journal.header(user_id) or snapshots.header(user_id)
+    if base is None:
+        raise DatabaseUnavailable(f"no snapshot of user {user_id}")
+    try:
+        journal.put(user_id, body, headers, version=base["version"])
+    except JournalFull as e:
+        raise DatabaseUnavailable(str(e)) from e
+
+
+def remember_data(user_id: int, body: bytes, headers, version: str):
+    """After a save: it is the user's snapshot now, and any journaled one is superseded."""
+    snapshots.put(user_id, body, headers, version=version)
+    if journal is not None:
+        journal.discard(user_id)
+
+
+def replay_saved_data(db, user_id: int, doc: Document) -> str | None:
+    """
+    Apply a journaled save if the database still holds the version it was
+    made over; a save since then, here or on another machine, wins. Returns
+    the new version, or None if the save was dropped.
+    """
+    db.execute("SELECT updated_at FROM user_data WHERE user_id = %s FOR UPDATE", (user_id,))
+    row = db.fetchone()
+    current = row["updated_at"] if row else None
+    if current is not None and (doc.version is None or current > datetime.fromisoformat(doc.version)):
+        print(f"[journal] user {user_id}: saved elsewhere since {doc.version}; journaled save dropped")
+        return None
+    return save_data(db, user_id, doc.body, doc.headers)
+
+
+def _replay_journaled(user_id: int, doc: Document):
+    conn = connect_home(user_id, write=True)
+    try:
+        with conn.cursor() as cur:
+            version = replay_saved_data(cur, user_id, doc)
+        conn.commit()
+    finally:
+        conn.close()
+    if version is not None:
+        snapshots.put(user_id, doc.body, doc.headers, doc.saved_at, version)
+
+
+def journal_replay_loop(check_every: float = DB_RETRY_SECONDS):
+    """
+    Replays journaled saves once their databases answer again. Every worker
+    runs one; the journal hands each entry to only one of them.
+    """
+    while True:
+        time.sleep(check_every)
+        try:
+            if not journal.pending():
+                continue
+            replayed = journal.replay(_replay_journaled, transient=(psycopg2.OperationalError, HTTPException))
+        except (psycopg2.OperationalError, HTTPException):
+            continue  # still down (or the user is being moved); the entry waits
+        except Exception as e:
+            print(f"[journal] replay failed: {e}")
+            continue
+        if replayed:
+            print(f"[journal] replayed {replayed} saves, {journal.pending()} left")
+
+
+def _data_response(db, user_id: int, history: str, request: Request) -> Response:
+    # The version is read first: should a save land in between, the snapshot
+    # is labelled older than its body, and a journaled save over it is
+    # dropped rather than replayed over the newer data.
+    version = data_version(db, user_id) if history == "recent" else None
+    response = data_response(load_data(db, user_id, history), request)
+    if history == "recent":
+        held = snapshots.header(user_id)
+        if held is None or held["version"] != version:
+            snapshots.put(user_id, response.body, response.headers, version=version)
+    return response
+
+
+@app.get("/data")
+async def get_data(
+    request: Request,
+    user_id: Annotated[int, Depends(current_user_id)],
+    run_read=Depends(get_home_read_runner),
+    history: str = "recent",
+):
+    try:
+        return await run_read(user_id, _data_response, user_id, history, request)
+    except DatabaseUnavailable:
+        if history != "recent":
+            raise  # snapshots hold the recent document only
+        return await anyio.to_thread.run_sync(snapshot_response, user_id, request)
+
+
+@app.get("/tasks")
+def get_tasks(
+    user_id: Annotated[int, Depends(current_user_id)],
+    db: Annotated[psycopg2.extensions.cursor, Depends(get_user_read_db)],
+):
+    """Task list with activity summaries, served from tasks alone (no sessions scan)."""
+    db.execute("""
+        SELECT id, name, last_started_at, total_ms, session_count
+        FROM tasks
+        WHERE user_id = %s
+        ORDER BY last_started_at DESC NULLS LAST
+    """, (user_id,))
+    return {"tasks": db.fetchall()}
+
+
+SEARCH_LIMIT_MAX = 100
+
+
+def like_pattern(text: str) -> str:
+    """Escape LIKE wildcards so user input only ever matches literally."""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+@app.get("/search")
+def search(
+    user_id: Annotated[int, Depends(current_user_id)],
+    db: Annotated[psycopg2.extensions.cursor, Depends(get_user_read_db)],
+    q: str = "",
+    limit: int = 20,
+):
+    """
+    Case-insensitive substring search over task names and later items, the
+    same matching the search box does client-side. Names starting with the
+    query rank first, then the most recently worked-on tasks; an empty query
+    returns the most recent tasks.
+    """
+    limit = max(1, min(limit, SEARCH_LIMIT_MAX))
+    needle = like_pattern(q.strip())
+    params = {"uid": user_id, "contains": f"%{needle}%", "prefix": f"{needle}%", "limit": limit}
+    db.execute("""
+        SELECT id, name, last_started_at, total_ms, session_count
+        FROM tasks
+        WHERE user_id = %(uid)s AND name ILIKE %(contains)s
+        ORDER BY name ILIKE %(prefix)s DESC, last_started_at DESC NULLS LAST, name
+        LIMIT %(limit)s
+    """, params)
+    tasks = db.fetchall()
+    db.execute("""
+        SELECT id, text
+        FROM later_items
+        WHERE user_id = %(uid)s AND text ILIKE %(contains)s
+        ORDER BY text ILIKE %(prefix)s DESC, position
+        LIMIT %(limit)s
+    """, params)
+    return {"tasks": tasks, "later": db.fetchall()}
+
+
+@app.get("/stats/daily")
+def daily_stats(
+    user_id: Annotated[int, Depends(current_user_id)],
+    db: Annotated[psycopg2.extensions.cursor, Depends(get_user_read_db)],
+    since: date | None = None,
+    until: date | None = None,
+):
+    """Per-day, per-task totals from daily_task_totals; days are in the user's time zone."""
+    db.execute("""
+        SELECT day, task_id, total_ms, session_count
+        FROM daily_task_totals
+        WHERE user_id = %s
+          AND (%s::date IS NULL OR day >= %s::date)
+          AND (%s::date IS NULL OR day <= %s::date)
+        ORDER BY day, task_id
+    """, (user_id, since, since, until, until))
+    return {"days": [{**row, "day": row["day"].isoformat()} for row in db.fetchall()]}
+
+
+class TimeZoneRequest(BaseModel):
+    time_zone: str
+
+
+TIME_ZONE_CHANGE_MINUTES = 60
+
+
+@app.post("/settings/time-zone")
+def set_time_zone(
+    req: TimeZoneRequest,
+    user_id: Annotated[int, Depends(current_user_id)],
+    _limit: Annotated[None, rate_limiter("time-zone")],
+    db: Annotated[psycopg2.extensions.cursor, Depends(get_db)],
+    home: Annotated[psycopg2.extensions.cursor, Depends(get_home_db)],
+):
+    """
+    Set the zone daily totals use; re-buckets the user's rollup. A change
+    within TIME_ZONE_CHANGE_MINUTES of the last one gets 429, which bounds the
+    rebuilds. The first zone set also becomes the free-tier day's for good,
+    so switching zones never re-opens a day's quota.
+    """
+    db.execute("SELECT 1 FROM pg_timezone_names WHERE name = %s", (req.time_zone,))
+    if db.fetchone() is None:
+        raise HTTPException(status_code=400, detail="Unknown time zone")
+    db.execute("""
+        SELECT time_zone, quota_time_zone,
+               extract(epoch FROM time_zone_changed_at + make_interval(mins => %s) - NOW()) AS wait
+        FROM users WHERE id = %s
+    """, (TIME_ZONE_CHANGE_MINUTES, user_id))
+    user = db.fetchone()
+    if user is None:
+        raise HTTPException(status_code=404)
+    if user["time_zone"] == req.time_zone:
+        if user["quota_time_zone"] is None:
+            db.execute("UPDATE users SET quota_time_zone = %s WHERE id = %s", (req.time_zone, user_id))
+        return {"ok": True}
+    if user["wait"] is not None and user["wait"] > 0:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="The time zone was changed recently — try again later",
+            headers={"Retry-After": str(max(1, round(user["wait"])))},
+        )
+    db.execute("""
+        UPDATE users SET time_zone = %(tz)s, time_zone_changed_at = NOW(),
+                         quota_time_zone = COALESCE(quota_time_zone, %(tz)s)
+        WHERE id = %(uid)s
+    """, {"tz": req.time_zone, "uid": user_id})
+    if home is not db:
+        home.execute("UPDATE users SET time_zone = %s WHERE id = %s", (req.time_zone, user_id))  # the shard's copy
+    rebuild_daily_totals(home, [user_id])
+    replicas.pin(user_id)
+    return {"ok": True}
+
+
+# ── Weekly digest ────────────────────────────────────────────────────────────
+# The emails are sent by `maintenance.py digest` (digest.py), outside the web
+# workers; here users opt in and out.
+class DigestRequest(BaseModel):
+    enabled: bool
 
 
-def get_db():
-    conn = psycopg2.connect(DATABASE_URL, cursor_factory=psycopg2.extras.RealDictCursor)
-    try:
-        cur = conn.cursor()
-        yield cur
-        conn.commit()
-    finally:
-        conn.close()
+@app.post("/settings/digest")
+def set_digest(
+    req: DigestRequest,
+    user_id: Annotated[int, Depends(current_user_id)],
+    db: Annotated[psycopg2.extensions.cursor, Depends(get_db)],
+):
+    db.execute("UPDATE users SET weekly_digest = %s WHERE id = %s", (req.enabled, user_id))
+    return {"weekly_digest": req.enabled}
 
 
-def current_user_id(
-    credentials: Annotated[HTTPAuthorizationCredentials, Depends(bearer)],
-) -> int:
-    try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
-        return int(user_id)
-    except JWTError:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+def check_unsubscribe_sig(user: int, sig: str):
+    if not hmac.compare_digest(sig, unsubscribe_sig(SECRET_KEY, user)):
+        raise HTTPException(status_code=404)
 
 
-def make_token(user_id: int) -> str:
-    expire = datetime.now(timezone.utc) + timedelta(days=TOKEN_EXPIRE_DAYS)
-    return jwt.encode({"sub": str(user_id), "exp": expire}, SECRET_KEY, algorithm=ALGORITHM)
+@app.get("/digest/unsubscribe")
+def digest_unsubscribe_page(user: int, sig: str):
+    """The link in the email: a button, so link scanners that follow it unsubscribe no one."""
+    check_unsubscribe_sig(user, sig)
+    return HTMLResponse(
+        f"<!doctype html><title>Doing It</title><form method='post' action='?user={user}&amp;sig={sig}'>"
+        "<p>Stop the weekly summary emails?</p><button>Unsubscribe</button></form>"
+    )
 
 
-class AuthRequest(BaseModel):
-    email: str
-    password: str
+@app.post("/digest/unsubscribe")
+def digest_unsubscribe(user: int, sig: str, db=Depends(get_db)):
+    """The button above, and one-click unsubscribe (RFC 8058) from the List-Unsubscribe header."""
+    check_unsubscribe_sig(user, sig)
+    db.execute("UPDATE users SET weekly_digest = FALSE WHERE id = %s", (user,))
+    return HTMLResponse("<!doctype html><title>Doing It</title><p>You won't get weekly summaries anymore.</p>")
 
 
-class GoogleAuthRequest(BaseModel):
-    credential: str
+# ── Share cards ──────────────────────────────────────────────────────────────
+card_cache = CardCache(CARD_CACHE_DIR, int(CARD_CACHE_MAX_MB * 1024 * 1024))
+card_renderer = CardRenderer(CARD_WORKERS)
 
 
-class ForgotPasswordRequest(BaseModel):
-    email: str
+def card_owner(db, share_token: str) -> dict | None:
+    """The user sharing under this token, and today's date in their zone; None for unknown tokens."""
+    db.execute(
+        "SELECT id, (NOW() AT TIME ZONE time_zone)::date AS today FROM users WHERE share_token = %s",
+        (share_token,),
+    )
+    return db.fetchone()
 
 
-class ResetPasswordRequest(BaseModel):
-    token: str
-    password: str
+def card_week(db, user_id: int, today: date) -> dict:
+    """The seven days ending today as drawn on the card; read on the user's home shard."""
+    db.execute("""
+        SELECT t.name, SUM(d.total_ms)::bigint AS total_ms
+        FROM daily_task_totals d
+        JOIN tasks t ON t.id = d.task_id AND t.user_id = d.user_id
+        WHERE d.user_id = %s AND d.day > %s::date - 7
+        GROUP BY t.name
+        ORDER BY total_ms DESC, t.name
+    """, (user_id, today))
+    tasks = [{"name": r["name"], "total_ms": int(r["total_ms"])} for r in db.fetchall()]
+    return {
+        "week_start": (today - timedelta(days=6)).isoformat(),
+        "week_end": today.isoformat(),
+        "total_ms": sum(t["total_ms"] for t in tasks),
+        "top": tasks[:TOP_TASKS],
+    }
 
 
-@app.get("/auth/google/client-id")
-def google_client_id_endpoint():
-    return {"client_id": GOOGLE_CLIENT_ID}
+def card_summary(db, share_token: str) -> dict | None:
+    """card_owner and card_week on one database."""
+    owner = card_owner(db, share_token)
+    return None if owner is None else card_week(db, owner["id"], owner["today"])
 
 
-@app.post("/auth/google")
-def google_auth(req: GoogleAuthRequest, db=Depends(get_db)):
-    from google.oauth2 import id_token
-    from google.auth.transport import requests as grequests
-    if not GOOGLE_CLIENT_ID:
-        raise HTTPException(status_code=501, detail="Google auth not configured")
-    try:
-        idinfo = id_token.verify_oauth2_token(req.credential, grequests.Request(), GOOGLE_CLIENT_ID)
-    except ValueError:
-        raise HTTPException(status_code=401, detail="Invalid Google token")
-    email = idinfo["email"]
-    db.execute("SELECT id FROM users WHERE email = %s", (email,))
-    row = db.fetchone()
-    if row:
-        user_id = row["id"]
-    else:
-        db.execute("INSERT INTO users (email, password_hash) VALUES (%s, NULL) RETURNING id", (email,))
-        user_id = db.fetchone()["id"]
-    return {"token": make_token(user_id)}
+@app.post("/share/card")
+def enable_share_card(
+    user_id: Annotated[int, Depends(current_user_id)],
+    db: Annotated[psycopg2.extensions.cursor, Depends(get_db)],
+):
+    """Turn on the public weekly card; the URL stays the same until sharing is turned off."""
+    db.execute(
+        "UPDATE users SET share_token = COALESCE(share_token, %s) WHERE id = %s RETURNING share_token",
+        (secrets.token_urlsafe(12), user_id),
+    )
+    return {"url": f"{APP_URL}/cards/{db.fetchone()['share_token']}.png"}
 
 
-@app.post("/auth/signup")
-def signup(req: AuthRequest, db: Annotated[psycopg2.extensions.cursor, Depends(get_db)]):
-    db.execute("SELECT id FROM users WHERE email = %s", (req.email,))
-    if db.fetchone():
-        raise HTTPException(status_code=409, detail="Email already registered")
-    hashed = hash_password(req.password)
-    db.execute(
-        "INSERT INTO users (email, password_hash) VALUES (%s, %s) RETURNING id",
-        (req.email, hashed),
+@app.delete("/share/card", status_code=204)
+def disable_share_card(
+    user_id: Annotated[int, Depends(current_user_id)],
+    db: Annotated[psycopg2.extensions.cursor, Depends(get_db)],
+):
+    db.execute("UPDATE users SET share_token = NULL WHERE id = %s", (user_id,))
+    return Response(status_code=204)
+
+
+@app.get("/cards/{share_token}.png")
+async def share_card(
+    share_token: str,
+    request: Request,
+    run_db=Depends(get_db_runner),
+    run_home=Depends(get_home_runner),
+):
+    """
+    A user's weekly card. The ETag is the card's content key, so a crawler
+    revalidating an unchanged week gets a 304 without a render, and any
+    worker serves a cached render straight from disk.
+    """
+    owner = await run_db(card_owner, share_token)
+    if owner is None:
+        raise HTTPException(status_code=404)
+    summary = await run_home(owner["id"], card_week, owner["id"], owner["today"])
+    key = card_key(summary)
+    headers = {"ETag": f'"{key}"', "Cache-Control": "public, max-age=300"}
+    if f'"{key}"' in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    path = card_cache.get(key)
+    if path is not None:
+        return FileResponse(path, media_type="image/png", headers=headers)
+    png = await card_renderer.render(summary)
+    await anyio.to_thread.run_sync(card_cache.put, key, png)
+    return Response(png, media_type="image/png", headers=headers)
+
+
+# ── Export ───────────────────────────────────────────────────────────────────
+EXPORT_CHUNK_ROWS = 1000
+EXPORT_MEDIA_TYPES = {
+    "csv":     "text/csv",
+    "ndjson":  "application/x-ndjson",
+    "columns": "application/x-ndjson",
+}
+
+
+def export_rows(conn, user_id: int | None, since_ms: int | None = None, until_ms: int | None = None):
+    """
+    Yield (user_id, task_id, task_name, start_ts, end_ts) ordered by start_ts,
+    hot and archived sessions alike, through a server-side cursor so memory
+    stays flat however long the history. user_id=None dumps every user.
+    """
+    hot, cold, params = ["TRUE"], ["TRUE"], {"uid": user_id, "since": since_ms, "until": until_ms}
+    if user_id is not None:
+        hot.append("user_id = %(uid)s")
+        cold.append("a.user_id = %(uid)s")
+    if since_ms is not None:
+        hot.append("start_ts >= %(since)s")
+        cold.append("x.start_ts >= %(since)s")
+    if until_ms is not None:
+        hot.append("start_ts < %(until)s")
+        cold.append("a.month_start < %(until)s AND x.start_ts < %(until)s")
+    with conn.cursor(name="export", cursor_factory=psycopg2.extensions.cursor) as cur:
+        cur.itersize = EXPORT_CHUNK_ROWS
+        cur.execute(f"""
+            SELECT s.user_id, s.task_id, t.name, s.start_ts, s.end_ts
+            FROM (
+                SELECT user_id, task_id, start_ts, end_ts FROM sessions
+                WHERE {" AND ".join(hot)}
+                UNION ALL
+                SELECT a.user_id, a.task_id, x.start_ts, x.end_ts
+                FROM sessions_archive a, unnest(a.starts, a.ends) AS x(start_ts, end_ts)
+                WHERE {" AND ".join(cold)}
+            ) s
+            JOIN tasks t ON t.id = s.task_id AND t.user_id = s.user_id
+            ORDER BY s.start_ts, s.user_id
+        """, params)
+        yield from cur
+
+
+def _export_csv(rows, with_user: bool):
+    buf = io.StringIO()
+    out = csv.writer(buf)
+    out.writerow((["user_id"] if with_user else []) + ["task_id", "task", "start", "end"])
+    for i, (uid, task_id, name, start, end) in enumerate(rows, 1):
+        out.writerow(([uid] if with_user else []) + [task_id, name, start, "" if end is None else end])
+        if i % EXPORT_CHUNK_ROWS == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def _export_ndjson(rows, with_user: bool):
+    lines = []
+    for uid, task_id, name, start, end in rows:
+        rec = {"task_id": str(task_id), "task": name, "start": start, "end": end}
+        if with_user:
+            rec = {"user_id": uid, **rec}
+        lines.append(json.dumps(rec))
+        if len(lines) == EXPORT_CHUNK_ROWS:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def _export_columns(rows, with_user: bool):
+    """
+    Compact columnar blocks, one JSON object per line. Each block lists task
+    names first seen in it, then parallel arrays: start is delta-encoded
+    against the previous row (the first row of the stream is absolute) and
+    duration is end - start (null while running). Task ids are only unique
+    per user, so with_user lists names as {user_id: {task_id: name}}.
+    """
+    seen: set = set()
+    prev = 0
+
+    def new_block():
+        block = {"tasks": {}, "task_id": [], "start": [], "duration": []}
+        if with_user:
+            block["user_id"] = []
+        return block
+
+    block = new_block()
+    for uid, task_id, name, start, end in rows:
+        task_id = str(task_id)
+        if (uid, task_id) not in seen:
+            seen.add((uid, task_id))
+            names = block["tasks"].setdefault(str(uid), {}) if with_user else block["tasks"]
+            names[task_id] = name
+        if with_user:
+            block["user_id"].append(uid)
+        block["task_id"].append(task_id)
+        block["start"].append(start - prev)
+        block["duration"].append(None if end is None else end - start)
+        prev = start
+        if len(block["start"]) == EXPORT_CHUNK_ROWS:
+            yield json.dumps(block, separators=(",", ":")) + "\n"
+            block = new_block()
+    if block["start"]:
+        yield json.dumps(block, separators=(",", ":")) + "\n"
+
+
+EXPORT_ENCODERS = {"csv": _export_csv, "ndjson": _export_ndjson, "columns": _export_columns}
+
+
+def export_stream(open_conn, fmt: str, user_id: int | None,
+                  since_ms: int | None = None, until_ms: int | None = None):
+    """Encoded export chunks; the connection lives exactly as long as the stream."""
+    with open_conn() as conn:
+        rows = export_rows(conn, user_id, since_ms, until_ms)
+        yield from EXPORT_ENCODERS[fmt](rows, with_user=user_id is None)
+
+
+def utc_day_start_ms(d: date) -> int:
+    return int(datetime(d.year, d.month, d.day, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+@app.get("/export")
+def export(
+    user_id: Annotated[int, Depends(current_user_id)],
+    open_conn=Depends(get_stream_db),
+    format: str = "csv",
+    since: date | None = None,
+    until: date | None = None,
+):
+    """Stream every session (including archived history), optionally limited to [since, until] UTC days."""
+    if format not in EXPORT_ENCODERS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(EXPORT_ENCODERS)}")
+    since_ms = utc_day_start_ms(since) if since else None
+    until_ms = utc_day_start_ms(until + timedelta(days=1)) if until else None
+    ext = "jsonl" if format != "csv" else "csv"
+    return StreamingResponse(
+        export_stream(open_conn, format, user_id, since_ms, until_ms),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="doingit-export.{ext}"'},
     )
-    user_id = db.fetchone()["id"]
-    return {"token": make_token(user_id)}
 
 
-@app.post("/auth/login")
-def login(req: AuthRequest, db: Annotated[psycopg2.extensions.cursor, Depends(get_db)]):
-    db.execute("SELECT id, password_hash FROM users WHERE email = %s", (req.email,))
-    row = db.fetchone()
-    if not row or not verify_password(req.password, row["password_hash"]):
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    return {"token": make_token(row["id"])}
+# ── Import ───────────────────────────────────────────────────────────────────
+IMPORT_MAX_BYTES      = int(os.getenv("IMPORT_MAX_BYTES", str(50 * 1024 * 1024)))
+IMPORT_SPOOL_BYTES    = 4 * 1024 * 1024  # larger uploads spill to a temp file
+IMPORT_PROGRESS_EVERY = 5000
+
+
+def _parse_import_ts(value) -> int | None:
+    """Milliseconds since the epoch, or an ISO-8601 datetime (naive = UTC)."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    text = str(value).strip()
+    if text.lstrip("-").isdigit():
+        return int(text)
+    dt = datetime.fromisoformat(text.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+
+def normalize_import_record(rec) -> tuple[str | None, str, int, int | None]:
+    """(task_id, task name, start, end) from a CSV row dict or an NDJSON line. Raises ValueError."""
+    if isinstance(rec, str):
+        rec = json.loads(rec)
+        if not isinstance(rec, dict):
+            raise ValueError("expected a JSON object")
+    name = str(rec.get("task") or rec.get("name") or "").strip()
+    if not name:
+        raise ValueError("missing task name")
+    start = _parse_import_ts(rec.get("start"))
+    if start is None:
+        raise ValueError("missing start")
+    end = _parse_import_ts(rec.get("end"))
+    if end is not None and end < start:
+        raise ValueError("end before start")
+    task_id = rec.get("task_id")
+    return (str(task_id) if task_id else None), name, start, end
+
+
+def _import_records(upload, fmt: str):
+    text = io.TextIOWrapper(upload, encoding="utf-8-sig", newline="")
+    if fmt == "csv":
+        yield from csv.DictReader(text)
+    else:
+        yield from (line for line in text if line.strip())
 
 
-@app.post("/auth/forgot-password")
-async def forgot_password(req: ForgotPasswordRequest, db=Depends(get_db)):
-    db.execute("SELECT id FROM users WHERE email = %s", (req.email,))
-    row = db.fetchone()
-    if row:
-        token = secrets.token_urlsafe(32)
-        expires_at = datetime.now(timezone.utc) + timedelta(minutes=RESET_EXPIRE_MINUTES)
-        db.execute(
-            "INSERT INTO password_reset_tokens (token, user_id, expires_at) VALUES (%s, %s, %s)",
-            (token, row["id"], expires_at),
+def merge_import(cur, user_id: int, staged) -> dict:
+    """
+    COPY normalized rows into a temp table and merge them in a few set-based
+    statements: resolve missing task ids by name (creating tasks for unknown
+    names), then insert sessions, skipping duplicates within the file, already
+    stored ones (via the (task_id, user_id, start_ts) key) and archived ones.
+    """
+    # CTAS from sessions gives task_id the same type as tasks.id (TEXT or uuid).
+    cur.execute(
+        "CREATE TEMP TABLE _import ON COMMIT DROP AS "
+        "SELECT task_id, ''::text AS task, start_ts, end_ts FROM sessions WITH NO DATA"
+    )
+    cur.copy_expert("COPY _import (task_id, task, start_ts, end_ts) FROM STDIN WITH (FORMAT csv)", staged)
+    cur.execute("""
+        UPDATE _import i SET task_id = t.id FROM tasks t
+        WHERE i.task_id IS NULL AND t.user_id = %s AND t.name = i.task
+    """, (user_id,))
+    cur.execute("""
+        WITH fresh AS (
+            SELECT task, gen_random_uuid() AS id
+            FROM (SELECT DISTINCT task FROM _import WHERE task_id IS NULL) n
         )
-        reset_url = f"{APP_URL}/?token={token}"
-        async with httpx.AsyncClient() as client:
-            await client.post(
-                "https://api.resend.com/emails",
-                headers={"Authorization": f"Bearer {RESEND_API_KEY}", "Content-Type": "application/json"},
-                json={
-                    "from": RESEND_FROM,
-                    "to": [req.email],
-                    "subject": "Reset your Doing It password",
-                    "html": f"<p>Reset your Doing It password (expires in 1 hour):</p><p><a href='{reset_url}'>{reset_url}</a></p><p>If you didn't request this, ignore this email.</p>",
-                },
-            )
-    return {"ok": True}
+        UPDATE _import i SET task_id = fresh.id FROM fresh
+        WHERE i.task_id IS NULL AND i.task = fresh.task
+    """)
+    cur.execute("""
+        INSERT INTO tasks (id, user_id, name)
+        SELECT DISTINCT ON (task_id) task_id, %s, task FROM _import ORDER BY task_id
+        ON CONFLICT (id, user_id) DO NOTHING
+    """, (user_id,))
+    tasks_created = cur.rowcount
+    cur.execute("""
+        INSERT INTO sessions (task_id, user_id, start_ts, end_ts)
+        SELECT DISTINCT ON (task_id, start_ts) task_id, %(uid)s, start_ts, end_ts
+        FROM _import i
+        WHERE i.start_ts >= %(horizon)s OR NOT EXISTS (
+            SELECT 1 FROM sessions_archive a
+            WHERE a.user_id = %(uid)s AND a.task_id = i.task_id AND i.start_ts = ANY(a.starts)
+        )
+        ORDER BY task_id, start_ts
+        ON CONFLICT (task_id, user_id, start_ts) DO NOTHING
+    """, {"uid": user_id, "horizon": archive_horizon(cur)})
+    inserted = cur.rowcount
+    cur.execute("DROP TABLE _import")
+    return {"rows_inserted": inserted, "tasks_created": tasks_created}
 
 
-@app.post("/auth/reset-password")
-def reset_password(req: ResetPasswordRequest, db=Depends(get_db)):
+def _import_progress(conn, job_id: str, **fields):
+    sets = ", ".join(f"{k} = %s" for k in fields)
+    with conn.cursor() as cur:
+        cur.execute(f"UPDATE import_jobs SET {sets} WHERE id = %s", (*fields.values(), job_id))
+    conn.commit()
+
+
+def run_import(open_conn, job_id: str, user_id: int, fmt: str, upload):
+    """
+    Background half of POST /import. Parses and validates the spooled upload
+    into a normalized CSV (reporting progress as it goes), then merges it in
+    one transaction that also marks the job done. Bad rows are counted and
+    skipped; the first problem is kept in error.
+    """
+    staged = tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_BYTES, mode="w+", newline="")
+    out = csv.writer(staged)
+    parsed = rejected = 0
+    first_error = None
+    with open_conn() as conn:
+        try:
+            _import_progress(conn, job_id, status="parsing")
+            upload.seek(0)
+            for i, rec in enumerate(_import_records(upload, fmt), 1):
+                try:
+                    task_id, name, start, end = normalize_import_record(rec)
+                except (ValueError, TypeError, AttributeError) as e:
+                    rejected += 1
+                    first_error = first_error or f"row {i}: {e}"
+                    continue
+                out.writerow([task_id or "", name, start, "" if end is None else end])
+                parsed += 1
+                if i % IMPORT_PROGRESS_EVERY == 0:
+                    _import_progress(conn, job_id, rows_parsed=parsed, rows_rejected=rejected)
+            _import_progress(conn, job_id, status="merging", rows_parsed=parsed, rows_rejected=rejected)
+
+            staged.seek(0)
+            with conn.cursor() as cur:
+                cur.execute("SAVEPOINT import_merge")
+                try:
+                    counts = merge_import(cur, user_id, staged)
+                except psycopg2.Error as e:
+                    cur.execute("ROLLBACK TO SAVEPOINT import_merge")
+                    _import_progress(conn, job_id, status="failed", error=str(e).strip(),
+                                     finished_at=datetime.now(timezone.utc))
+                    return
+            _import_progress(conn, job_id, status="done", error=first_error,
+                             rows_duplicate=parsed - counts["rows_inserted"],
+                             finished_at=datetime.now(timezone.utc), **counts)
+            replicas.pin(user_id)
+            snapshots.discard(user_id)  # the next GET /data takes a fresh one
+        except (UnicodeDecodeError, csv.Error) as e:
+            _import_progress(conn, job_id, status="failed", error=f"unreadable upload: {e}",
+                             finished_at=datetime.now(timezone.utc))
+        finally:
+            staged.close()
+            upload.close()
+
+
+@app.post("/import", status_code=202)
+async def import_sessions(
+    request: Request,
+    background: BackgroundTasks,
+    user_id: Annotated[int, Depends(current_user_id)],
+    db: Annotated[psycopg2.extensions.cursor, Depends(get_user_db)],
+    open_conn=Depends(get_job_db),
+    format: str | None = None,
+):
+    """
+    Accept a CSV (task_id?, task, start, end) or NDJSON upload as the raw
+    request body and merge it into the user's history in the background.
+    Sessions already stored are left untouched. Poll the returned status_url.
+    """
+    if format is None:
+        format = "ndjson" if "json" in request.headers.get("content-type", "") else "csv"
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be csv or ndjson")
+    upload = tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_BYTES)
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > IMPORT_MAX_BYTES:
+            upload.close()
+            raise HTTPException(status_code=413, detail="Upload too large")
+        upload.write(chunk)
+    job_id = secrets.token_urlsafe(12)
     db.execute(
-        "SELECT user_id, expires_at, used FROM password_reset_tokens WHERE token = %s",
-        (req.token,),
+        "INSERT INTO import_jobs (id, user_id, format, bytes) VALUES (%s, %s, %s, %s)",
+        (job_id, user_id, format, size),
     )
-    row = db.fetchone()
-    if not row or row["used"] or row["expires_at"] < datetime.now(timezone.utc):
-        raise HTTPException(status_code=400, detail="Invalid or expired token")
-    if len(req.password) < 8:
-        raise HTTPException(status_code=400, detail="Password must be at least 8 characters")
-    db.execute("UPDATE users SET password_hash = %s WHERE id = %s", (hash_password(req.password), row["user_id"]))
-    db.execute("UPDATE password_reset_tokens SET used = TRUE WHERE token = %s", (req.token,))
-    return {"ok": True}
+    background.add_task(run_import, open_conn, job_id, user_id, format, upload)
+    return {"job_id": job_id, "status_url": f"/import/{job_id}"}
 
 
-@app.get("/data")
-def get_data(
+@app.get("/import/{job_id}")
+def import_status(
+    job_id: str,
     user_id: Annotated[int, Depends(current_user_id)],
-    db: Annotated[psycopg2.extensions.cursor, Depends(get_db)],
+    db: Annotated[psycopg2.extensions.cursor, Depends(get_user_db)],
 ):
     db.execute("""
-        SELECT
-            t.id,
-            t.name,
-            COALESCE(
-                json_agg(
-                    json_build_object('start', s.start_ts, 'end', s.end_ts)
-                    ORDER BY s.start_ts ASC
-                ) FILTER (WHERE s.id IS NOT NULL),
-                '[]'::json
-            ) AS sessions
-        FROM tasks t
-        LEFT JOIN sessions s ON s.task_id = t.id AND s.user_id = t.user_id
-        WHERE t.user_id = %s
-        GROUP BY t.id, t.name
-        ORDER BY MAX(s.start_ts) DESC NULLS LAST
-    """, (user_id,))
-    tasks = [
-        {"id": r["id"], "name": r["name"], "sessions": r["sessions"] or []}
-        for r in db.fetchall()
-    ]
+        SELECT status, format, bytes, rows_parsed, rows_rejected, rows_inserted,
+               rows_duplicate, tasks_created, error, created_at, finished_at
+        FROM import_jobs WHERE id = %s AND user_id = %s
+    """, (job_id, user_id))
+    row = db.fetchone()
+    if not row:
+        raise HTTPException(status_code=404)
+    return row
 
-    db.execute(
-        "SELECT id, text FROM later_items WHERE user_id = %s ORDER BY position",
-        (user_id,),
-    )
-    later = [{"id": r["id"], "text": r["text"]} for r in db.fetchall()]
 
-    return JSONResponse({"tasks": tasks, "later": later})
+UPSERT_SESSION_SQL = (
+    "INSERT INTO sessions (task_id, user_id, start_ts, end_ts) VALUES (%s, %s, %s, %s) "
+    "ON CONFLICT (task_id, user_id, start_ts) DO UPDATE SET end_ts = EXCLUDED.end_ts "
+    "WHERE sessions.end_ts IS DISTINCT FROM EXCLUDED.end_ts"
+)
 
 
 @app.post("/data", status_code=204)
 async def post_data(
     request: Request,
     user_id: Annotated[int, Depends(current_user_id)],
-    db: Annotated[psycopg2.extensions.cursor, Depends(get_db)],
+    run_home=Depends(get_home_runner),
 ):
     body = await request.body()
-    payload = json.loads(body)
+    # The writes can wait on row locks held by another save for the same user;
+    # waiting on the event loop would stall every request in this worker,
+    # including the one whose commit releases the lock. The runner waits in a thread.
+    try:
+        version = await run_home(user_id, save_data, user_id, body, request.headers)
+    except DatabaseUnavailable:
+        await anyio.to_thread.run_sync(journal_data, user_id, body, request.headers)
+        return Response(status_code=status.HTTP_202_ACCEPTED)
+    await anyio.to_thread.run_sync(remember_data, user_id, body, request.headers, version)
+    return Response(status_code=204)
+
+
+def save_data(db, user_id: int, body: bytes, headers) -> str:
+    """Replace the user's tasks, sessions and later items with the posted document; returns its version."""
+    payload, blob = decode_data_body(body, headers)
     tasks = payload.get("tasks", [])
     later = payload.get("later", [])
 
@@ -391,66 +2764,148 @@ async def post_data(
     incoming_task_ids = [t["id"] for t in tasks]
     if incoming_task_ids:
         # Delete tasks (and their sessions via CASCADE) no longer in the payload
+        # id::text so the text[] parameter also matches native uuid task ids.
         db.execute(
-            "DELETE FROM tasks WHERE user_id = %s AND id != ALL(%s)",
+            "DELETE FROM tasks WHERE user_id = %s AND id::text != ALL(%s)",
             (user_id, incoming_task_ids),
         )
     else:
         db.execute("DELETE FROM tasks WHERE user_id = %s", (user_id,))
 
+    # Archived sessions are owned by sessions_archive; a client that loaded
+    # history=full must not copy them back into the hot table.
+    horizon = archive_horizon(db)
+
     for task in tasks:
         db.execute(
             "INSERT INTO tasks (id, user_id, name) VALUES (%s, %s, %s) "
-            "ON CONFLICT (id, user_id) DO UPDATE SET name = EXCLUDED.name",
+            "ON CONFLICT (id, user_id) DO UPDATE SET name = EXCLUDED.name "
+            "WHERE tasks.name IS DISTINCT FROM EXCLUDED.name",
             (task["id"], user_id, task["name"]),
         )
 
         # ── Sync sessions for this task ──────────────────────────────────────
-        incoming_starts = [s["start"] for s in task.get("sessions", [])]
+        # Hot rows older than the horizon (imported after the last archive
+        # run) are left alone too: the client's copy of them was dropped above.
+        sessions = [s for s in task.get("sessions", []) if s["start"] >= horizon]
+        incoming_starts = [s["start"] for s in sessions]
+        params = {"task": task["id"], "uid": user_id, "horizon": horizon, "starts": incoming_starts}
         if incoming_starts:
             db.execute(
-                "DELETE FROM sessions WHERE task_id = %s AND user_id = %s AND start_ts != ALL(%s)",
-                (task["id"], user_id, incoming_starts),
+                "DELETE FROM sessions WHERE task_id = %(task)s AND user_id = %(uid)s "
+                "AND start_ts >= %(horizon)s AND start_ts != ALL(%(starts)s)",
+                params,
             )
         else:
             db.execute(
-                "DELETE FROM sessions WHERE task_id = %s AND user_id = %s",
-                (task["id"], user_id),
+                "DELETE FROM sessions WHERE task_id = %(task)s AND user_id = %(uid)s "
+                "AND start_ts >= %(horizon)s",
+                params,
             )
 
-        for s in task.get("sessions", []):
-            db.execute(
-                "INSERT INTO sessions (id, task_id, user_id, start_ts, end_ts) "
-                "VALUES (%s, %s, %s, %s, %s) "
-                "ON CONFLICT (task_id, user_id, start_ts) DO UPDATE SET end_ts = EXCLUDED.end_ts",
-                (str(uuid_mod.uuid4()), task["id"], user_id, s["start"], s.get("end")),
-            )
+        for s in sessions:
+            db.execute(UPSERT_SESSION_SQL, (task["id"], user_id, s["start"], s.get("end")))
 
     # ── Sync later items ─────────────────────────────────────────────────────
-    db.execute("DELETE FROM later_items WHERE user_id = %s", (user_id,))
-    for i, item in enumerate(later):
-        db.execute(
-            "INSERT INTO later_items (id, user_id, text, position) VALUES (%s, %s, %s, %s)",
-            (item["id"], user_id, item["text"], i),
-        )
+    sync_later_items(db, user_id, later)
 
     # Keep blob in sync for Plan B rollback
     db.execute(
         "INSERT INTO user_data (user_id, tasks_json, migrated_at) VALUES (%s, %s, NOW()) "
-        "ON CONFLICT (user_id) DO UPDATE SET tasks_json = EXCLUDED.tasks_json",
-        (user_id, body.decode()),
+        "ON CONFLICT (user_id) DO UPDATE SET tasks_json = EXCLUDED.tasks_json, updated_at = NOW() "
+        "RETURNING updated_at",
+        (user_id, blob),
     )
+    version = db.fetchone()["updated_at"].isoformat()
 
-    return Response(status_code=204)
+    replicas.pin(user_id)
+    return version
+
+
+def sync_later_items(db, user_id: int, later: list[dict]):
+    """
+    Bring later_items in line with the incoming list, touching only rows that
+    changed. Items already in the right relative order keep their position
+    keys; new and moved items get a key between their neighbours.
+    """
+    db.execute(
+        "SELECT id, text, position FROM later_items WHERE user_id = %s ORDER BY position",
+        (user_id,),
+    )
+    stored = db.fetchall()
+    if [(r["id"], r["text"]) for r in stored] == [(i["id"], i["text"]) for i in later]:
+        return
+
+    incoming_ids = {item["id"] for item in later}
+    removed = [r["id"] for r in stored if r["id"] not in incoming_ids]
+    if removed:
+        db.execute(
+            "DELETE FROM later_items WHERE user_id = %s AND id = ANY(%s)",
+            (user_id, removed),
+        )
+
+    rank = {r["id"]: n for n, r in enumerate(stored)}
+    existing = [i for i, item in enumerate(later) if item["id"] in rank]
+    keep = {existing[j] for j in _longest_increasing([rank[later[i]["id"]] for i in existing])}
+    stored_by_id = {r["id"]: r for r in stored}
+
+    keys: list[str | None] = [stored_by_id[later[i]["id"]]["position"] if i in keep else None
+                              for i in range(len(later))]
+    i = 0
+    while i < len(later):
+        if keys[i] is not None:
+            i += 1
+            continue
+        j = i
+        while j < len(later) and keys[j] is None:
+            j += 1
+        lo = keys[i - 1] if i else None
+        hi = keys[j] if j < len(later) else None
+        keys[i:j] = positions_between(lo, hi, j - i)
+        i = j
+    # Repeated inserts at one spot lengthen keys; past a bound, respace the whole list.
+    if any(len(k) > POSITION_MAX_LEN for k in keys):
+        keys = positions_between(None, None, len(later))
+
+    changed = [
+        (item["id"], user_id, item["text"], key)
+        for item, key in zip(later, keys)
+        if item["id"] not in stored_by_id
+        or stored_by_id[item["id"]]["position"] != key
+        or stored_by_id[item["id"]]["text"] != item["text"]
+    ]
+    if changed:
+        psycopg2.extras.execute_values(db, """
+            INSERT INTO later_items (id, user_id, text, position) VALUES %s
+            ON CONFLICT (id, user_id) DO UPDATE
+            SET text = EXCLUDED.text, position = EXCLUDED.position
+        """, changed)
 
 
-def count_today_sessions(user_id: int, db) -> int:
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+def count_today_sessions(user_id: int, db, quota_zone: str | None) -> int:
+    """
+    Sessions started today in quota_zone (users.quota_time_zone; None means
+    the user's time zone). From the daily rollup while it is bucketed in that
+    zone, else from today's sessions by index range.
+    """
     db.execute("""
-        SELECT COUNT(*) AS cnt FROM sessions
-        WHERE user_id = %s
-          AND to_char(to_timestamp(start_ts / 1000.0) AT TIME ZONE 'UTC', 'YYYY-MM-DD') = %s
-    """, (user_id, today))
+        WITH z AS (
+            SELECT u.id, u.time_zone, COALESCE(%(zone)s, u.time_zone) AS zone
+            FROM users u WHERE u.id = %(uid)s
+        ), d AS (
+            SELECT z.*, date_trunc('day', NOW() AT TIME ZONE z.zone) AS today FROM z
+        )
+        SELECT CASE WHEN d.zone = d.time_zone THEN (
+                   SELECT COALESCE(SUM(t.session_count), 0) FROM daily_task_totals t
+                   WHERE t.user_id = d.id AND t.day = d.today::date
+               ) ELSE (
+                   SELECT count(*) FROM sessions s
+                   WHERE s.user_id = d.id
+                     AND s.start_ts >= extract(epoch FROM d.today AT TIME ZONE d.zone) * 1000
+                     AND s.start_ts < extract(epoch FROM (d.today + INTERVAL '1 day') AT TIME ZONE d.zone) * 1000
+               ) END AS cnt
+        FROM d
+    """, {"uid": user_id, "zone": quota_zone})
     row = db.fetchone()
     return int(row["cnt"]) if row else 0
 
@@ -458,10 +2913,11 @@ def count_today_sessions(user_id: int, db) -> int:
 @app.post("/sessions/start")
 def session_start(
     user_id: Annotated[int, Depends(current_user_id)],
-    db: Annotated[psycopg2.extensions.cursor, Depends(get_db)],
+    db: Annotated[psycopg2.extensions.cursor, Depends(get_read_db)],
+    home: Annotated[psycopg2.extensions.cursor, Depends(get_home_read_db)],
 ):
     db.execute(
-        "SELECT subscription_status, is_comped FROM users WHERE id = %s",
+        "SELECT subscription_status, is_comped, quota_time_zone FROM users WHERE id = %s",
         (user_id,),
     )
     row = db.fetchone()
@@ -469,7 +2925,7 @@ def session_start(
         raise HTTPException(status_code=404)
     if row["is_comped"] or row["subscription_status"] == "active":
         return {"ok": True}
-    if count_today_sessions(user_id, db) >= 5:
+    if count_today_sessions(user_id, home, row["quota_time_zone"]) >= 5:
         raise HTTPException(
             status_code=402,
             detail="You've reached your 5 free sessions for today. Upgrade for unlimited.",
@@ -481,30 +2937,61 @@ class CheckoutRequest(BaseModel):
     guest_trial_start: int | None = None
 
 
-@app.post("/billing/checkout")
-def billing_checkout(
-    req: CheckoutRequest,
-    user_id: Annotated[int, Depends(current_user_id)],
-    db: Annotated[psycopg2.extensions.cursor, Depends(get_db)],
-):
+billing_client = BillingClient(STRIPE_SECRET_KEY, api_base=STRIPE_API_BASE,
+                               timeout=STRIPE_TIMEOUT_SECONDS, retries=STRIPE_RETRIES)
+BILLING_UNAVAILABLE = "Billing is temporarily unavailable, try again in a minute"
+
+
+def _checkout_user(db, user_id: int, guest_trial_start: int | None):
+    """
+    The user's email and Stripe customer, and the guest-mode trial start and
+    end to carry over. Nothing is written until Stripe has answered (see
+    _save_customer_id).
+    """
     db.execute("SELECT email, stripe_customer_id FROM users WHERE id = %s", (user_id,))
     row = db.fetchone()
     if not row:
         raise HTTPException(status_code=404)
-    customer_id = row["stripe_customer_id"]
-    if not customer_id:
-        customer = stripe.Customer.create(email=row["email"], metadata={"user_id": str(user_id)})
-        customer_id = customer.id
-        db.execute("UPDATE users SET stripe_customer_id = %s WHERE id = %s", (customer_id, user_id))
-    trial_end = None
-    if req.guest_trial_start:
-        guest_dt = datetime.fromtimestamp(req.guest_trial_start / 1000, tz=timezone.utc)
+    trial_started = trial_end = None
+    if guest_trial_start:
+        guest_dt = datetime.fromtimestamp(guest_trial_start / 1000, tz=timezone.utc)
         trial_end_dt = guest_dt + timedelta(days=30)
         if trial_end_dt > datetime.now(timezone.utc):
-            trial_end = int(trial_end_dt.timestamp())
-            db.execute("UPDATE users SET trial_started_at = %s WHERE id = %s", (guest_dt, user_id))
+            trial_started, trial_end = guest_dt, int(trial_end_dt.timestamp())
+    return row, trial_started, trial_end
+
+
+def _save_customer_id(db, user_id: int, customer_id: str, trial_started: datetime | None = None) -> str:
+    """
+    Store a new Stripe customer unless a concurrent checkout got there first,
+    together with the guest trial start if there is one; returns the customer
+    kept.
+    """
+    db.execute(
+        "UPDATE users SET stripe_customer_id = COALESCE(stripe_customer_id, %s), "
+        "trial_started_at = COALESCE(%s, trial_started_at) WHERE id = %s "
+        "RETURNING stripe_customer_id",
+        (customer_id, trial_started, user_id),
+    )
+    replicas.pin(user_id)
+    return db.fetchone()["stripe_customer_id"]
+
+
+def _stripe_customer_id(db, user_id: int) -> str | None:
+    db.execute("SELECT stripe_customer_id FROM users WHERE id = %s", (user_id,))
+    row = db.fetchone()
+    return row["stripe_customer_id"] if row else None
+
+
+@app.post("/billing/checkout")
+async def billing_checkout(
+    req: CheckoutRequest,
+    user_id: Annotated[int, Depends(current_user_id)],
+    run_db=Depends(get_db_runner),
+):
+    # No connection is held while Stripe is called; see run_in_db.
+    user, trial_started, trial_end = await run_db(_checkout_user, user_id, req.guest_trial_start)
     checkout_kwargs: dict = dict(
-        customer=customer_id,
         mode="subscription",
         line_items=[{"price": STRIPE_PRICE_ID, "quantity": 1}],
         success_url=f"{APP_URL}/billing/success",
@@ -514,41 +3001,58 @@ def billing_checkout(
         checkout_kwargs["subscription_data"] = {"trial_end": trial_end}
     else:
         checkout_kwargs["subscription_data"] = {"trial_period_days": 30}
-    session = stripe.checkout.Session.create(**checkout_kwargs)
-    return {"url": session.url}
+    try:
+        customer_id = user["stripe_customer_id"]
+        if not customer_id:
+            customer_id = await billing_client.create_customer(user["email"], user_id)
+            customer_id = await run_db(_save_customer_id, user_id, customer_id, trial_started)
+            trial_started = None
+        url = await billing_client.checkout_url({"customer": customer_id, **checkout_kwargs})
+        if trial_started:
+            await run_db(_save_customer_id, user_id, customer_id, trial_started)
+    except BillingUnavailable:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=BILLING_UNAVAILABLE)
+    return {"url": url}
 
 
 @app.get("/billing/portal")
-def billing_portal(
+async def billing_portal(
     user_id: Annotated[int, Depends(current_user_id)],
-    db: Annotated[psycopg2.extensions.cursor, Depends(get_db)],
+    run_db=Depends(get_db_runner),
 ):
-    db.execute("SELECT stripe_customer_id FROM users WHERE id = %s", (user_id,))
-    row = db.fetchone()
-    if not row or not row["stripe_customer_id"]:
+    customer_id = await run_db(_stripe_customer_id, user_id)
+    if not customer_id:
         raise HTTPException(status_code=400, detail="No billing account found")
-    portal = stripe.billing_portal.Session.create(
-        customer=row["stripe_customer_id"],
-        return_url=f"{APP_URL}/",
-    )
-    return {"url": portal.url}
+    try:
+        url = await billing_client.portal_url(customer_id, f"{APP_URL}/")
+    except BillingUnavailable:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=BILLING_UNAVAILABLE)
+    return {"url": url}
 
 
-@app.get("/billing/status")
-def billing_status(
-    user_id: Annotated[int, Depends(current_user_id)],
-    db: Annotated[psycopg2.extensions.cursor, Depends(get_db)],
-):
+def billing_state(db, user_id: int) -> dict | None:
+    """The body of GET /billing/status, or None if the user no longer exists."""
     db.execute("SELECT subscription_status, is_comped FROM users WHERE id = %s", (user_id,))
     row = db.fetchone()
     if not row:
-        raise HTTPException(status_code=404)
+        return None
     return {
         "subscription_status": row["subscription_status"] or "free",
         "is_comped": row["is_comped"] or False,
     }
 
 
+@app.get("/billing/status")
+def billing_status(
+    user_id: Annotated[int, Depends(current_user_id)],
+    db: Annotated[psycopg2.extensions.cursor, Depends(get_read_db)],
+):
+    state = billing_state(db, user_id)
+    if state is None:
+        raise HTTPException(status_code=404)
+    return state
+
+
 @app.post("/billing/webhook")
 async def billing_webhook(request: Request, db=Depends(get_db)):
     payload = await request.body()
@@ -598,9 +3102,94 @@ async def billing_webhook(request: Request, db=Depends(get_db)):
     return {"ok": True}
 
 
+# ── Index page ────────────────────────────────────────────────────────────────
+# For a signed-in browser, GET / carries what load() would otherwise fetch from
+# /data and /billing/status, so first paint needs one request. The client
+# mirrors its bearer token into the tt_boot cookie; the cookie is only read
+# here, by a read-only GET, so it grants nothing a cross-site request could use.
+BOOTSTRAP_COOKIE = "tt_boot"
+BOOTSTRAP_BEFORE = b'<script src="/static/app.js"></script>'
+_index_cache: dict = {}
+
+
+def index_template() -> tuple[bytes, bytes]:
+    """index.html split where the bootstrap goes; kept in memory, re-read when the file changes."""
+    mtime = os.stat("index.html").st_mtime_ns
+    if _index_cache.get("mtime") != mtime:
+        with open("index.html", "rb") as f:
+            html = f.read()
+        at = html.index(BOOTSTRAP_BEFORE)
+        _index_cache.update(mtime=mtime, parts=(html[:at], html[at:]))
+    return _index_cache["parts"]
+
+
+def cookie_user_id(request: Request) -> int | None:
+    """The user named by a valid bootstrap cookie, else None; never raises."""
+    token = request.cookies.get(BOOTSTRAP_COOKIE)
+    if not INLINE_BOOTSTRAP or not token:
+        return None
+    try:
+        user_id = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+        return int(user_id) if user_id is not None else None
+    except (JWTError, ValueError):
+        return None
+
+
+async def bootstrap_slot(user_id: Annotated[int | None, Depends(cookie_user_id)]):
+    """db_slot and home_slot, taken only when the page will be personalized; yields the home shard."""
+    if user_id is None:
+        yield None
+        return
+    async with db_pool.slot():
+        shard = await home_shard(user_id)
+        if shard == 0:
+            yield 0
+            return
+        async with shard_pools[shard].slot():
+            yield shard
+
+
+def get_bootstrap_db(user_id: Annotated[int | None, Depends(cookie_user_id)],
+                     _shard: Annotated[int | None, Depends(bootstrap_slot)]):
+    """get_read_db for the index page; None when there is no one to bootstrap."""
+    if user_id is None:
+        yield None
+        return
+    yield from _read_session(user_id)
+
+
+def get_bootstrap_home_db(user_id: Annotated[int | None, Depends(cookie_user_id)],
+                          shard: Annotated[int | None, Depends(bootstrap_slot)],
+                          db: Annotated[psycopg2.extensions.cursor | None, Depends(get_bootstrap_db)]):
+    """get_home_read_db for the index page; None when there is no one to bootstrap."""
+    if user_id is None:
+        yield None
+        return
+    yield from _home_session(db, user_id, shard, write=False)
+
+
+def bootstrap_json(state: dict) -> bytes:
+    """JSON that cannot end the <script> element it is embedded in (ASCII, so no U+2028 either)."""
+    return json.dumps(state, separators=(",", ":")).replace("<", "\\u003c").encode()
+
+
+def index_response(user_id: int | None, db, home) -> Response:
+    head, tail = index_template()
+    headers = {"Cache-Control": "no-cache", "Vary": "Cookie"}
+    billing = billing_state(db, user_id) if user_id is not None and db is not None else None
+    if billing is None:
+        return Response(head + tail, media_type="text/html", headers=headers)
+    state = {"user": str(user_id), "data": load_data(home, user_id), "billing": billing}
+    boot = b'<script id="tt-bootstrap" type="application/json">' + bootstrap_json(state) + b"</script>\n"
+    headers["Cache-Control"] = "private, no-store"
+    return Response(head + boot + tail, media_type="text/html", headers=headers)
+
+
 @app.get("/billing/success")
-def billing_success():
-    return FileResponse("index.html")
+def billing_success(user_id: Annotated[int | None, Depends(cookie_user_id)],
+                    db: Annotated[psycopg2.extensions.cursor | None, Depends(get_bootstrap_db)],
+                    home: Annotated[psycopg2.extensions.cursor | None, Depends(get_bootstrap_home_db)]):
+    return index_response(user_id, db, home)
 
 
 @app.get("/favicon-local.png")
@@ -609,5 +3198,7 @@ def favicon_local():
 
 
 @app.get("/")
-def root():
-    return FileResponse("index.html")
+def root(user_id: Annotated[int | None, Depends(cookie_user_id)],
+         db: Annotated[psycopg2.extensions.cursor | None, Depends(get_bootstrap_db)],
+         home: Annotated[psycopg2.extensions.cursor | None, Depends(get_bootstrap_home_db)]):
+    return index_response(user_id, db, home)
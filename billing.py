@@ -0,0 +1,163 @@
+"""
+billing.py — Stripe API calls made while serving a request.
+
+BillingClient makes them asynchronously (httpx, through stripe.StripeClient),
+so a checkout waits on the event loop instead of holding a threadpool thread,
+and app.py releases its database connection before calling out. Each attempt
+has a short timeout. Transient failures (connection errors, timeouts, 429 and
+5xx) are retried a bounded number of times with the same Idempotency-Key, so
+a retried create never makes a second customer or session. Failures that
+survive the retries trip a CircuitBreaker: while Stripe looks down, calls
+fail at once with BillingUnavailable instead of tying up requests.
+
+Webhook verification (stripe.Webhook.construct_event) is local and stays in
+app.py.
+"""
+import asyncio
+import time
+import uuid
+import weakref
+
+import anyio
+import stripe
+
+# Errors that say Stripe (or the way to it) is unwell, not that the request was wrong.
+TRANSIENT_ERRORS = (stripe.APIConnectionError, stripe.RateLimitError, stripe.APIError)
+
+
+class BillingUnavailable(Exception):
+    """Stripe is failing or the circuit is open; callers answer 503."""
+
+
+class CircuitBreaker:
+    """
+    Closed until `threshold` calls in a row have failed, then open for
+    `reset_seconds`, during which allow() is False. After that a single trial
+    call is let through (half-open): its success closes the circuit, its
+    failure opens it for another reset_seconds. Per process.
+    """
+
+    def __init__(self, threshold: int = 5, reset_seconds: float = 30, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self.clock() - self.opened_at < self.reset_seconds:
+            return "open"
+        return "half-open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._trial:
+            self._trial = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures, self.opened_at, self._trial = 0, None, False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial or self.failures >= self.threshold:
+            self.opened_at = self.clock()
+        self._trial = False
+
+    def release(self):
+        """The call ended without telling us anything (e.g. it was cancelled)."""
+        self._trial = False
+
+
+class BillingClient:
+    """
+    The Stripe calls the billing endpoints make. `retries` is the number of
+    extra attempts after a transient failure, spaced backoff, 2×backoff, ...
+    seconds apart. api_base points the client elsewhere (stripe-mock, or the
+    stub server in tests).
+
+    httpx connection pools belong to an event loop, so the underlying
+    StripeClient is created per running loop: one per gunicorn worker, never
+    inherited across fork.
+    """
+
+    def __init__(self, api_key: str, *, api_base: str = "", timeout: float = 5,
+                 retries: int = 2, backoff: float = 0.25, breaker: CircuitBreaker | None = None):
+        self.api_key = api_key
+        self.api_base = api_base
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _stripe(self) -> stripe.StripeClient:
+        loop = asyncio.get_running_loop()
+        if loop not in self._clients:
+            http = stripe.HTTPXClient(timeout=self.timeout)
+            client = stripe.StripeClient(
+                self.api_key,
+                http_client=http,
+                max_network_retries=0,  # retried here, where the breaker can see them
+                base_addresses={"api": self.api_base} if self.api_base else {},
+            )
+            self._clients[loop] = (client, http)
+        return self._clients[loop][0]
+
+    async def _call(self, method: str, params: dict):
+        if not self.breaker.allow():
+            raise BillingUnavailable("Stripe circuit is open")
+        options = {"idempotency_key": str(uuid.uuid4())}
+        healthy = None
+        try:
+            service = self._stripe()
+            for name in method.split("."):
+                service = getattr(service, name)
+            for attempt in range(self.retries + 1):
+                try:
+                    result = await service(params=params, options=options)
+                except TRANSIENT_ERRORS as e:
+                    if attempt == self.retries:
+                        healthy = False
+                        raise BillingUnavailable(str(e)) from e
+                    await anyio.sleep(self.backoff * 2 ** attempt)
+                except stripe.StripeError:
+                    healthy = True  # Stripe answered; the request itself was refused
+                    raise
+                else:
+                    healthy = True
+                    return result
+        finally:
+            if healthy is True:
+                self.breaker.record_success()
+            elif healthy is False:
+                self.breaker.record_failure()
+            else:
+                self.breaker.release()
+
+    async def create_customer(self, email: str, user_id: int) -> str:
+        customer = await self._call("customers.create_async",
+                                    {"email": email, "metadata": {"user_id": str(user_id)}})
+        return customer.id
+
+    async def checkout_url(self, params: dict) -> str:
+        session = await self._call("checkout.sessions.create_async", params)
+        return session.url
+
+    async def portal_url(self, customer_id: str, return_url: str) -> str:
+        session = await self._call("billing_portal.sessions.create_async",
+                                   {"customer": customer_id, "return_url": return_url})
+        return session.url
+
+    async def aclose(self):
+        """Close the connection pool of the running loop's client."""
+        entry = self._clients.pop(asyncio.get_running_loop(), None)
+        if entry is not None:
+            await entry[1].close_async()
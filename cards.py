@@ -0,0 +1,291 @@
+"""
+cards.py — 1200×630 share images: the static og.png and per-user weekly cards.
+
+Artwork is decoded and resized once per process and fonts are loaded once per
+size, so a render only draws. Weekly cards are rendered by CardRenderer in a
+small process pool, away from the web workers' GIL, and stored by CardCache
+under a hash of what they show: an unchanged week is served from disk, and
+clients holding the same ETag get a 304.
+
+gen_og.py writes static/og.png with render_og().
+"""
+import asyncio, concurrent.futures, functools, hashlib, io, json, multiprocessing, os, tempfile, threading
+from datetime import date
+from pathlib import Path
+
+from PIL import Image, ImageDraw, ImageFont
+
+HERE = Path(__file__).parent
+BEAVER = HERE / "static" / "beaver.png"
+W, H = 1200, 630
+CARD_VERSION = 1  # bump when the weekly layout changes so cached cards are re-rendered
+TOP_TASKS = 5
+WEEK_BEAVER_H = 300
+WEEK_FONTS = [(44, True), (28, False), (96, True), (30, False), (26, False)]  # (size, bold)
+
+# Colours (matching app)
+BG     = "#FCFBFB"
+RED    = "#FF3B30"
+TEXT   = "#1C1C1E"
+DIM    = "#6E6E73"
+TRACK  = "#EFEDED"
+
+
+def hex2rgb(h):
+    h = h.lstrip("#")
+    return tuple(int(h[i:i+2], 16) for i in (0, 2, 4))
+
+
+# ── Assets (cached per process) ────────────────────────────────────────────────
+@functools.lru_cache(maxsize=None)
+def font(size, bold=False):
+    candidates = [
+        # San Francisco (macOS system font)
+        "/System/Library/Fonts/SFNS.ttf",
+        # Linux fallbacks (GitHub Actions, fonts-dejavu-core in the Docker image)
+        "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf" if bold else "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+        "/opt/anaconda3/lib/python3.12/site-packages/matplotlib/mpl-data/fonts/ttf/DejaVuSans-Bold.ttf" if bold else "/opt/anaconda3/lib/python3.12/site-packages/matplotlib/mpl-data/fonts/ttf/DejaVuSans.ttf",
+    ]
+    for path in candidates:
+        if os.path.exists(path):
+            try:
+                return ImageFont.truetype(path, size)
+            except Exception:
+                pass
+    return ImageFont.load_default()
+
+
+@functools.lru_cache(maxsize=4)
+def beaver(height: int) -> Image.Image:
+    """The mascot scaled to `height`; callers only paste it, never modify it."""
+    with Image.open(BEAVER) as src:
+        src = src.convert("RGBA")
+        width = int(src.width * height / src.height)
+        return src.resize((width, height), Image.LANCZOS)
+
+
+def warm():
+    """Load everything a weekly card uses, so a pool worker's first render is as fast as the rest."""
+    beaver(WEEK_BEAVER_H)
+    for size, bold in WEEK_FONTS:
+        font(size, bold)
+
+
+def _centered(draw, text, fnt, center_x, y, fill):
+    bb = draw.textbbox((0, 0), text, font=fnt)
+    draw.text((center_x - (bb[2] - bb[0]) // 2, y), text, font=fnt, fill=hex2rgb(fill))
+
+
+def _fit(draw, text, fnt, max_width):
+    """text, shortened with an ellipsis until it fits max_width."""
+    if draw.textlength(text, font=fnt) <= max_width:
+        return text
+    while text and draw.textlength(text + "…", font=fnt) > max_width:
+        text = text[:-1]
+    return text.rstrip() + "…"
+
+
+def format_hours(ms: int) -> str:
+    minutes = round(ms / 60000)
+    if minutes < 60:
+        return f"{minutes}m"
+    return f"{minutes / 60:.1f}h"
+
+
+# ── Static og.png ──────────────────────────────────────────────────────────────
+def render_og() -> Image.Image:
+    img  = Image.new("RGB", (W, H), hex2rgb(BG))
+    draw = ImageDraw.Draw(img)
+
+    # Beaver mascot, centred in the left half
+    mascot = beaver(350)
+    bx = (W // 2 - mascot.width) // 2
+    by = (H - mascot.height) // 2
+    img.paste(mascot, (bx, by), mascot)
+
+    # Right column: wordmark, tagline, URL
+    center_x = (bx + mascot.width + W) // 2
+    _centered(draw, "DOING IT", font(120, bold=True), center_x, 210, RED)
+    _centered(draw, "From to-do to done, tracked", font(38), center_x, 335, TEXT)
+    _centered(draw, "doingit.online", font(31), center_x, 390, DIM)
+    return img
+
+
+# ── Weekly card ────────────────────────────────────────────────────────────────
+def card_key(summary: dict) -> str:
+    """Content address of a weekly card: equal summaries render identical images."""
+    blob = json.dumps({"v": CARD_VERSION, **summary}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(blob.encode()).hexdigest()[:32]
+
+
+def render_week(summary: dict) -> bytes:
+    """
+    PNG for a summary shaped like {"week_start": "2026-10-13", "week_end":
+    "2026-10-19", "total_ms": ..., "top": [{"name": ..., "total_ms": ...}]}.
+    """
+    img  = Image.new("RGB", (W, H), hex2rgb(BG))
+    draw = ImageDraw.Draw(img)
+
+    mascot = beaver(WEEK_BEAVER_H)
+    img.paste(mascot, ((400 - mascot.width) // 2, (H - mascot.height) // 2), mascot)
+
+    x0, x1 = 420, W - 70
+    draw.text((x0, 60), "DOING IT", font=font(44, bold=True), fill=hex2rgb(RED))
+    start, end = date.fromisoformat(summary["week_start"]), date.fromisoformat(summary["week_end"])
+    draw.text((x0, 118), f"{start:%b} {start.day} – {end:%b} {end.day}",
+              font=font(28), fill=hex2rgb(DIM))
+
+    total = format_hours(summary["total_ms"])
+    draw.text((x0, 160), total, font=font(96, bold=True), fill=hex2rgb(TEXT))
+    tw = draw.textlength(total, font=font(96, bold=True))
+    draw.text((x0 + tw + 18, 222), "tracked this week", font=font(30), fill=hex2rgb(DIM))
+
+    top = summary["top"][:TOP_TASKS]
+    if not top:
+        draw.text((x0, 320), "No sessions yet this week", font=font(30), fill=hex2rgb(DIM))
+    longest = max((t["total_ms"] for t in top), default=1) or 1
+    y = 300
+    for task in top:
+        hours = format_hours(task["total_ms"])
+        hw = draw.textlength(hours, font=font(30))
+        draw.text((x0, y), _fit(draw, task["name"], font(30), x1 - x0 - hw - 24),
+                  font=font(30), fill=hex2rgb(TEXT))
+        draw.text((x1 - hw, y), hours, font=font(30), fill=hex2rgb(DIM))
+        draw.rectangle((x0, y + 40, x1, y + 46), fill=hex2rgb(TRACK))
+        draw.rectangle((x0, y + 40, x0 + (x1 - x0) * task["total_ms"] // longest, y + 46),
+                       fill=hex2rgb(RED))
+        y += 58
+
+    url = "doingit.online"
+    draw.text((x1 - draw.textlength(url, font=font(26)), H - 44), url, font=font(26), fill=hex2rgb(DIM))
+
+    out = io.BytesIO()
+    img.save(out, "PNG")
+    return out.getvalue()
+
+
+# ── Rendering off the request path ─────────────────────────────────────────────
+class CardRenderer:
+    """
+    Runs render_week in a process pool of `workers` processes (0 renders in
+    a thread instead). The pool is started on first use and keyed by pid,
+    like app.ConnectionPool, so it is never inherited across gunicorn's fork;
+    its processes are spawned fresh and warm their assets once. After
+    idle_seconds without a render the pool is shut down again, so a small VM
+    only pays for it while cards are being shared.
+    """
+
+    def __init__(self, workers: int, idle_seconds: float = 60):
+        self.workers = workers
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+        self._busy = 0
+        self._idle_timer = None
+
+    def _acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=warm,
+                )
+                self._pid = os.getpid()
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+            self._busy += 1
+            return self._executor
+
+    def _release(self):
+        with self._lock:
+            self._busy -= 1
+            if self._busy == 0 and self._pid == os.getpid():
+                self._idle_timer = threading.Timer(self.idle_seconds, self._shutdown_if_idle)
+                self._idle_timer.daemon = True
+                self._idle_timer.start()
+
+    def _shutdown_if_idle(self):
+        with self._lock:
+            if self._busy or self._pid != os.getpid():
+                return
+            executor, self._executor, self._pid, self._idle_timer = self._executor, None, None, None
+        executor.shutdown(wait=False)
+
+    async def render(self, summary: dict) -> bytes:
+        if self.workers <= 0:
+            return await asyncio.to_thread(render_week, summary)
+        executor = self._acquire()
+        try:
+            return await asyncio.wrap_future(executor.submit(render_week, summary))
+        finally:
+            self._release()
+
+    def close(self):
+        with self._lock:
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(cancel_futures=True)
+            self._pid = self._executor = self._idle_timer = None
+
+
+# ── Disk cache ─────────────────────────────────────────────────────────────────
+class CardCache:
+    """
+    Rendered cards on disk, one file per card_key. A hit refreshes the
+    file's mtime; writes evict the least recently used files once the
+    directory holds more than max_bytes. Files are written to a temp name
+    and renamed, so workers sharing the directory never see a partial PNG.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def path(self, key: str) -> Path:
+        return self.directory / f"{key}.png"
+
+    def get(self, key: str) -> Path | None:
+        path = self.path(key)
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key: str, data: bytes) -> Path:
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".card-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.evict()
+        return self.path(key)
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".png"):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
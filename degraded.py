@@ -0,0 +1,248 @@
+"""
+degraded.py — serving /data while Postgres is unreachable.
+
+When a database stops answering, its ConnectionPool (app.py) raises
+DatabaseUnavailable and fails fast for DB_RETRY_SECONDS before trying again.
+Most endpoints answer 503. The two that keep a signed-in user working fall
+back to the local disk:
+
+  SnapshotCache   the last /data document seen for each user (the body of
+                  their last save, or of a GET when there was none), bounded
+                  by size with the least recently used evicted first.
+                  GET /data answers from it during an outage.
+  WriteJournal    POST /data bodies accepted during an outage, the newest per
+                  user. A background thread replays them once the database is
+                  back, and a normal save discards the user's entry, since
+                  every save is the whole document. Off unless JOURNAL_DIR
+                  names durable storage: a 202 promises the save is kept.
+
+Both keep one file per user, holding a header line (content type, content
+encoding, when it was saved, and the version) and the body exactly as it was
+posted or served. They are written to a temp name and renamed, so gunicorn
+workers sharing a directory never read a partial file; journal entries are
+fsynced first. Neither is shared between machines: a user whose requests land
+on another machine during an outage gets a 503 there until that machine has
+seen them.
+
+Versions are user_data.updated_at, as the database wrote it. A snapshot holds
+the version its body was read or saved at, and is refreshed on a read that
+finds a newer one. A journal entry holds the version of the document the save
+was made over, and is replayed only if the database is still at that version,
+so a stale snapshot never overwrites a save made on another machine.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+import psycopg2
+
+
+class DatabaseUnavailable(psycopg2.OperationalError):
+    """A database could not be reached, or its connection was lost mid-request."""
+
+
+class Document(NamedTuple):
+    body: bytes
+    headers: dict  # content-type and content-encoding, as decode_data_body reads them
+    saved_at: float  # epoch seconds
+    version: str | None  # user_data.updated_at (ISO 8601) this body is, or was made over; None before any save
+
+
+class DocumentStore:
+    """The latest /data body of each user, one file per user under directory."""
+
+    durable = False  # fsync each file and the directory before put() returns
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def path(self, user_id: int) -> Path:
+        return self.directory / str(user_id)
+
+    def has(self, user_id: int) -> bool:
+        return self.path(user_id).exists()
+
+    def get(self, user_id: int) -> Document | None:
+        try:
+            return self._read(self.path(user_id))
+        except FileNotFoundError:
+            return None
+
+    def header(self, user_id: int) -> dict | None:
+        """The entry's header line alone (saved_at, version, ...); None if there is no entry."""
+        try:
+            with open(self.path(user_id), "rb") as f:
+                return json.loads(f.readline())
+        except FileNotFoundError:
+            return None
+
+    def put(self, user_id: int, body: bytes, headers, saved_at: float | None = None,
+            version: str | None = None):
+        header = {"content-type": headers.get("content-type", "application/json"),
+                  "content-encoding": headers.get("content-encoding", "identity"),
+                  "saved_at": time.time() if saved_at is None else saved_at,
+                  "version": version}
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".doc-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(json.dumps(header).encode() + b"\n" + body)
+                if self.durable:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp, self.path(user_id))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        if self.durable:
+            dir_fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def discard(self, user_id: int):
+        try:
+            os.unlink(self.path(user_id))
+        except FileNotFoundError:
+            pass
+
+    def _read(self, path: Path) -> Document:
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            body = f.read()
+        saved_at, version = header.pop("saved_at"), header.pop("version", None)
+        return Document(body, header, saved_at, version)
+
+    def _entries(self) -> list[tuple[float, int, int]]:
+        """(mtime, size, user id) of every entry, oldest first."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.isdigit():
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, int(entry.name)))
+        return sorted(entries)
+
+    def total_bytes(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+
+class SnapshotCache(DocumentStore):
+    """
+    Last known documents. A read refreshes the file's mtime; writes evict the
+    least recently used files once the directory holds more than max_bytes.
+    Eviction lists the whole directory, so a process runs it at most every
+    evict_every seconds and the directory may overshoot in between.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int, evict_every: float = 60):
+        super().__init__(directory, max_bytes)
+        self.evict_every = evict_every
+        self._evicted_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> Document | None:
+        try:
+            os.utime(self.path(user_id))  # mark as recently used
+        except FileNotFoundError:
+            return None
+        return super().get(user_id)
+
+    def put(self, user_id: int, body: bytes, headers, saved_at: float | None = None,
+            version: str | None = None):
+        super().put(user_id, body, headers, saved_at, version)
+        if time.monotonic() - self._evicted_at >= self.evict_every:
+            self.evict()
+
+    def evict(self):
+        with self._lock:
+            self._evicted_at = time.monotonic()
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, user_id in entries:
+                if total <= self.max_bytes:
+                    break
+                self.discard(user_id)
+                total -= size
+
+
+class JournalFull(Exception):
+    """The journal holds max_bytes already; the save was not accepted."""
+
+
+class WriteJournal(DocumentStore):
+    """
+    Saves waiting for the database. Entries are fsynced and never evicted:
+    put() raises JournalFull instead once the directory holds max_bytes.
+
+    replay() claims each entry by renaming it to .replaying-<pid>-<user id>,
+    so the replay threads of several workers never apply one twice. A claim
+    left behind by a process that died is put back on the next replay.
+    """
+
+    durable = True
+
+    def put(self, user_id: int, body: bytes, headers, saved_at: float | None = None,
+            version: str | None = None):
+        if not self.has(user_id) and self.total_bytes() + len(body) > self.max_bytes:
+            raise JournalFull(f"journal holds more than {self.max_bytes} bytes")
+        super().put(user_id, body, headers, saved_at, version)
+
+    def pending(self) -> int:
+        return len(self._entries())
+
+    def _restore(self, claim: Path, user_id: int):
+        """Put a claimed entry back, unless a newer save for the user arrived meanwhile."""
+        try:
+            os.link(claim, self.path(user_id))
+        except FileExistsError:
+            pass
+        os.unlink(claim)
+
+    def _restore_orphans(self):
+        for entry in os.scandir(self.directory):
+            if not entry.name.startswith(".replaying-"):
+                continue
+            _, pid, user_id = entry.name.split("-")
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                self._restore(Path(entry.path), int(user_id))
+            except PermissionError:
+                pass  # alive, as another user
+
+    def replay(self, apply, transient=(psycopg2.OperationalError,), log=print) -> int:
+        """
+        apply(user_id, document) for every entry, oldest first, dropping each
+        once apply returns. A transient error puts the entry back and stops
+        the replay; any other error sets the entry aside as .failed-<user id>
+        and moves on. Returns the number of entries applied.
+        """
+        self._restore_orphans()
+        applied = 0
+        for _, _, user_id in self._entries():
+            claim = self.directory / f".replaying-{os.getpid()}-{user_id}"
+            try:
+                os.rename(self.path(user_id), claim)
+            except FileNotFoundError:
+                continue  # saved normally, or claimed by another worker
+            try:
+                apply(user_id, self._read(claim))
+            except transient:
+                self._restore(claim, user_id)
+                raise
+            except Exception as e:
+                log(f"[journal] user {user_id}: replay failed, kept as .failed-{user_id}: {e}")
+                os.replace(claim, self.directory / f".failed-{user_id}")
+                continue
+            os.unlink(claim)
+            applied += 1
+        return applied
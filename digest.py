@@ -0,0 +1,310 @@
+"""
+digest.py — the weekly summary email, sent by `maintenance.py digest`.
+
+The job runs in its own process (a cron entry or a scheduled machine), never
+in the web workers. It walks the users who opted in (users.weekly_digest) in
+batches by id. For each batch it runs one query on the primary for the users
+and one per home shard for their weeks, read from the daily_task_totals
+rollup. The rollup already holds per-day, per-task totals in each user's
+time zone, so the job never scans sessions. Emails are filled in from
+templates compiled once, and the whole batch goes to Resend's batch endpoint
+in a single call.
+
+  digest_week()     Monday of the last Monday–Sunday week that is over in
+                    every time zone
+  weekly_totals()   that week's and the week before's totals for a batch of
+                    users, on their shard
+  render_digest()   subject, html and text for one user
+  DigestMailer      Resend batch calls through one keep-alive httpx.Client,
+                    paced to `rate` calls per second, with retries
+  send_digests()    the job
+
+Checkpointing: once Resend has accepted a batch, its users get
+users.digest_sent_for = the week, in a commit of its own. A run that stops
+partway, or a batch that keeps failing, leaves the rest unmarked for the next
+run. Before a call goes out, its Idempotency-Key is stored in
+users.digest_batch for each recipient and committed. A later run sends each
+recipient under the key they already hold, so a batch that was sent but not
+marked is not delivered twice even if users joined or left it meanwhile.
+"""
+import hashlib
+import hmac
+import string
+import time
+from datetime import date, datetime, timedelta, timezone
+from html import escape
+
+import httpx
+
+from cards import TOP_TASKS, format_hours
+
+BATCH_MAX = 100  # emails per Resend batch call
+
+
+def digest_week(now: datetime | None = None) -> date:
+    """Monday of the last full week that has ended everywhere, UTC-12 included."""
+    today = ((now or datetime.now(timezone.utc)) - timedelta(hours=12)).date()
+    return today - timedelta(days=today.weekday() + 7)
+
+
+def unsubscribe_sig(secret: str, user_id: int) -> str:
+    """Signs the unsubscribe link; unlike a session token it can do nothing else."""
+    return hmac.new(secret.encode(), f"digest:{user_id}".encode(), hashlib.sha256).hexdigest()[:32]
+
+
+# ── Totals ───────────────────────────────────────────────────────────────────
+
+USERS_SQL = """
+    SELECT u.id, u.email, u.digest_batch, COALESCE(s.shard, 0) AS shard
+    FROM users u LEFT JOIN user_shards s ON s.user_id = u.id
+    WHERE u.weekly_digest AND u.id > %(after)s
+      AND (u.digest_sent_for IS NULL OR u.digest_sent_for < %(week)s)
+    ORDER BY u.id
+    LIMIT %(limit)s
+"""
+
+TOTALS_SQL = """
+    SELECT d.user_id, t.name,
+           COALESCE(SUM(d.total_ms) FILTER (WHERE d.day >= %(week)s), 0)::bigint AS week_ms,
+           COALESCE(SUM(d.session_count) FILTER (WHERE d.day >= %(week)s), 0)::bigint AS sessions,
+           COALESCE(SUM(d.total_ms) FILTER (WHERE d.day < %(week)s), 0)::bigint AS previous_ms
+    FROM daily_task_totals d
+    JOIN tasks t ON t.id = d.task_id AND t.user_id = d.user_id
+    WHERE d.user_id = ANY(%(uids)s)
+      AND d.day >= %(week)s::date - 7 AND d.day < %(week)s::date + 7
+    GROUP BY d.user_id, t.name
+"""
+
+
+def weekly_totals(cur, user_ids: list[int], week: date) -> dict[int, dict]:
+    """
+    Per user: total_ms, sessions and previous_ms (the week before) across
+    tasks, and the top tasks of the week as (name, ms). Users with no time
+    in either week are left out.
+    """
+    cur.execute(TOTALS_SQL, {"uids": user_ids, "week": week})
+    out: dict[int, dict] = {}
+    for r in cur.fetchall():
+        user = out.setdefault(r["user_id"], {"total_ms": 0, "sessions": 0, "previous_ms": 0, "tasks": []})
+        user["total_ms"] += r["week_ms"]
+        user["sessions"] += r["sessions"]
+        user["previous_ms"] += r["previous_ms"]
+        if r["week_ms"]:
+            user["tasks"].append((r["name"], r["week_ms"]))
+    for user in out.values():
+        user["tasks"].sort(key=lambda task: (-task[1], task[0]))
+        del user["tasks"][TOP_TASKS:]
+    return out
+
+
+# ── Rendering ────────────────────────────────────────────────────────────────
+
+HTML = string.Template("""\
+<div style="font-family:-apple-system,BlinkMacSystemFont,'Segoe UI',sans-serif;max-width:480px;color:#222">
+<p style="color:#888;margin:0">$label</p>
+<h1 style="margin:4px 0 8px">$total</h1>
+<p style="margin:0 0 16px">$detail</p>
+<table style="border-collapse:collapse">$rows</table>
+<p style="margin:24px 0"><a href="$app_url">Open Doing It</a></p>
+<p style="color:#888;font-size:12px">You asked for a weekly summary.
+<a href="$unsubscribe_url" style="color:#888">Unsubscribe</a></p>
+</div>""")
+ROW = string.Template('<tr><td style="padding:2px 16px 2px 0">$name</td>'
+                      '<td style="text-align:right">$hours</td></tr>')
+TEXT = string.Template("""\
+$label: $total
+$detail
+
+$rows
+
+$app_url
+Unsubscribe: $unsubscribe_url
+""")
+
+
+def week_label(week: date) -> str:
+    end = week + timedelta(days=6)
+    if end.month == week.month:
+        return f"{week:%b} {week.day} – {end.day}"
+    return f"{week:%b} {week.day} – {end:%b} {end.day}"
+
+
+def _detail(summary: dict) -> str:
+    sessions = f"{summary['sessions']} session{'' if summary['sessions'] == 1 else 's'}"
+    diff = summary["total_ms"] - summary["previous_ms"]
+    if not summary["previous_ms"] or abs(diff) < 60_000:
+        return sessions
+    return f"{sessions}, {format_hours(abs(diff))} {'more' if diff > 0 else 'less'} than the week before"
+
+
+def render_digest(summary: dict, week: date, app_url: str, unsubscribe_url: str) -> dict:
+    """The email for one user's weekly_totals entry: subject, html and text."""
+    label, total, detail = week_label(week), format_hours(summary["total_ms"]), _detail(summary)
+    fields = {"label": label, "total": total, "detail": detail,
+              "app_url": app_url, "unsubscribe_url": unsubscribe_url}
+    return {
+        "subject": f"Your week: {total} ({label})",
+        "html": HTML.substitute(fields, rows="".join(
+            ROW.substitute(name=escape(name), hours=format_hours(ms)) for name, ms in summary["tasks"]
+        )),
+        "text": TEXT.substitute(fields, rows="\n".join(
+            f"{format_hours(ms):>6}  {name}" for name, ms in summary["tasks"]
+        )),
+    }
+
+
+# ── Sending ──────────────────────────────────────────────────────────────────
+
+class MailerError(Exception):
+    """Resend refused a batch, or it kept failing through the retries."""
+
+
+class DigestMailer:
+    """
+    Resend's /emails/batch through one pooled httpx.Client. Calls start at
+    least 1/rate seconds apart. Connection errors, 429 and 5xx are retried
+    `retries` times with the same Idempotency-Key. Between attempts it waits
+    for Retry-After when Resend sends one, else backoff, 2×backoff, and so on.
+    A 409 means Resend has already seen that key, so the batch went out before.
+    """
+
+    def __init__(self, api_key: str, api_base: str = "https://api.resend.com", rate: float = 2.0,
+                 retries: int = 3, backoff: float = 1.0, timeout: float = 15.0,
+                 sleep=time.sleep, clock=time.monotonic):
+        self.interval = 1 / rate
+        self.retries = retries
+        self.backoff = backoff
+        self.sleep = sleep
+        self.clock = clock
+        self._next = float("-inf")
+        self._http = httpx.Client(base_url=api_base, timeout=timeout,
+                                  headers={"Authorization": f"Bearer {api_key}"})
+
+    def _pace(self):
+        wait = self._next - self.clock()
+        if wait > 0:
+            self.sleep(wait)
+        self._next = self.clock() + self.interval
+
+    def send(self, emails: list[dict], key: str):
+        for attempt in range(self.retries + 1):
+            self._pace()
+            wait = None
+            try:
+                r = self._http.post("/emails/batch", json=emails, headers={"Idempotency-Key": key})
+            except httpx.TransportError as e:
+                error = f"{type(e).__name__}: {e}"
+            else:
+                if r.status_code < 300 or r.status_code == 409:
+                    return
+                error = f"{r.status_code} {r.text[:200]}"
+                if r.status_code != 429 and r.status_code < 500:
+                    raise MailerError(error)
+                try:
+                    wait = float(r.headers["retry-after"])
+                except (KeyError, ValueError):
+                    pass
+            if attempt < self.retries:
+                self.sleep(self.backoff * 2 ** attempt if wait is None else wait)
+        raise MailerError(f"gave up after {self.retries + 1} attempts: {error}")
+
+    def close(self):
+        self._http.close()
+
+
+class PreviewMailer:
+    """For --dry-run: prints the first email and counts the rest."""
+
+    def __init__(self, log=print):
+        self.log = log
+        self.emails = 0
+
+    def send(self, emails: list[dict], key: str):
+        if not self.emails:
+            self.log(f"[digest] first email, to {emails[0]['to'][0]}:\n{emails[0]['text']}")
+        self.emails += len(emails)
+
+    def close(self):
+        pass
+
+
+def batch_keys(primary, week: date, users: list[dict], store: bool = True) -> dict[int, str]:
+    """
+    The Idempotency-Key each of these users is sent under for `week`: the
+    one stored in users.digest_batch by an earlier attempt, else a new one
+    shared by the rest, stored (unless store is False) before anything is
+    sent.
+    """
+    prefix = f"digest-{week}-"
+    keys = {u["id"]: u["digest_batch"] for u in users if (u["digest_batch"] or "").startswith(prefix)}
+    new = [u["id"] for u in users if u["id"] not in keys]
+    if new:
+        key = f"{prefix}{new[0]}"  # a user holds one key per week, so no earlier batch started with them
+        keys.update(dict.fromkeys(new, key))
+        if store:
+            with primary.cursor() as cur:
+                cur.execute("UPDATE users SET digest_batch = %s WHERE id = ANY(%s)", (key, new))
+            primary.commit()
+    return keys
+
+
+def send_digests(primary, shards: list, mailer, week: date, sender: str, app_url: str, secret: str,
+                 batch: int = BATCH_MAX, mark: bool = True, log=print) -> dict:
+    """
+    Send the digest for `week` to every opted-in user not yet sent it.
+    primary and shards are connections (shards[0] is the primary). Users who
+    tracked no time that week are marked without an email. Returns counts of
+    sent, empty and failed.
+    """
+    counts = {"sent": 0, "empty": 0, "failed": 0}
+    started, after = time.monotonic(), 0
+    while True:
+        with primary.cursor() as cur:
+            cur.execute(USERS_SQL, {"after": after, "week": week, "limit": min(batch, BATCH_MAX)})
+            users = cur.fetchall()
+        primary.commit()
+        if not users:
+            break
+        after = users[-1]["id"]
+        homes: dict[int, list[int]] = {}
+        for user in users:
+            homes.setdefault(user["shard"], []).append(user["id"])
+        totals = {}
+        for shard, user_ids in homes.items():
+            with shards[shard].cursor() as cur:
+                totals.update(weekly_totals(cur, user_ids, week))
+            shards[shard].commit()
+
+        emails, recipients = [], []
+        for user in users:
+            summary = totals.get(user["id"])
+            if not summary or not summary["total_ms"]:
+                continue
+            recipients.append(user)
+            url = f"{app_url}/digest/unsubscribe?user={user['id']}&sig={unsubscribe_sig(secret, user['id'])}"
+            emails.append({
+                "from": sender, "to": [user["email"]], **render_digest(summary, week, app_url, url),
+                "headers": {"List-Unsubscribe": f"<{url}>", "List-Unsubscribe-Post": "List-Unsubscribe=One-Click"},
+            })
+        keys = batch_keys(primary, week, recipients, store=mark)
+        calls: dict[str, list[dict]] = {}
+        for user, email in zip(recipients, emails):
+            calls.setdefault(keys[user["id"]], []).append(email)
+        failed = set()
+        for key, batch_emails in calls.items():
+            try:
+                mailer.send(batch_emails, key)
+            except MailerError as e:
+                failed.add(key)
+                counts["failed"] += len(batch_emails)
+                log(f"[digest] users {users[0]['id']}..{after} ({key}): {e}; left for the next run")
+        if mark:
+            done = [user["id"] for user in users if keys.get(user["id"]) not in failed]
+            with primary.cursor() as cur:
+                cur.execute("UPDATE users SET digest_sent_for = %s WHERE id = ANY(%s)", (week, done))
+            primary.commit()
+        counts["sent"] += sum(len(batch_emails) for key, batch_emails in calls.items() if key not in failed)
+        counts["empty"] += len(users) - len(emails)
+    log(f"[digest] week of {week}: {counts['sent']} sent, {counts['empty']} without time tracked, "
+        f"{counts['failed']} failed, in {time.monotonic() - started:.1f} s")
+    return counts
@@ -0,0 +1,40 @@
+"""
+gunicorn.conf.py — production serving profile (the Dockerfile's CMD).
+
+The app is imported once in the master (preload_app) and forked into
+WEB_CONCURRENCY uvicorn workers, so the interpreter, FastAPI, Stripe,
+google-auth and the rest are shared copy-on-write instead of loaded per
+worker. Each worker then sizes its own threadpool and connection pool from
+the same env vars (see app.py: THREADPOOL_SIZE, DB_MAX_CONNECTIONS).
+
+Defaults fit the 256 MB VM in fly.toml; the README's "Serving profile"
+section has the measurements behind them.
+
+Usage:
+    gunicorn -c gunicorn.conf.py app:app
+    WEB_CONCURRENCY=3 THREADPOOL_SIZE=4 gunicorn -c gunicorn.conf.py app:app
+"""
+import gc
+import os
+
+# Set before app is imported so its pool sizing sees the same worker count.
+os.environ.setdefault("WEB_CONCURRENCY", "2")
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.environ["WEB_CONCURRENCY"])
+worker_class = "uvicorn_worker.UvicornWorker"
+preload_app = True
+
+timeout = 30
+graceful_timeout = 20
+keepalive = 5  # Fly's proxy keeps connections open; don't drop them between requests
+# Recycle workers now and then so heap fragmentation can't creep toward the VM limit.
+max_requests = 5000
+max_requests_jitter = 500
+
+
+def when_ready(server):
+    # Everything allocated so far is shared with the workers. Freezing it keeps
+    # the cyclic GC from writing to those pages and un-sharing them after fork.
+    gc.collect()
+    gc.freeze()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+loadtest.py — synthetic user population and traffic replay for load testing.
+
+`populate` creates N users with configurable history straight into the
+normalized tasks / sessions / later_items tables using COPY, reusing
+seed.py's session generator. `replay` drives a running server at a target
+request rate and reports latency percentiles and throughput per route.
+
+Point both at a local Postgres and server — never production.
+
+Usage:
+    python3 loadtest.py populate --users 500 --weeks 26
+    uvicorn app:app --port 8000 &
+    python3 loadtest.py replay --users 500 --rps 50 --duration 60
+    python3 loadtest.py clean
+"""
+import argparse, asyncio, csv, io, json, os, random, time, uuid
+from pathlib import Path
+
+from app import positions_between, rebuild_daily_totals
+from seed import EXISTING_SEEDS, SEED_TASKS, gen_sessions, past_weekdays
+
+EMAIL_DOMAIN = "loadtest.invalid"
+PASSWORD     = "loadtest-password"
+BATCH_USERS  = 100  # users buffered in memory per COPY round
+
+# Relative weights of each route in the replayed traffic.
+DEFAULT_MIX = {"get_data": 6, "post_data": 2, "session_start": 2, "login": 1}
+OK_STATUSES = {200, 204, 402}  # 402 = free-tier quota reached, a normal answer
+
+
+def email_for(i: int) -> str:
+    return f"load{i:06d}@{EMAIL_DOMAIN}"
+
+
+# ── Populate ───────────────────────────────────────────────────────────────────
+TASK_SPECS = SEED_TASKS + [{"name": name, **spec} for name, spec in EXISTING_SEEDS.items()]
+
+
+def _copy(cur, table: str, columns: list[str], rows: list[list]):
+    if not rows:
+        return
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buf)
+
+
+def _user_history(weeks: int, n_tasks: int):
+    """(tasks, sessions, later) rows for one user, minus the user_id column."""
+    days = past_weekdays(weeks)
+    tasks, sessions = [], []
+    for spec in random.sample(TASK_SPECS, min(n_tasks, len(TASK_SPECS))):
+        task_id = str(uuid.uuid4())
+        starts = set()
+        total_ms = count = 0
+        last = None
+        for d in days:
+            if random.random() > spec["freq"]:
+                continue
+            for s in gen_sessions(d, random.uniform(spec["min_h"], spec["max_h"])):
+                if s["start"] in starts:
+                    continue
+                starts.add(s["start"])
+                sessions.append([task_id, s["start"], s["end"]])
+                total_ms += s["end"] - s["start"]
+                count += 1
+                last = s["start"] if last is None else max(last, s["start"])
+        tasks.append([task_id, spec["name"], last if last is not None else "", total_ms, count])
+    n_later = random.randint(0, 5)
+    later = [[str(uuid.uuid4()), f"later item {j}", key]
+             for j, key in enumerate(positions_between(None, None, n_later))]
+    return tasks, sessions, later
+
+
+def populate(cur, users: int, weeks: int, tasks_per_user: int = 5) -> dict:
+    """
+    Create `users` load-test users (skipping ones that already exist) with
+    `weeks` of weekday history each. The session triggers are disabled for
+    the duration: per-task stats are written directly and the daily rollup is
+    rebuilt once at the end, so a large population loads at COPY speed. Run
+    this in its own transaction.
+    """
+    import bcrypt
+    password_hash = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt()).decode()
+    cur.execute("""
+        INSERT INTO users (email, password_hash)
+        SELECT e, %s FROM unnest(%s::text[]) AS e
+        ON CONFLICT (email) DO NOTHING
+        RETURNING id
+    """, (password_hash, [email_for(i) for i in range(users)]))
+    new_ids = [row["id"] for row in cur.fetchall()]
+
+    cur.execute("ALTER TABLE sessions DISABLE TRIGGER sessions_task_stats")
+    cur.execute("ALTER TABLE sessions DISABLE TRIGGER sessions_daily_totals")
+    totals = {"users": len(new_ids), "tasks": 0, "sessions": 0, "later_items": 0}
+    for start in range(0, len(new_ids), BATCH_USERS):
+        task_rows, session_rows, later_rows = [], [], []
+        for uid in new_ids[start:start + BATCH_USERS]:
+            tasks, sessions, later = _user_history(weeks, tasks_per_user)
+            task_rows += [[t[0], uid, *t[1:]] for t in tasks]
+            session_rows += [[s[0], uid, *s[1:]] for s in sessions]
+            later_rows += [[item[0], uid, *item[1:]] for item in later]
+        _copy(cur, "tasks", ["id", "user_id", "name", "last_started_at", "total_ms", "session_count"], task_rows)
+        _copy(cur, "sessions", ["task_id", "user_id", "start_ts", "end_ts"], session_rows)
+        _copy(cur, "later_items", ["id", "user_id", "text", "position"], later_rows)
+        totals["tasks"] += len(task_rows)
+        totals["sessions"] += len(session_rows)
+        totals["later_items"] += len(later_rows)
+    cur.execute("ALTER TABLE sessions ENABLE TRIGGER sessions_task_stats")
+    cur.execute("ALTER TABLE sessions ENABLE TRIGGER sessions_daily_totals")
+    rebuild_daily_totals(cur, new_ids)
+    cur.execute("ANALYZE tasks")
+    cur.execute("ANALYZE sessions")
+    return totals
+
+
+def clean(cur) -> int:
+    pattern = f"%@{EMAIL_DOMAIN}"
+    # These two reference users without ON DELETE CASCADE.
+    for table in ("user_data", "password_reset_tokens"):
+        cur.execute(
+            f"DELETE FROM {table} WHERE user_id IN (SELECT id FROM users WHERE email LIKE %s)",
+            (pattern,),
+        )
+    cur.execute("DELETE FROM users WHERE email LIKE %s", (pattern,))
+    return cur.rowcount
+
+
+# ── Replay ─────────────────────────────────────────────────────────────────────
+def percentile(samples: list[float], pct: float) -> float:
+    """Nearest-rank percentile; 0 for no samples."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, -(-len(ordered) * pct // 100))  # ceil
+    return ordered[int(rank) - 1]
+
+
+class Replayer:
+    """
+    Open-loop traffic generator: requests are scheduled at a fixed rate
+    whether or not earlier ones have finished, and latency is measured from
+    the scheduled time, so server queueing shows up in the percentiles
+    instead of silently lowering the offered load.
+    """
+
+    def __init__(self, client, users: int, mix: dict[str, int] = DEFAULT_MIX, concurrency: int = 64):
+        self.client = client
+        self.emails = [email_for(i) for i in range(users)]
+        self.mix = mix
+        self.tokens: dict[str, str] = {}
+        self.docs: dict[str, dict] = {}
+        self.latencies: dict[str, list[float]] = {route: [] for route in mix}
+        self.errors: dict[str, int] = {route: 0 for route in mix}
+        self.limit = asyncio.Semaphore(concurrency)
+
+    async def _login(self, email: str):
+        r = await self.client.post("/auth/login", json={"email": email, "password": PASSWORD})
+        if r.status_code == 200:
+            self.tokens[email] = r.json()["token"]
+        return r
+
+    def _headers(self, email: str) -> dict:
+        return {"Authorization": f"Bearer {self.tokens[email]}"}
+
+    async def _get_data(self, email):
+        r = await self.client.get("/data", headers=self._headers(email))
+        if r.status_code == 200:
+            self.docs[email] = r.json()
+        return r
+
+    async def _post_data(self, email):
+        doc = self.docs.get(email)
+        if doc is None:
+            await self._get_data(email)
+            doc = self.docs.get(email, {"tasks": [], "later": []})
+        if not doc["tasks"]:
+            doc["tasks"].append({"id": str(uuid.uuid4()), "name": "load test", "sessions": []})
+        now = int(time.time() * 1000)
+        doc["tasks"][0]["sessions"].append({"start": now, "end": now + 60_000})
+        return await self.client.post("/data", content=json.dumps(doc), headers=self._headers(email))
+
+    async def _session_start(self, email):
+        return await self.client.post("/sessions/start", headers=self._headers(email))
+
+    async def _request(self, route: str, email: str, scheduled: float):
+        handler = {"get_data": self._get_data, "post_data": self._post_data,
+                   "session_start": self._session_start, "login": self._login}[route]
+        async with self.limit:
+            try:
+                r = await handler(email)
+                ok = r.status_code in OK_STATUSES
+            except Exception:
+                ok = False
+        self.latencies[route].append(time.perf_counter() - scheduled)
+        if not ok:
+            self.errors[route] += 1
+
+    async def run(self, rps: float, duration: float) -> dict:
+        # Warm-up logins are not measured.
+        await asyncio.gather(*(self._login(email) for email in self.emails))
+        emails = [e for e in self.emails if e in self.tokens]
+        if not emails:
+            raise SystemExit("No load-test user could log in — run `loadtest.py populate` first")
+        routes, weights = zip(*self.mix.items())
+        pending = []
+        start = time.perf_counter()
+        for k in range(int(rps * duration)):
+            scheduled = start + k / rps
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            route = random.choices(routes, weights)[0]
+            pending.append(asyncio.create_task(self._request(route, random.choice(emails), scheduled)))
+        await asyncio.gather(*pending)
+        return self.report(time.perf_counter() - start)
+
+    def report(self, elapsed: float) -> dict:
+        return {
+            route: {
+                "requests": len(samples),
+                "errors": self.errors[route],
+                "rps": round(len(samples) / elapsed, 1) if elapsed else 0.0,
+                "p50_ms": round(percentile(samples, 50) * 1000, 1),
+                "p95_ms": round(percentile(samples, 95) * 1000, 1),
+                "p99_ms": round(percentile(samples, 99) * 1000, 1),
+            }
+            for route, samples in self.latencies.items()
+        }
+
+
+def print_report(report: dict):
+    print(f"  {'route':<14} {'reqs':>6} {'errs':>5} {'rps':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for route, r in report.items():
+        print(f"  {route:<14} {r['requests']:>6} {r['errors']:>5} {r['rps']:>7} "
+              f"{r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8}")
+
+
+def parse_mix(value: str) -> dict[str, int]:
+    mix = {}
+    for part in value.split(","):
+        route, _, weight = part.partition("=")
+        if route not in DEFAULT_MIX or not weight.isdigit():
+            raise argparse.ArgumentTypeError(f"expected route=weight with route in {', '.join(DEFAULT_MIX)}")
+        mix[route] = int(weight)
+    return mix
+
+
+# ── Main ───────────────────────────────────────────────────────────────────────
+def main():
+    # load .env before parsing so DATABASE_URL is available as a default
+    env_file = Path(__file__).parent / ".env"
+    if env_file.exists():
+        for line in env_file.read_text().splitlines():
+            if "=" in line and not line.startswith("#"):
+                k, v = line.split("=", 1)
+                os.environ.setdefault(k.strip(), v.strip())
+
+    parser = argparse.ArgumentParser(description="Doing It load testing")
+    parser.add_argument("--db", default=os.getenv("DATABASE_URL"),
+                        help="Postgres URL (default: DATABASE_URL from .env)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("populate", help="create synthetic users with history via COPY")
+    p.add_argument("--users", type=int, default=100)
+    p.add_argument("--weeks", type=int, default=12, help="weeks of weekday history per user")
+    p.add_argument("--tasks", type=int, default=5, help="tasks per user")
+    p.add_argument("--seed", type=int, default=42)
+    sub.add_parser("clean", help="delete every load-test user and their data")
+    p = sub.add_parser("replay", help="drive a running server at a target request rate")
+    p.add_argument("--base-url", default="http://localhost:8000")
+    p.add_argument("--users", type=int, default=100, help="how many populated users to spread load over")
+    p.add_argument("--rps", type=float, default=20)
+    p.add_argument("--duration", type=float, default=30, help="seconds")
+    p.add_argument("--concurrency", type=int, default=64, help="max in-flight requests")
+    p.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                   help="route weights, e.g. get_data=6,post_data=2,session_start=2,login=1")
+    p.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    if args.command == "replay":
+        import httpx
+
+        async def go():
+            limits = httpx.Limits(max_connections=args.concurrency)
+            async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=30) as client:
+                return await Replayer(client, args.users, args.mix, args.concurrency).run(args.rps, args.duration)
+
+        report = asyncio.run(go())
+        if args.json:
+            print(json.dumps(report, indent=2))
+        else:
+            print_report(report)
+        return
+
+    if not args.db:
+        parser.error("No database URL — pass --db or set DATABASE_URL in .env")
+
+    import psycopg2
+    import psycopg2.extras
+
+    with psycopg2.connect(args.db, cursor_factory=psycopg2.extras.RealDictCursor) as conn:
+        with conn.cursor() as cur:
+            if args.command == "populate":
+                random.seed(args.seed)
+                t0 = time.perf_counter()
+                totals = populate(cur, args.users, args.weeks, args.tasks)
+                print(f"Created {totals['users']} users, {totals['tasks']} tasks, "
+                      f"{totals['sessions']} sessions, {totals['later_items']} later items "
+                      f"in {time.perf_counter() - t0:.1f}s")
+            elif args.command == "clean":
+                print(f"Deleted {clean(cur)} load-test users")
+        conn.commit()
+
+if __name__ == "__main__":
+    main()
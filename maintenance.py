@@ -0,0 +1,712 @@
+#!/usr/bin/env python3
+"""
+maintenance.py — database housekeeping.
+
+sessions can be range-partitioned by month on start_ts. Hot-path queries
+(count_today_sessions, per-task sync in POST /data) then only touch recent
+partitions, and whole old months can be moved into the compact
+sessions_archive table, where GET /data?history=full still finds them.
+
+Usage:
+    python3 maintenance.py partition             # one-time: convert sessions to monthly partitions
+    python3 maintenance.py ensure --ahead 3      # create partitions for this month + 3 ahead
+    python3 maintenance.py archive --before 2025-01
+    python3 maintenance.py compact-keys [--uuid-task-ids] [--dry-run]
+    python3 maintenance.py export [--email you@example.com] [--format csv] > dump
+    python3 maintenance.py rollup [--verify]
+    python3 maintenance.py housekeep [--blob-days 180]
+    python3 maintenance.py rebalance --email you@example.com --to 2
+    python3 maintenance.py rebalance --status
+    python3 maintenance.py digest [--week 2025-06-02] [--dry-run]
+
+Run `ensure` from a monthly cron (or before each deploy). Rows that land
+outside every partition go to sessions_default and are moved into their
+month's partition when `ensure` creates it.
+
+`housekeep` purges expired reset tokens, stale rollback blobs, finished
+import jobs and idle rate-limit buckets in batches, repairs drifted daily
+rollups and vacuums/analyzes sessions and tasks where needed. The app also
+runs it in the background every MAINTENANCE_INTERVAL_HOURS; there the rollup
+check covers only users who saved or imported since the last run, and
+`rollup --verify` or this command checks everyone.
+
+With DATABASE_SHARD_URLS set, --db is the primary for `rebalance` and the
+account lookups; point the other commands at each shard in turn (a shard
+knows the emails of the users homed there). `rebalance` moves one user's
+rows to another shard while the app keeps serving them (see shards.py).
+
+`digest` emails last week's summary to the users who opted in, in paced
+batches through Resend (see digest.py). Run it weekly, on Mondays after
+12:00 UTC, from a process of its own; a rerun sends only what is left.
+"""
+import argparse, os, re, sys, time, uuid
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+
+MONTH_PARTITION = re.compile(r"^sessions_p(\d{4})_(\d{2})$")
+
+
+# ── Month helpers (UTC, millisecond bounds to match start_ts) ─────────────────
+def add_months(year: int, month: int, n: int) -> tuple[int, int]:
+    idx = year * 12 + (month - 1) + n
+    return idx // 12, idx % 12 + 1
+
+def month_start_ms(year: int, month: int) -> int:
+    return int(datetime(year, month, 1, tzinfo=timezone.utc).timestamp() * 1000)
+
+def month_of(ms: int) -> tuple[int, int]:
+    d = datetime.fromtimestamp(ms / 1000, tz=timezone.utc)
+    return d.year, d.month
+
+def current_month() -> tuple[int, int]:
+    now = datetime.now(timezone.utc)
+    return now.year, now.month
+
+def partition_name(year: int, month: int) -> str:
+    return f"sessions_p{year:04d}_{month:02d}"
+
+
+# ── Partition management ───────────────────────────────────────────────────────
+def is_partitioned(cur) -> bool:
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = 'sessions'::regclass")
+    return cur.fetchone()["relkind"] == "p"
+
+
+def month_partitions(cur) -> list[tuple[int, int]]:
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'sessions'::regclass
+    """)
+    months = []
+    for row in cur.fetchall():
+        m = MONTH_PARTITION.match(row["relname"])
+        if m:
+            months.append((int(m.group(1)), int(m.group(2))))
+    return sorted(months)
+
+
+def _create_partition(cur, parent: str, year: int, month: int):
+    lo = month_start_ms(year, month)
+    hi = month_start_ms(*add_months(year, month, 1))
+    cur.execute(
+        f"CREATE TABLE {partition_name(year, month)} PARTITION OF {parent} "
+        f"FOR VALUES FROM ({lo}) TO ({hi})"
+    )
+
+
+def partition_sessions(cur, ahead: int = 3) -> int:
+    """
+    Convert the plain sessions heap into a monthly range-partitioned table.
+
+    Copies every row, then re-adds constraints and (via create_schema) the
+    sessions_user_start index and the task-stats trigger. The trigger is
+    created after the copy so task totals are not counted twice.
+    Returns the number of partitions created.
+    """
+    if is_partitioned(cur):
+        return 0
+    from app import create_schema
+
+    cur.execute("LOCK TABLE sessions IN ACCESS EXCLUSIVE MODE")
+    cur.execute("SELECT MIN(start_ts) AS lo FROM sessions")
+    lo = cur.fetchone()["lo"]
+    first = month_of(lo) if lo is not None else current_month()
+    last = add_months(*current_month(), ahead)
+
+    cur.execute(
+        "CREATE TABLE sessions_partitioned (LIKE sessions INCLUDING DEFAULTS) "
+        "PARTITION BY RANGE (start_ts)"
+    )
+    cur.execute("CREATE TABLE sessions_default PARTITION OF sessions_partitioned DEFAULT")
+    created, ym = 0, first
+    while ym <= last:
+        _create_partition(cur, "sessions_partitioned", *ym)
+        created += 1
+        ym = add_months(*ym, 1)
+
+    cur.execute("INSERT INTO sessions_partitioned SELECT * FROM sessions")
+    cur.execute("DROP TABLE sessions")
+    cur.execute("ALTER TABLE sessions_partitioned RENAME TO sessions")
+    # Partitioned unique constraints must include the partition key.
+    if has_surrogate_session_id(cur):
+        cur.execute("ALTER TABLE sessions ADD PRIMARY KEY (id, start_ts)")
+        cur.execute("ALTER TABLE sessions ADD UNIQUE (task_id, user_id, start_ts)")
+    else:
+        cur.execute("ALTER TABLE sessions ADD PRIMARY KEY (task_id, user_id, start_ts)")
+    cur.execute(
+        "ALTER TABLE sessions ADD FOREIGN KEY (task_id, user_id) "
+        "REFERENCES tasks(id, user_id) ON DELETE CASCADE"
+    )
+    create_schema(cur)
+    return created
+
+
+def ensure_partitions(cur, ahead: int = 3) -> list[str]:
+    """Create any missing partitions from this month through `ahead` months out."""
+    if not is_partitioned(cur):
+        raise SystemExit("sessions is not partitioned — run `maintenance.py partition` first")
+    existing = set(month_partitions(cur))
+    created = []
+    ym, last = current_month(), add_months(*current_month(), ahead)
+    while ym <= last:
+        if ym not in existing:
+            lo = month_start_ms(*ym)
+            hi = month_start_ms(*add_months(*ym, 1))
+            # Postgres refuses to add a partition whose range has rows in the
+            # default partition, so park them and re-insert through the parent.
+            # Delete + insert both fire the stats trigger, so totals net out.
+            cur.execute(
+                "CREATE TEMP TABLE _moving ON COMMIT DROP AS "
+                "SELECT * FROM sessions_default WHERE start_ts >= %s AND start_ts < %s",
+                (lo, hi),
+            )
+            cur.execute(
+                "DELETE FROM sessions_default WHERE start_ts >= %s AND start_ts < %s",
+                (lo, hi),
+            )
+            _create_partition(cur, "sessions", *ym)
+            cur.execute("INSERT INTO sessions SELECT * FROM _moving")
+            cur.execute("DROP TABLE _moving")
+            created.append(partition_name(*ym))
+        ym = add_months(*ym, 1)
+    return created
+
+
+def archive_sessions(cur, before: tuple[int, int]) -> list[str]:
+    """
+    Detach every monthly partition older than `before` and fold its rows into
+    sessions_archive (one row per user, task and month), then drop it.
+
+    Detaching fires no row triggers, so tasks.total_ms / session_count keep
+    counting archived time. Rows in sessions_default stay hot.
+    """
+    if not is_partitioned(cur):
+        raise SystemExit("sessions is not partitioned — run `maintenance.py partition` first")
+    if before > current_month():
+        raise SystemExit("refusing to archive the current month or later")
+    archived = []
+    for ym in month_partitions(cur):
+        if ym >= before:
+            continue
+        name = partition_name(*ym)
+        cur.execute(f"ALTER TABLE sessions DETACH PARTITION {name}")
+        cur.execute(f"""
+            INSERT INTO sessions_archive (user_id, task_id, month_start, starts, ends)
+            SELECT user_id, task_id, %s,
+                   array_agg(start_ts ORDER BY start_ts),
+                   array_agg(end_ts   ORDER BY start_ts)
+            FROM {name}
+            GROUP BY user_id, task_id
+            ON CONFLICT (user_id, task_id, month_start) DO UPDATE SET
+                starts = sessions_archive.starts || EXCLUDED.starts,
+                ends   = sessions_archive.ends   || EXCLUDED.ends
+        """, (month_start_ms(*ym),))
+        cur.execute(f"DROP TABLE {name}")
+        archived.append(name)
+    cur.execute("""
+        INSERT INTO app_state (key, value) VALUES ('sessions_archived_before', %s)
+        ON CONFLICT (key) DO UPDATE SET value = GREATEST(app_state.value::bigint, EXCLUDED.value::bigint)::text
+    """, (str(month_start_ms(*before)),))
+    return archived
+
+
+# ── Key layout ─────────────────────────────────────────────────────────────────
+UUID_RE = "^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$"
+
+
+def has_surrogate_session_id(cur) -> bool:
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'sessions' AND column_name = 'id'
+    """)
+    return cur.fetchone() is not None
+
+
+def column_type(cur, table: str, column: str) -> str:
+    cur.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_name = %s AND column_name = %s
+    """, (table, column))
+    return cur.fetchone()["data_type"]
+
+
+def measure(cur, probe_rows: int = 2000) -> dict:
+    """
+    Size of sessions (summed over partitions) and the upsert rate of the
+    statement POST /data uses. The rate is probed against an empty temp copy
+    with the same columns and indexes, so the real table is never written.
+    """
+    from app import UPSERT_SESSION_SQL
+
+    cur.execute("""
+        SELECT COALESCE(SUM(pg_table_size(relid)), 0)   AS table_bytes,
+               COALESCE(SUM(pg_indexes_size(relid)), 0) AS index_bytes
+        FROM (SELECT relid FROM pg_partition_tree('sessions')
+              UNION SELECT 'sessions'::regclass) t
+    """)
+    sizes = cur.fetchone()
+    cur.execute("CREATE TEMP TABLE _probe (LIKE sessions INCLUDING ALL)")
+    sql = UPSERT_SESSION_SQL.replace("sessions", "_probe")
+    task_id = str(uuid.uuid4())
+    base = month_start_ms(*current_month())
+    t0 = time.perf_counter()
+    for i in range(probe_rows):
+        cur.execute(sql, (task_id, 1, base + i * 1000, base + i * 1000 + 500))
+    elapsed = time.perf_counter() - t0
+    cur.execute("DROP TABLE _probe")
+    return {
+        "table_bytes": int(sizes["table_bytes"]),
+        "index_bytes": int(sizes["index_bytes"]),
+        "upserts_per_s": round(probe_rows / elapsed),
+    }
+
+
+def compact_keys(cur, uuid_task_ids: bool = False) -> list[str]:
+    """
+    Move sessions to the compact key layout:
+
+    - drop the surrogate TEXT id (and its index) and make the natural key
+      (task_id, user_id, start_ts) the primary key, replacing the separate
+      UNIQUE constraint — one index instead of two
+    - with uuid_task_ids, convert tasks.id and every column referencing it
+      to native uuid (16 bytes instead of 37), provided all ids parse
+
+    Returns a description of each step applied; already-compact layouts are
+    left alone. Dropping a column does not rewrite the heap, so without
+    --uuid-task-ids run `VACUUM FULL sessions` afterwards to reclaim its bytes.
+    """
+    steps = []
+    cur.execute("LOCK TABLE tasks, sessions IN ACCESS EXCLUSIVE MODE")
+    if has_surrogate_session_id(cur):
+        cur.execute("""
+            SELECT conname FROM pg_constraint
+            WHERE conrelid = 'sessions'::regclass AND contype IN ('p', 'u')
+        """)
+        for row in cur.fetchall():
+            cur.execute(f"ALTER TABLE sessions DROP CONSTRAINT {row['conname']}")
+        cur.execute("ALTER TABLE sessions DROP COLUMN id")
+        cur.execute("ALTER TABLE sessions ADD PRIMARY KEY (task_id, user_id, start_ts)")
+        steps.append("sessions: dropped surrogate id, primary key is (task_id, user_id, start_ts)")
+
+    if uuid_task_ids and column_type(cur, "tasks", "id") != "uuid":
+        cur.execute("SELECT COUNT(*) AS n FROM tasks WHERE id !~* %s", (UUID_RE,))
+        bad = cur.fetchone()["n"]
+        if bad:
+            raise SystemExit(f"{bad} task ids are not UUIDs — leaving tasks.id as TEXT")
+        # Foreign keys must be dropped while both sides change type. Only the
+        # parent constraint is dropped on partitioned tables; partitions follow.
+        cur.execute("""
+            SELECT c.conname, c.conrelid::regclass::text AS rel, a.attname,
+                   pg_get_constraintdef(c.oid) AS def
+            FROM pg_constraint c
+            JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = c.conkey[1]
+            WHERE c.confrelid = 'tasks'::regclass AND c.contype = 'f' AND c.conparentid = 0
+        """)
+        fks = cur.fetchall()
+        for fk in fks:
+            cur.execute(f"ALTER TABLE {fk['rel']} DROP CONSTRAINT {fk['conname']}")
+        cur.execute("ALTER TABLE tasks ALTER COLUMN id TYPE uuid USING id::uuid")
+        for fk in fks:
+            cur.execute(
+                f"ALTER TABLE {fk['rel']} ALTER COLUMN {fk['attname']} "
+                f"TYPE uuid USING {fk['attname']}::uuid"
+            )
+        for fk in fks:
+            cur.execute(f"ALTER TABLE {fk['rel']} ADD CONSTRAINT {fk['conname']} {fk['def']}")
+        steps.append("tasks.id and " + ", ".join(f"{fk['rel']}.{fk['attname']}" for fk in fks)
+                     + " converted to uuid")
+    return steps
+
+
+def export(conn, cur, args):
+    """Admin dump through the same streaming path as GET /export."""
+    from contextlib import nullcontext
+    from app import utc_day_start_ms, export_stream
+
+    user_id = None
+    if args.email:
+        cur.execute("SELECT id FROM users WHERE lower(email) = lower(%s)", (args.email.strip(),))
+        row = cur.fetchone()
+        if not row:
+            raise SystemExit(f"No user found with email: {args.email}")
+        user_id = row["id"]
+    since_ms = utc_day_start_ms(args.since) if args.since else None
+    until_ms = utc_day_start_ms(args.until + timedelta(days=1)) if args.until else None
+    for chunk in export_stream(lambda: nullcontext(conn), args.format, user_id, since_ms, until_ms):
+        sys.stdout.write(chunk)
+
+
+def rollup(cur, args):
+    """Backfill or check daily_task_totals; --verify exits non-zero on any mismatch."""
+    from app import rebuild_daily_totals, verify_daily_totals
+
+    user_ids = None
+    if args.email:
+        cur.execute("SELECT id FROM users WHERE lower(email) = lower(%s)", (args.email.strip(),))
+        row = cur.fetchone()
+        if not row:
+            raise SystemExit(f"No user found with email: {args.email}")
+        user_ids = [row["id"]]
+    if not args.verify:
+        print(f"Rebuilt {rebuild_daily_totals(cur, user_ids)} daily totals")
+        return
+    mismatches = verify_daily_totals(cur, user_ids)
+    for m in mismatches[:20]:
+        print(f"user {m['user_id']} {m['day']} task {m['task_id']}: "
+              f"stored {m['stored_ms']} ms / {m['stored_count']}, "
+              f"expected {m['expected_ms']} ms / {m['expected_count']}")
+    if mismatches:
+        raise SystemExit(f"{len(mismatches)} daily totals out of date — run without --verify to rebuild")
+    print("Daily totals match sessions")
+
+
+def rebalance(cur, args):
+    """Move one user to shard --to, or with --status print users per shard."""
+    from shards import MoveRefused, move_user, shard_counts
+
+    urls = [args.db, *[u.strip() for u in args.shards.split(",") if u.strip()]]
+    if args.status:
+        for shard, n in enumerate(shard_counts(args.db, len(urls))):
+            print(f"shard {shard}: {n} users")
+        return
+    if not args.email or args.to is None:
+        raise SystemExit("rebalance needs --email and --to (or --status)")
+    cur.execute("SELECT id FROM users WHERE lower(email) = lower(%s)", (args.email.strip(),))
+    row = cur.fetchone()
+    if not row:
+        raise SystemExit(f"No user found with email: {args.email}")
+    cur.connection.commit()
+    try:
+        if move_user(urls, row["id"], args.to) is None:
+            print(f"{args.email} already lives on shard {args.to}")
+    except MoveRefused as e:
+        raise SystemExit(str(e))
+
+
+def digest(args):
+    """Send the weekly digest for --week (default: the last week that is over everywhere)."""
+    import psycopg2
+    import psycopg2.extras
+    from app import APP_URL, RESEND_API_KEY, RESEND_FROM, SECRET_KEY
+    from digest import BATCH_MAX, DigestMailer, PreviewMailer, digest_week, send_digests
+
+    week = args.week or digest_week()
+    if week.weekday() != 0:
+        raise SystemExit("--week must be a Monday")
+    if not args.dry_run and not RESEND_API_KEY:
+        raise SystemExit("RESEND_API_KEY is not set (use --dry-run to preview)")
+    urls = [args.db, *[u.strip() for u in args.shards.split(",") if u.strip()]]
+    conns = [psycopg2.connect(url, cursor_factory=psycopg2.extras.RealDictCursor) for url in urls]
+    mailer = PreviewMailer() if args.dry_run else DigestMailer(
+        RESEND_API_KEY, api_base=os.getenv("RESEND_API_BASE", "https://api.resend.com"), rate=args.rate
+    )
+    try:
+        send_digests(conns[0], conns, mailer, week, RESEND_FROM, APP_URL, SECRET_KEY,
+                     batch=min(args.batch, BATCH_MAX), mark=not args.dry_run)
+    finally:
+        mailer.close()
+        for conn in conns:
+            conn.close()
+
+
+def print_measurements(before: dict, after: dict):
+    print(f"  {'':<14} {'before':>12} {'after':>12}")
+    for key in ("table_bytes", "index_bytes", "upserts_per_s"):
+        print(f"  {key:<14} {before[key]:>12,} {after[key]:>12,}")
+
+
+# ── Housekeeping ───────────────────────────────────────────────────────────────
+# Session-level advisory lock: with several app instances (and maybe a cron),
+# only the holder runs housekeeping; the rest skip.
+HOUSEKEEPING_LOCK = 7_447_001
+BLOB_RETENTION_DAYS = 180
+IMPORT_JOB_RETENTION_DAYS = 30
+
+
+def _delete_in_batches(cur, sql: str, params: dict, batch: int) -> int:
+    """Repeat a DELETE ... LIMIT %(batch)s until it runs dry; on an autocommit
+    connection each batch is its own short transaction."""
+    total = 0
+    while True:
+        cur.execute(sql, {**params, "batch": batch})
+        total += cur.rowcount
+        if cur.rowcount < batch:
+            return total
+
+
+def purge_reset_tokens(cur, batch: int = 1000) -> int:
+    return _delete_in_batches(cur, """
+        DELETE FROM password_reset_tokens WHERE token IN (
+            SELECT token FROM password_reset_tokens WHERE expires_at < NOW() LIMIT %(batch)s
+        )
+    """, {}, batch)
+
+
+def prune_rollback_blobs(cur, days: int = BLOB_RETENTION_DAYS, batch: int = 1000) -> int:
+    """Drop Plan B blobs of migrated users who haven't saved in `days`."""
+    return _delete_in_batches(cur, """
+        DELETE FROM user_data WHERE user_id IN (
+            SELECT user_id FROM user_data
+            WHERE migrated_at IS NOT NULL AND updated_at < NOW() - make_interval(days => %(days)s)
+            LIMIT %(batch)s
+        )
+    """, {"days": days}, batch)
+
+
+def purge_orphan_sessions(cur, batch: int = 1000) -> int:
+    """Sessions whose task is gone. Only possible on databases whose sessions
+    table predates the foreign key, so it is skipped when the key exists."""
+    cur.execute("""
+        SELECT 1 FROM pg_constraint
+        WHERE conrelid = 'sessions'::regclass AND confrelid = 'tasks'::regclass AND contype = 'f'
+    """)
+    if cur.fetchone() is not None:
+        return 0
+    return _delete_in_batches(cur, """
+        DELETE FROM sessions WHERE (task_id, user_id, start_ts) IN (
+            SELECT s.task_id, s.user_id, s.start_ts FROM sessions s
+            WHERE NOT EXISTS (SELECT 1 FROM tasks t WHERE t.id = s.task_id AND t.user_id = s.user_id)
+            LIMIT %(batch)s
+        )
+    """, {}, batch)
+
+
+def purge_stale_rows(cur, batch: int = 1000) -> int:
+    """Finished import jobs past retention, interrupted ones, and idle rate-limit buckets."""
+    # An import whose worker died stays parsing or merging; marking it failed
+    # lets it expire and unblocks `rebalance` for its user.
+    cur.execute("""
+        UPDATE import_jobs SET status = 'failed', error = 'interrupted', finished_at = NOW()
+        WHERE status NOT IN ('done', 'failed') AND created_at < NOW() - INTERVAL '1 day'
+    """)
+    n = cur.rowcount
+    n += _delete_in_batches(cur, """
+        DELETE FROM import_jobs WHERE id IN (
+            SELECT id FROM import_jobs
+            WHERE finished_at < NOW() - make_interval(days => %(days)s) LIMIT %(batch)s
+        )
+    """, {"days": IMPORT_JOB_RETENTION_DAYS}, batch)
+    # Every bucket refills within a day, so older rows carry no state.
+    n += _delete_in_batches(cur, """
+        DELETE FROM rate_limit_buckets WHERE key IN (
+            SELECT key FROM rate_limit_buckets
+            WHERE updated_at < extract(epoch FROM NOW()) - 86400 LIMIT %(batch)s
+        )
+    """, {}, batch)
+    return n
+
+
+def refresh_rollups(cur, since: float | None = None) -> int:
+    """
+    Rebuild daily_task_totals for users whose rollup drifted; returns how
+    many. With `since` (epoch seconds), only users who saved or finished an
+    import after it are checked, rather than every session in the database.
+    """
+    from app import rebuild_daily_totals, verify_daily_totals
+
+    if since is None:
+        checked = None
+    else:
+        cur.execute("""
+            SELECT user_id FROM user_data WHERE updated_at > to_timestamp(%(since)s)
+            UNION SELECT user_id FROM import_jobs WHERE finished_at > to_timestamp(%(since)s)
+        """, {"since": since})
+        checked = [r["user_id"] for r in cur.fetchall()]
+        if not checked:
+            return 0
+    user_ids = sorted({m["user_id"] for m in verify_daily_totals(cur, checked)})
+    if user_ids:
+        rebuild_daily_totals(cur, user_ids)
+    return len(user_ids)
+
+
+def vacuum_analyze(cur, min_changed: int = 1000, ratio: float = 0.1) -> list[str]:
+    """
+    VACUUM (ANALYZE) the sessions partitions and tasks when dead tuples pass
+    max(min_changed, ratio * live rows); plain ANALYZE when only the
+    statistics are stale. Needs an autocommit connection.
+    """
+    cur.execute("""
+        SELECT s.relid::regclass::text AS rel, s.n_live_tup, s.n_dead_tup, s.n_mod_since_analyze
+        FROM pg_stat_user_tables s
+        WHERE s.relid IN (
+            SELECT relid FROM pg_partition_tree('sessions') WHERE isleaf
+            UNION SELECT 'sessions'::regclass
+            UNION SELECT 'tasks'::regclass
+        )
+        ORDER BY 1
+    """)
+    actions = []
+    for t in cur.fetchall():
+        threshold = max(min_changed, ratio * t["n_live_tup"])
+        if t["n_dead_tup"] >= threshold:
+            cur.execute(f"VACUUM (ANALYZE) {t['rel']}")
+            actions.append(f"vacuum {t['rel']}")
+        elif t["n_mod_since_analyze"] >= threshold:
+            cur.execute(f"ANALYZE {t['rel']}")
+            actions.append(f"analyze {t['rel']}")
+    return actions
+
+
+def housekeep(cur, blob_days: int = BLOB_RETENTION_DAYS, batch: int = 1000,
+              min_interval_hours: float | None = None, full_rollup_check: bool = True,
+              log=print) -> list[dict] | None:
+    """
+    Run every housekeeping step under HOUSEKEEPING_LOCK, logging rows and
+    time per step. Returns the per-step stats, or None if another process
+    holds the lock or (with min_interval_hours) the last run is too recent.
+    VACUUM is skipped unless the connection is in autocommit mode. Without
+    full_rollup_check, only users active since the last run (or the last
+    day, on the first run) have their rollup checked.
+    """
+    cur.execute("SELECT pg_try_advisory_lock(%s) AS ok", (HOUSEKEEPING_LOCK,))
+    if not cur.fetchone()["ok"]:
+        log("[maintenance] another instance is running housekeeping; skipped")
+        return None
+    try:
+        cur.execute("SELECT value FROM app_state WHERE key = 'housekeeping_last_run'")
+        row = cur.fetchone()
+        last_run = float(row["value"]) if row else None
+        if min_interval_hours is not None and last_run and time.time() - last_run < min_interval_hours * 3600:
+            return None
+        since = None if full_rollup_check else (last_run or time.time() - 86400)
+        steps = [
+            ("expired reset tokens", lambda: purge_reset_tokens(cur, batch)),
+            ("stale rollback blobs", lambda: prune_rollback_blobs(cur, blob_days, batch)),
+            ("orphaned sessions", lambda: purge_orphan_sessions(cur, batch)),
+            ("stale jobs and buckets", lambda: purge_stale_rows(cur, batch)),
+            ("rollup users rebuilt", lambda: refresh_rollups(cur, since)),
+        ]
+        if cur.connection.autocommit:
+            steps.append(("vacuum/analyze", lambda: vacuum_analyze(cur)))
+        stats = []
+        for name, step in steps:
+            t0 = time.perf_counter()
+            result = step()
+            elapsed = time.perf_counter() - t0
+            shown = (", ".join(result) or "nothing to do") if isinstance(result, list) else result
+            log(f"[maintenance] {name}: {shown} ({elapsed:.2f}s)")
+            stats.append({"step": name, "result": result, "seconds": round(elapsed, 3)})
+        cur.execute("""
+            INSERT INTO app_state (key, value) VALUES ('housekeeping_last_run', %s)
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+        """, (str(time.time()),))
+        return stats
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (HOUSEKEEPING_LOCK,))
+
+
+# ── Main ───────────────────────────────────────────────────────────────────────
+def parse_month(value: str) -> tuple[int, int]:
+    try:
+        d = datetime.strptime(value, "%Y-%m")
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected YYYY-MM")
+    return d.year, d.month
+
+
+def main():
+    # load .env before parsing so DATABASE_URL is available as a default
+    env_file = Path(__file__).parent / ".env"
+    if env_file.exists():
+        for line in env_file.read_text().splitlines():
+            if "=" in line and not line.startswith("#"):
+                k, v = line.split("=", 1)
+                os.environ.setdefault(k.strip(), v.strip())
+
+    parser = argparse.ArgumentParser(description="Doing It database maintenance")
+    parser.add_argument("--db", default=os.getenv("DATABASE_URL"),
+                        help="Postgres URL (default: DATABASE_URL from .env)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("partition", help="convert sessions to monthly range partitions")
+    p.add_argument("--ahead", type=int, default=3, help="future months to pre-create")
+    p = sub.add_parser("ensure", help="create upcoming monthly partitions")
+    p.add_argument("--ahead", type=int, default=3, help="future months to pre-create")
+    p = sub.add_parser("archive", help="move whole months before YYYY-MM into sessions_archive")
+    p.add_argument("--before", type=parse_month, required=True, help="first month to keep hot (YYYY-MM)")
+    p = sub.add_parser("compact-keys", help="drop the surrogate session id; optionally uuid task ids")
+    p.add_argument("--uuid-task-ids", action="store_true", help="convert task ids to native uuid")
+    p.add_argument("--dry-run", action="store_true", help="measure and roll back")
+    p = sub.add_parser("export", help="stream sessions to stdout (all users unless --email)")
+    p.add_argument("--email", help="only this user")
+    p.add_argument("--format", choices=["csv", "ndjson", "columns"], default="ndjson")
+    p.add_argument("--since", type=date.fromisoformat, help="first UTC day (YYYY-MM-DD)")
+    p.add_argument("--until", type=date.fromisoformat, help="last UTC day (YYYY-MM-DD)")
+    p = sub.add_parser("housekeep", help="purge expired tokens and stale rows, refresh rollups, vacuum")
+    p.add_argument("--blob-days", type=int, default=BLOB_RETENTION_DAYS,
+                   help="prune migrated user_data blobs not saved for this many days")
+    p.add_argument("--batch", type=int, default=1000, help="rows per DELETE")
+    p = sub.add_parser("rollup", help="rebuild daily_task_totals from sessions, or --verify it")
+    p.add_argument("--email", help="only this user")
+    p.add_argument("--verify", action="store_true", help="report mismatches instead of rebuilding")
+    p = sub.add_parser("rebalance", help="move a user's rows to another shard, or show users per shard")
+    p.add_argument("--email", help="the user to move")
+    p.add_argument("--to", type=int, help="destination shard (0 = --db)")
+    p.add_argument("--status", action="store_true", help="count users per shard instead")
+    p.add_argument("--shards", default=os.getenv("DATABASE_SHARD_URLS", ""),
+                   help="shard URLs 1.. (default: DATABASE_SHARD_URLS from .env)")
+    p = sub.add_parser("digest", help="email last week's summary to the users who opted in")
+    p.add_argument("--week", type=date.fromisoformat, help="Monday of the week (default: the last one over everywhere)")
+    p.add_argument("--batch", type=int, default=100, help="emails per Resend call (at most 100)")
+    p.add_argument("--rate", type=float, default=float(os.getenv("DIGEST_RATE_PER_SECOND", "2")),
+                   help="Resend calls per second (default: DIGEST_RATE_PER_SECOND or 2)")
+    p.add_argument("--dry-run", action="store_true", help="print the first email and count; send and mark nothing")
+    p.add_argument("--shards", default=os.getenv("DATABASE_SHARD_URLS", ""),
+                   help="shard URLs 1.. (default: DATABASE_SHARD_URLS from .env)")
+    args = parser.parse_args()
+
+    if not args.db:
+        parser.error("No database URL — pass --db or set DATABASE_URL in .env")
+
+    import psycopg2
+    import psycopg2.extras
+
+    if args.command == "digest":
+        digest(args)
+        return
+
+    if args.command == "housekeep":
+        # Autocommit: each batch commits on its own and VACUUM can run.
+        conn = psycopg2.connect(args.db, cursor_factory=psycopg2.extras.RealDictCursor)
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                housekeep(cur, args.blob_days, args.batch)
+        finally:
+            conn.close()
+        return
+
+    with psycopg2.connect(args.db, cursor_factory=psycopg2.extras.RealDictCursor) as conn:
+        with conn.cursor() as cur:
+            if args.command == "partition":
+                n = partition_sessions(cur, args.ahead)
+                print(f"Created {n} partitions" if n else "sessions is already partitioned")
+            elif args.command == "ensure":
+                created = ensure_partitions(cur, args.ahead)
+                print("Created: " + ", ".join(created) if created else "All partitions present")
+            elif args.command == "archive":
+                archived = archive_sessions(cur, args.before)
+                print("Archived: " + ", ".join(archived) if archived else "Nothing to archive")
+            elif args.command == "export":
+                export(conn, cur, args)
+                return
+            elif args.command == "rollup":
+                rollup(cur, args)
+            elif args.command == "rebalance":
+                rebalance(cur, args)
+            elif args.command == "compact-keys":
+                before = measure(cur)
+                steps = compact_keys(cur, args.uuid_task_ids)
+                after = measure(cur)
+                for step in steps or ["already compact"]:
+                    print(f"- {step}")
+                print_measurements(before, after)
+                if args.dry_run:
+                    conn.rollback()
+                    print("(dry run — rolled back)")
+                    return
+        conn.commit()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+profiling.py — opt-in CPU and memory profiling of a running worker.
+
+Nothing here runs unless an admin asks for it through the /admin/profile
+endpoints in app.py (enabled by PROFILING_TOKEN):
+
+  sample()          wall-clock stack sampling of every thread for N seconds,
+                    as folded stacks ("a;b;c 12" per line), the input of
+                    flamegraph.pl, speedscope and inferno
+  MemoryProfiler    tracemalloc start/stop, a baseline snapshot and diffs
+                    against it, and the threshold for AllocationLogMiddleware
+  AllocationLogMiddleware
+                    prints requests whose allocation peak exceeds that
+                    threshold while tracemalloc is tracing; otherwise one
+                    attribute check per request
+
+Each gunicorn worker profiles only itself; responses name the pid.
+"""
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+# Leaf frames in these files are threads waiting for work, not doing any.
+IDLE_FILES = frozenset({"threading.py", "queue.py", "selectors.py"})
+
+
+def _fold(frame) -> list[str]:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+def sample(seconds: float, interval: float = 0.01, include_idle: bool = False) -> Counter:
+    """
+    Stacks of all other threads every `interval` seconds for `seconds`,
+    counted by folded stack. Each stack is rooted at its thread's name.
+    Samples of idle threads are dropped unless include_idle.
+    """
+    me = threading.get_ident()
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            if not include_idle and os.path.basename(frame.f_code.co_filename) in IDLE_FILES:
+                continue
+            stacks[";".join([names.get(ident, str(ident)), *_fold(frame)])] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def folded(stacks: Counter) -> str:
+    return "".join(f"{stack} {n}\n" for stack, n in stacks.most_common())
+
+
+class MemoryProfiler:
+    """tracemalloc for one process: tracing on and off, and a baseline to diff against."""
+
+    def __init__(self):
+        self.baseline = None
+        self.log_over_bytes = 0
+
+    def start(self, frames: int = 10, log_over_kib: float = 0):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.log_over_bytes = int(log_over_kib * 1024)
+
+    def stop(self):
+        tracemalloc.stop()
+        self.baseline = None
+        self.log_over_bytes = 0
+
+    def status(self) -> dict:
+        current, peak = tracemalloc.get_traced_memory()
+        return {"tracing": tracemalloc.is_tracing(), "traced_kib": current // 1024,
+                "peak_kib": peak // 1024, "baseline": self.baseline is not None,
+                "log_over_kib": self.log_over_bytes // 1024, "pid": os.getpid()}
+
+    def _snapshot(self) -> tracemalloc.Snapshot:
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc is not tracing; start it first")
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ])
+
+    def snapshot(self, limit: int = 25) -> list[str]:
+        """Take a new baseline and return its top allocation sites."""
+        self.baseline = self._snapshot()
+        return [str(stat) for stat in self.baseline.statistics("lineno")[:limit]]
+
+    def diff(self, limit: int = 25) -> list[str]:
+        """Allocation sites that grew (or shrank) most since the baseline."""
+        if self.baseline is None:
+            raise RuntimeError("no baseline; take a snapshot first")
+        return [str(stat) for stat in self._snapshot().compare_to(self.baseline, "lineno")[:limit]]
+
+
+class AllocationLogMiddleware:
+    """
+    While memory.log_over_bytes is set and tracemalloc is tracing, prints
+    each request whose allocations peaked more than that above the traced
+    total at its start. The peak is process-wide, so requests that overlap
+    share it; the log line says how many were in flight.
+    """
+
+    def __init__(self, app, memory: MemoryProfiler):
+        self.app = app
+        self.memory = memory
+        self._lock = threading.Lock()
+        self._inflight = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.memory.log_over_bytes or not tracemalloc.is_tracing():
+            await self.app(scope, receive, send)
+            return
+        with self._lock:
+            if self._inflight == 0:
+                tracemalloc.reset_peak()
+            self._inflight += 1
+            overlapping = self._inflight
+            start, _ = tracemalloc.get_traced_memory()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            with self._lock:
+                _, peak = tracemalloc.get_traced_memory()
+                overlapping = max(overlapping, self._inflight)
+                self._inflight -= 1
+            grew = peak - start
+            if grew > self.memory.log_over_bytes:
+                print(f"[alloc] {scope['method']} {scope['path']} peaked {grew // 1024} KiB "
+                      f"above its start ({overlapping} in flight)", flush=True)
@@ -90,7 +90,7 @@ def main():
 
     with psycopg2.connect(args.db, cursor_factory=psycopg2.extras.RealDictCursor) as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT id FROM users WHERE email = %s", (args.email,))
+            cur.execute("SELECT id FROM users WHERE lower(email) = lower(%s)", (args.email.strip(),))
             row = cur.fetchone()
             if not row:
                 print(f"No user found with email: {args.email}")
@@ -1,16 +1,246 @@
 #!/usr/bin/env python3
-import http.server, json, os, webbrowser
+"""
+server.py — local/offline mode: no auth, one user, data kept on this machine.
+
+The document is cached in memory, so GET /data never touches the disk. Each
+request gets its own thread, and saves are persisted in one of two ways:
+
+  data.json (default)  written to a temp file, fsynced and renamed over the
+                       original by a background flusher, so a crash leaves
+                       either the old or the new file, never a torn one.
+                       A burst of saves is batched into one write.
+  --sqlite [PATH]      an embedded SQLite database with the same tasks /
+                       sessions / later_items tables as the Postgres schema.
+                       Only the rows that changed since the last save are
+                       written, so large histories stay fast. An existing
+                       data.json is imported on first run.
+
+Usage:
+    python3 server.py
+    python3 server.py --sqlite            # tt.sqlite3 next to this file
+    python3 server.py --port 5556 --no-browser
+"""
+import argparse, http.server, json, os, sqlite3, tempfile, threading, time, webbrowser
 from pathlib import Path
 
-DATA = Path(__file__).parent / "data.json"
+HERE = Path(__file__).parent
+DATA = HERE / "data.json"
+SQLITE_DB = HERE / "tt.sqlite3"
 PORT = 5555
+FLUSH_INTERVAL = 0.5  # seconds; saves arriving within this window share one fsync
+EMPTY = b'{"tasks":[]}'
+
+
+# ── JSON file store ────────────────────────────────────────────────────────────
+class JsonStore:
+    def __init__(self, path: Path, flush_interval: float = FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._body = path.read_bytes() if path.exists() else EMPTY
+        self._lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def get(self) -> bytes:
+        return self._body
+
+    def put(self, body: bytes):
+        json.loads(body)  # never persist something the app can't load back
+        self._body = body
+        self._dirty.set()
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._dirty.wait()
+            if self._closed:
+                break
+            time.sleep(self.flush_interval)  # let a burst of saves coalesce
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty.is_set():
+                return
+            self._dirty.clear()
+            body = self._body
+            fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.path.name}.")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(body)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+            dir_fd = os.open(self.path.parent, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)  # make the rename itself durable
+            finally:
+                os.close(dir_fd)
+
+    def close(self):
+        self._closed = True
+        self._dirty.set()  # wake the flusher so it exits
+        self._flusher.join()
+        self.flush()
+
+
+# ── SQLite store ───────────────────────────────────────────────────────────────
+# Follows app.create_schema for tasks and sessions; user_id is always
+# LOCAL_USER. later_items differs: the primary key is id alone and position
+# is a plain list index, where Postgres keys (id, user_id) and orders by
+# fractional TEXT keys (position_between). Nothing copies these rows into
+# Postgres; a copy would have to re-key positions, since integers compared
+# as text put 10 before 9.
+LOCAL_USER = 1
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id              TEXT NOT NULL,
+    user_id         INTEGER NOT NULL DEFAULT 1,
+    name            TEXT NOT NULL,
+    last_started_at INTEGER,
+    total_ms        INTEGER NOT NULL DEFAULT 0,
+    session_count   INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (id, user_id)
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    task_id  TEXT NOT NULL,
+    user_id  INTEGER NOT NULL DEFAULT 1,
+    start_ts INTEGER NOT NULL,
+    end_ts   INTEGER,
+    PRIMARY KEY (task_id, user_id, start_ts),
+    FOREIGN KEY (task_id, user_id) REFERENCES tasks(id, user_id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS sessions_user_start ON sessions(user_id, start_ts);
+CREATE TABLE IF NOT EXISTS later_items (
+    id       TEXT PRIMARY KEY,
+    user_id  INTEGER NOT NULL DEFAULT 1,
+    text     TEXT NOT NULL,
+    position INTEGER NOT NULL
+);
+"""
+
+
+def _rows(doc: dict):
+    """Flatten a /data document into (tasks, sessions, later) keyed for diffing."""
+    tasks, sessions = {}, {}
+    for t in doc.get("tasks", []):
+        tasks[t["id"]] = t["name"]
+        for s in t.get("sessions", []):
+            sessions[(t["id"], s["start"])] = s.get("end")
+    later = [(item["id"], item["text"], i) for i, item in enumerate(doc.get("later", []))]
+    return tasks, sessions, later
+
 
+class SqliteStore:
+    def __init__(self, path: Path, seed: Path | None = None):
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")  # fsync at checkpoints, not every commit
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.executescript(SQLITE_SCHEMA)
+        self._lock = threading.Lock()
+        self._body = self._load()
+        self._rows = _rows(json.loads(self._body))
+        if seed and seed.exists() and not self._rows[0]:
+            self.put(seed.read_bytes())
+
+    def _load(self) -> bytes:
+        cur = self.conn.execute(
+            "SELECT id, name FROM tasks WHERE user_id = ? "
+            "ORDER BY last_started_at DESC NULLS LAST, id", (LOCAL_USER,)
+        )
+        tasks = {tid: {"id": tid, "name": name, "sessions": []} for tid, name in cur}
+        cur = self.conn.execute(
+            "SELECT task_id, start_ts, end_ts FROM sessions WHERE user_id = ? ORDER BY start_ts",
+            (LOCAL_USER,),
+        )
+        for tid, start, end in cur:
+            tasks[tid]["sessions"].append({"start": start, "end": end})
+        later = [
+            {"id": lid, "text": text}
+            for lid, text in self.conn.execute(
+                "SELECT id, text FROM later_items WHERE user_id = ? ORDER BY position", (LOCAL_USER,)
+            )
+        ]
+        return json.dumps({"tasks": list(tasks.values()), "later": later}).encode()
+
+    def get(self) -> bytes:
+        return self._body
+
+    def put(self, body: bytes):
+        tasks, sessions, later = new = _rows(json.loads(body))
+        with self._lock:
+            old_tasks, old_sessions, old_later = self._rows
+            touched = set()
+            c = self.conn
+            c.execute("BEGIN")
+            try:
+                c.executemany(
+                    "DELETE FROM tasks WHERE id = ? AND user_id = ?",
+                    [(tid, LOCAL_USER) for tid in old_tasks.keys() - tasks.keys()],
+                )
+                c.executemany(
+                    "INSERT INTO tasks (id, user_id, name) VALUES (?, ?, ?) "
+                    "ON CONFLICT (id, user_id) DO UPDATE SET name = excluded.name",
+                    [(tid, LOCAL_USER, name) for tid, name in tasks.items() if old_tasks.get(tid) != name],
+                )
+                removed = [key for key in old_sessions.keys() - sessions.keys() if key[0] in tasks]
+                changed = [(key, end) for key, end in sessions.items()
+                           if key not in old_sessions or old_sessions[key] != end]
+                c.executemany(
+                    "DELETE FROM sessions WHERE task_id = ? AND user_id = ? AND start_ts = ?",
+                    [(tid, LOCAL_USER, start) for tid, start in removed],
+                )
+                c.executemany(
+                    "INSERT INTO sessions (task_id, user_id, start_ts, end_ts) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (task_id, user_id, start_ts) DO UPDATE SET end_ts = excluded.end_ts",
+                    [(tid, LOCAL_USER, start, end) for (tid, start), end in changed],
+                )
+                touched.update(tid for tid, _ in removed)
+                touched.update(tid for (tid, _), _ in changed)
+                # Same per-task activity columns the Postgres trigger maintains.
+                c.executemany("""
+                    UPDATE tasks SET
+                        last_started_at = (SELECT MAX(start_ts) FROM sessions s
+                                           WHERE s.task_id = tasks.id AND s.user_id = tasks.user_id),
+                        total_ms = (SELECT COALESCE(SUM(end_ts - start_ts), 0) FROM sessions s
+                                    WHERE s.task_id = tasks.id AND s.user_id = tasks.user_id),
+                        session_count = (SELECT COUNT(*) FROM sessions s
+                                         WHERE s.task_id = tasks.id AND s.user_id = tasks.user_id)
+                    WHERE id = ? AND user_id = ?
+                """, [(tid, LOCAL_USER) for tid in touched])
+                if later != old_later:
+                    c.execute("DELETE FROM later_items WHERE user_id = ?", (LOCAL_USER,))
+                    c.executemany(
+                        "INSERT INTO later_items (id, user_id, text, position) VALUES (?, ?, ?, ?)",
+                        [(lid, LOCAL_USER, text, pos) for lid, text, pos in later],
+                    )
+                c.execute("COMMIT")
+            except BaseException:
+                c.execute("ROLLBACK")
+                raise
+            self._rows = new
+            self._body = body
+
+    def close(self):
+        self.conn.close()
+
+
+# ── HTTP ───────────────────────────────────────────────────────────────────────
 class H(http.server.SimpleHTTPRequestHandler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=str(HERE), **kwargs)
+
     def do_GET(self):
         if self.path == "/data":
-            body = DATA.read_bytes() if DATA.exists() else b'{"tasks":[]}'
+            body = self.server.store.get()
             self.send_response(200)
             self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
             self.end_headers()
             self.wfile.write(body)
         else:
@@ -19,12 +249,48 @@ class H(http.server.SimpleHTTPRequestHandler):
     def do_POST(self):
         if self.path == "/data":
             length = int(self.headers["Content-Length"])
-            DATA.write_bytes(self.rfile.read(length))
+            try:
+                self.server.store.put(self.rfile.read(length))
+            except (ValueError, KeyError, TypeError):
+                self.send_error(400, "invalid document")
+                return
             self.send_response(204)
             self.end_headers()
+        else:
+            self.send_error(404)
 
     def log_message(self, *_): pass  # silence request logs
 
-print(f"tt running at http://localhost:{PORT}")
-webbrowser.open(f"http://localhost:{PORT}")
-http.server.HTTPServer(("", PORT), H).serve_forever()
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, store):
+        self.store = store
+        super().__init__(address, H)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run tt locally without an account.")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--sqlite", nargs="?", const=str(SQLITE_DB), metavar="PATH",
+                        help=f"store data in SQLite (default {SQLITE_DB.name}) instead of {DATA.name}")
+    parser.add_argument("--no-browser", action="store_true")
+    args = parser.parse_args()
+
+    store = SqliteStore(Path(args.sqlite), seed=DATA) if args.sqlite else JsonStore(DATA)
+    server = Server(("", args.port), store)
+    print(f"tt running at http://localhost:{args.port}")
+    if not args.no_browser:
+        webbrowser.open(f"http://localhost:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
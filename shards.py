@@ -0,0 +1,283 @@
+"""
+shards.py — user data spread over several Postgres databases.
+
+Accounts stay on the primary (DATABASE_URL): users with their billing and
+sharing columns, password reset tokens, rate-limit buckets and the shard
+directory. Everything keyed by one user's id (tasks, sessions and their
+archive, later items, daily totals, Plan B blobs and import jobs) lives on
+that user's home shard. Shard 0 is the primary itself and shards 1.. are
+DATABASE_SHARD_URLS. Homes are rows of the primary's user_shards table;
+users without a row live on shard 0, so turning sharding on moves nobody.
+
+Every shard has the full schema. Its users table holds a copy of the id,
+email and time zone of the users homed there, which the foreign keys and the
+daily-rollup trigger need. app.py keeps those copies current.
+
+  ShardMap      the home shard of each user, cached per process
+  fence()       first statement of every session on a shard; says whether the
+                user has moved away
+  move_user()   the rebalancing tool (`maintenance.py rebalance`): copies one
+                user's rows to another shard while the app keeps serving
+
+A move holds the user's move lock on the old shard while it copies. Writers
+take that lock in shared mode, so the move waits for writes in flight and
+holds off new ones. It then commits the copy, points user_shards at the new
+shard and, in one transaction on the old shard, deletes the rows and leaves a
+tombstone in moved_users. A worker whose cache still names the old shard
+finds the tombstone, forgets the entry and answers 503; the retry goes to the
+new home. Reads run in REPEATABLE READ from the fence on, so they see the
+user's rows either whole or not at all.
+"""
+import threading
+
+import psycopg2
+import psycopg2.extras
+
+# Advisory lock class of the per-user move lock; the second key is the user id.
+MOVE_LOCK = 7_447_003
+
+# Tables with a user_id column, in an order that satisfies their foreign keys.
+USER_TABLES = ("user_data", "import_jobs", "tasks", "sessions_archive",
+               "later_items", "sessions", "daily_task_totals")
+TASK_STATS = ("last_started_at", "total_ms", "session_count")
+
+
+def fence(cur, user_id: int, write: bool) -> bool:
+    """
+    Open a session for the user's rows on this shard; True if they moved away.
+    Writers take the move lock (shared) and then look for the tombstone in a
+    fresh snapshot; readers switch to REPEATABLE READ so every later query
+    sees the same snapshot as the check. Must be the session's first statement.
+    """
+    if write:
+        sql = "SELECT pg_advisory_xact_lock_shared(%(lock)s, %(uid)s); "
+    else:
+        sql = "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ; "
+    cur.execute(sql + "SELECT EXISTS (SELECT 1 FROM moved_users WHERE user_id = %(uid)s) AS moved",
+                {"lock": MOVE_LOCK, "uid": user_id})
+    row = cur.fetchone()
+    return bool(row["moved"] if isinstance(row, dict) else row[0])
+
+
+class ShardMap:
+    """
+    Home shard of each user. A lookup reads user_shards on the primary once
+    per user and process; after that the cache answers. Entries go stale only
+    when a user is moved, which fence() detects on the old shard, and callers
+    then forget() the entry.
+    """
+
+    def __init__(self, primary_url: str, shard_urls=(), max_cached: int = 100_000):
+        self.urls = [primary_url, *shard_urls]
+        self.max_cached = max_cached
+        self._cache: dict[int, int] = {}
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return len(self.urls) > 1
+
+    def cached(self, user_id: int) -> int | None:
+        return self._cache.get(user_id) if self.enabled else 0
+
+    def home(self, user_id: int) -> int:
+        shard = self.cached(user_id)
+        if shard is not None:
+            return shard
+        with self._lock:
+            try:
+                if self._conn is None or self._conn.closed:
+                    self._conn = psycopg2.connect(self.urls[0], connect_timeout=2)
+                    self._conn.autocommit = True
+                with self._conn.cursor() as cur:
+                    cur.execute("SELECT shard FROM user_shards WHERE user_id = %s", (user_id,))
+                    row = cur.fetchone()
+            except psycopg2.Error:
+                if self._conn is not None:
+                    self._conn.close()
+                raise
+            if len(self._cache) >= self.max_cached:
+                self._cache.clear()
+            shard = self._cache[user_id] = row[0] if row else 0
+        return shard
+
+    def forget(self, user_id: int):
+        self._cache.pop(user_id, None)
+
+    def place(self, cur, user_id: int, email: str) -> int:
+        """
+        Home a new account (cur is on the primary, in the signup's
+        transaction): round-robin by id over all shards. The shard gets its
+        copy of the users row at once, so the user can save straight away.
+        """
+        if not self.enabled:
+            return 0
+        shard = user_id % len(self.urls)
+        if shard:
+            with psycopg2.connect(self.urls[shard]) as conn:
+                with conn.cursor() as shard_cur:
+                    shard_cur.execute(
+                        "INSERT INTO users (id, email) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                        (user_id, email),
+                    )
+            conn.close()
+            cur.execute("INSERT INTO user_shards (user_id, shard) VALUES (%s, %s)", (user_id, shard))
+        self._cache[user_id] = shard
+        return shard
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+
+
+# ── Rebalancing ──────────────────────────────────────────────────────────────
+
+class MoveRefused(Exception):
+    """The user can't be moved right now; nothing was changed."""
+
+
+def _columns(cur, table: str) -> list[str]:
+    cur.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_name = %s AND table_schema = current_schema() ORDER BY ordinal_position
+    """, (table,))
+    return [r["column_name"] for r in cur.fetchall()]
+
+
+def _archive_horizon(cur) -> int:
+    cur.execute("SELECT value FROM app_state WHERE key = 'sessions_archived_before'")
+    row = cur.fetchone()
+    return int(row["value"]) if row else 0
+
+
+def _delete_user_rows(cur, user_id: int, keep_account: bool):
+    # Deleting tasks cascades to sessions, the archive and daily totals.
+    for table in ("user_data", "import_jobs", "later_items", "tasks"):
+        cur.execute(f"DELETE FROM {table} WHERE user_id = %s", (user_id,))
+    if not keep_account:
+        cur.execute("DELETE FROM users WHERE id = %s", (user_id,))
+
+
+def _copy_user_rows(src, dst, user_id: int) -> dict:
+    """Insert the user's rows from src into dst; returns rows copied per table."""
+    counts, stats = {}, []
+    for table in USER_TABLES:
+        present = set(_columns(dst, table))
+        cols = [c for c in _columns(src, table) if c in present]
+        src.execute(f"SELECT {', '.join(cols)} FROM {table} WHERE user_id = %s", (user_id,))
+        rows = [tuple(r[c] for c in cols) for r in src.fetchall()]
+        if table == "tasks":
+            # Inserted sessions bump these through the triggers; the source's
+            # values (which count archived sessions too) are restored below.
+            at = [cols.index(c) for c in ("id", *TASK_STATS)]
+            stats = [(r[at[0]], user_id, *(r[i] for i in at[1:])) for r in rows]
+        if table == "daily_task_totals":
+            dst.execute("DELETE FROM daily_task_totals WHERE user_id = %s", (user_id,))
+        if rows:
+            psycopg2.extras.execute_values(
+                dst, f"INSERT INTO {table} ({', '.join(cols)}) VALUES %s", rows, page_size=1000
+            )
+        counts[table] = len(rows)
+    if stats:
+        psycopg2.extras.execute_values(dst, f"""
+            UPDATE tasks t SET {", ".join(f"{c} = v.{c}" for c in TASK_STATS)}
+            FROM (VALUES %s) AS v(id, user_id, {", ".join(TASK_STATS)})
+            WHERE t.id::text = v.id AND t.user_id = v.user_id
+        """, stats, template="(%s::text, %s, %s::bigint, %s::bigint, %s::integer)", page_size=1000)
+    return counts
+
+
+def move_user(urls: list[str], user_id: int, to: int, log=print) -> dict | None:
+    """
+    Move one user's rows to shard `to` (an index into urls; urls[0] is the
+    primary). Returns rows copied per table, or None if the user already
+    lives there. Raises MoveRefused while an import of theirs is unfinished
+    or when the two shards have archived sessions up to different months.
+    Safe to re-run after a failure: a half-finished move is completed.
+    """
+    if not 0 <= to < len(urls):
+        raise MoveRefused(f"no shard {to}; shards are 0..{len(urls) - 1}")
+    factory = psycopg2.extras.RealDictCursor
+    primary = psycopg2.connect(urls[0], cursor_factory=factory)
+    try:
+        with primary.cursor() as cur:
+            cur.execute("""
+                SELECT u.email, u.time_zone, COALESCE(s.shard, 0) AS shard, s.previous
+                FROM users u LEFT JOIN user_shards s ON s.user_id = u.id
+                WHERE u.id = %s
+            """, (user_id,))
+            user = cur.fetchone()
+        primary.commit()
+        if user is None:
+            raise MoveRefused(f"no user {user_id}")
+        if user["shard"] == to and user["previous"] is None:
+            return None
+        if user["shard"] == to:
+            source = user["previous"]  # copied and switched over, not yet cleaned up
+            log(f"[rebalance] user {user_id}: finishing the move from shard {source}")
+        else:
+            source = user["shard"]
+        src = psycopg2.connect(urls[source], cursor_factory=factory)
+        dst = psycopg2.connect(urls[to], cursor_factory=factory)
+        try:
+            with src.cursor() as s, dst.cursor() as d:
+                s.execute("SELECT pg_advisory_xact_lock(%s, %s)", (MOVE_LOCK, user_id))
+                counts = {}
+                if user["shard"] != to:
+                    s.execute("""
+                        SELECT count(*) AS n FROM import_jobs
+                        WHERE user_id = %s AND status NOT IN ('done', 'failed')
+                    """, (user_id,))
+                    if s.fetchone()["n"]:
+                        raise MoveRefused(f"user {user_id} has an import in progress; try again later")
+                    if _archive_horizon(s) != _archive_horizon(d):
+                        raise MoveRefused(f"shards {source} and {to} are archived up to different "
+                                          "months; run `maintenance.py archive` on both first")
+                    d.execute("DELETE FROM moved_users WHERE user_id = %s", (user_id,))
+                    _delete_user_rows(d, user_id, keep_account=True)
+                    if to:
+                        d.execute("""
+                            INSERT INTO users (id, email, time_zone) VALUES (%s, %s, %s)
+                            ON CONFLICT (id) DO UPDATE SET email = EXCLUDED.email,
+                                                           time_zone = EXCLUDED.time_zone
+                        """, (user_id, user["email"], user["time_zone"]))
+                    counts = _copy_user_rows(s, d, user_id)
+                    dst.commit()
+                    with primary.cursor() as cur:
+                        cur.execute("""
+                            INSERT INTO user_shards (user_id, shard, previous) VALUES (%s, %s, %s)
+                            ON CONFLICT (user_id) DO UPDATE SET shard = EXCLUDED.shard,
+                                                                previous = EXCLUDED.previous
+                        """, (user_id, to, source))
+                    primary.commit()
+                s.execute("""
+                    INSERT INTO moved_users (user_id, shard) VALUES (%s, %s)
+                    ON CONFLICT (user_id) DO UPDATE SET shard = EXCLUDED.shard, moved_at = NOW()
+                """, (user_id, to))
+                _delete_user_rows(s, user_id, keep_account=source == 0)
+            src.commit()
+            with primary.cursor() as cur:
+                cur.execute("UPDATE user_shards SET previous = NULL WHERE user_id = %s", (user_id,))
+            primary.commit()
+        finally:
+            src.close()
+            dst.close()
+    finally:
+        primary.close()
+    log(f"[rebalance] user {user_id}: shard {source} -> {to} "
+        f"({', '.join(f'{n} {t}' for t, n in counts.items() if n) or 'no rows copied'})")
+    return counts
+
+
+def shard_counts(primary_url: str, shards: int) -> list[int]:
+    """Users homed on each shard."""
+    with psycopg2.connect(primary_url) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT COALESCE(s.shard, 0), count(*) FROM users u
+                LEFT JOIN user_shards s ON s.user_id = u.id GROUP BY 1
+            """)
+            found = dict(cur.fetchall())
+    conn.close()
+    return [found.get(i, 0) for i in range(shards)]
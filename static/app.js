@@ -14,6 +14,7 @@ async function load() {
     document.getElementById('billing-success-banner').style.display = 'flex';
   }
 
+  syncBootCookie();
   const resetToken = new URLSearchParams(location.search).get('token');
   if (resetToken) { showAuth(); showResetView(); return; }
   const token = localStorage.getItem('tt_token');
@@ -24,25 +25,76 @@ async function load() {
     ensureTick();
     return;
   }
-  try {
-    const r = await fetch('/data', {
-      headers: { 'Authorization': `Bearer ${token}` }
-    });
-    if (r.status === 401) {
-      localStorage.removeItem('tt_token');
-      loadGuestData(); showGuestMode(); render(); ensureTick();
-      return;
-    }
-    data = await r.json();
-    data.later = data.later || [];
-  } catch { data = { tasks: [] }; }
-  await fetchBillingStatus();
+  const boot = takeBootstrap(token);
+  if (boot) {
+    data = boot.data;
+    subscriptionStatus = boot.billing.subscription_status;
+    isComped = boot.billing.is_comped;
+  } else {
+    try {
+      let r;
+      // 503: the database is down and this machine has no snapshot of our data
+      // (degraded.py in app.py). Starting empty would save over it, so wait.
+      while ((r = await fetch('/data', {
+        headers: { 'Authorization': `Bearer ${token}`, 'Accept': DATA_TYPE }
+      })).status === 503) {
+        await new Promise(ok => setTimeout(ok, 1000 * (Number(r.headers.get('Retry-After')) || 5)));
+      }
+      if (r.status === 401) {
+        localStorage.removeItem('tt_token');
+        syncBootCookie();
+        loadGuestData(); showGuestMode(); render(); ensureTick();
+        return;
+      }
+      const body = await r.json();
+      data = (r.headers.get('Content-Type') || '').startsWith(DATA_TYPE) ? fromColumnar(body) : body;
+    } catch { data = { tasks: [] }; }
+  }
+  data.later = data.later || [];
+  syncTimeZone(token);
+  if (boot) updateBillingUI();
+  else await fetchBillingStatus();
   showUserMode();
   hideAuth();
   render();
   ensureTick();
 }
 
+// ── Inline bootstrap ──────────────────────────────────────────────────────────
+// tt_boot mirrors the token so GET / can embed this user's /data and billing
+// state in the page (index_response in app.py), saving load() two requests.
+function syncBootCookie() {
+  const token = localStorage.getItem('tt_token');
+  const secure = location.protocol === 'https:' ? '; Secure' : '';
+  document.cookie = token
+    ? `tt_boot=${token}; Path=/; Max-Age=${30 * 86400}; SameSite=Lax${secure}`
+    : `tt_boot=; Path=/; Max-Age=0; SameSite=Lax${secure}`;
+}
+
+// The embedded state, used once and only if it belongs to this token.
+function takeBootstrap(token) {
+  const el = document.getElementById('tt-bootstrap');
+  if (!el) return null;
+  el.remove();
+  try {
+    const boot = JSON.parse(el.textContent);
+    const payload = JSON.parse(atob(token.split('.')[1].replace(/-/g, '+').replace(/_/g, '/')));
+    return boot.user === String(payload.sub) ? boot : null;
+  } catch { return null; }
+}
+
+// Server-side daily totals follow the browser's zone (the free-tier day stays
+// in the first one reported).
+function syncTimeZone(token) {
+  const tz = Intl.DateTimeFormat().resolvedOptions().timeZone;
+  if (!tz) return;
+  fetch('/settings/time-zone', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json', 'Authorization': `Bearer ${token}` },
+    body: JSON.stringify({ time_zone: tz })
+  }).catch(() => {});
+}
+
 const bc = new BroadcastChannel('tt');
 
 bc.onmessage = e => {
@@ -59,18 +111,74 @@ function persist() {
     return;
   }
   bc.postMessage(data);
-  fetch('/data', {
+  const seq = ++saveSeq;
+  // Compression is async; chaining keeps saves leaving in the order they were made.
+  const ready = saveQueue.then(() => encodeData(JSON.stringify(toColumnar(data))));
+  saveQueue = ready.then(() => {}, () => {});
+  ready.then(({ body, encoding }) => fetch('/data', {
     method: 'POST',
     headers: {
-      'Content-Type': 'application/json',
+      'Content-Type': DATA_TYPE,
+      ...(encoding && { 'Content-Encoding': encoding }),
       'Authorization': `Bearer ${token}`
     },
-    body: JSON.stringify(data)
-  }).then(r => {
-    if (r.status === 401) { localStorage.removeItem('tt_token'); loadGuestData(); showGuestMode(); }
+    body
+  })).then(r => {
+    if (r.status === 401) { localStorage.removeItem('tt_token'); syncBootCookie(); loadGuestData(); showGuestMode(); }
+    // 503: neither saved nor journaled (app.py). Send the whole document again
+    // later, unless a newer save has gone out meanwhile.
+    if (r.status === 503) {
+      setTimeout(() => { if (seq === saveSeq) persist(); },
+                 1000 * (Number(r.headers.get('Retry-After')) || 5));
+    }
   }).catch(() => {});
 }
 
+// ── /data wire format ─────────────────────────────────────────────────────────
+// Sessions travel as two columns per task: starts (first start, then the gap
+// from the previous start) and lengths (null while running). See COLUMNAR_TYPE
+// in app.py.
+const DATA_TYPE = 'application/vnd.doingit.columnar+json';
+let saveQueue = Promise.resolve();
+let saveSeq = 0;  // the latest persist(), so a retried save never follows a newer one
+
+function toColumnar(doc) {
+  return {
+    tasks: doc.tasks.map(t => {
+      const starts = [], lengths = [];
+      let prev = 0;
+      for (const s of t.sessions) {
+        starts.push(s.start - prev);
+        lengths.push(s.end == null ? null : s.end - s.start);
+        prev = s.start;
+      }
+      return { id: t.id, name: t.name, starts, lengths };
+    }),
+    later: doc.later || []
+  };
+}
+
+function fromColumnar(doc) {
+  return {
+    tasks: doc.tasks.map(t => {
+      const sessions = new Array(t.starts.length);
+      let start = 0;
+      for (let i = 0; i < t.starts.length; i++) {
+        start += t.starts[i];
+        sessions[i] = { start, end: t.lengths[i] == null ? null : start + t.lengths[i] };
+      }
+      return { id: t.id, name: t.name, sessions };
+    }),
+    later: doc.later || []
+  };
+}
+
+async function encodeData(json) {
+  if (typeof CompressionStream === 'undefined' || json.length < 1024) return { body: json, encoding: null };
+  const gz = new Blob([json]).stream().pipeThrough(new CompressionStream('gzip'));
+  return { body: await new Response(gz).arrayBuffer(), encoding: 'gzip' };
+}
+
 // ── Auth ──────────────────────────────────────────────────────────────────────
 let authMode = 'login';
 let googleClientId = null;
@@ -425,6 +533,7 @@ function logout() {
   if (ticker) { clearInterval(ticker); ticker = null; }
   clearPomodoroTimer();
   localStorage.removeItem('tt_token');
+  syncBootCookie();
   subscriptionStatus = 'free';
   isComped = false;
   loadGuestData();
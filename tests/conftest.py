@@ -1,78 +1,51 @@
 import os
+import tempfile
+from contextlib import contextmanager
 
 # Must be set before importing app — load_dotenv() does not override existing env vars,
 # so setting these here takes precedence over whatever is in .env.
 os.environ.setdefault("DATABASE_URL", "postgresql://localhost/tt_test")
 os.environ.setdefault("SECRET_KEY", "test-secret-for-testing")
+# Snapshots and journaled saves (degraded.py) go to a fresh directory per run.
+_scratch = tempfile.mkdtemp(prefix="tt-test-")
+os.environ.setdefault("SNAPSHOT_DIR", os.path.join(_scratch, "snapshots"))
+os.environ.setdefault("JOURNAL_DIR", os.path.join(_scratch, "journal"))
 
 import psycopg2
 import psycopg2.extras
 import pytest
 from fastapi.testclient import TestClient
 
-from app import app, get_db
+from app import (
+    app, create_schema, get_bootstrap_db, get_bootstrap_home_db, get_db, get_db_runner, get_home_db,
+    get_home_read_db, get_home_read_runner, get_home_runner, get_job_db, get_read_db, get_stream_db,
+    get_user_db, get_user_read_db, rate_limiter,
+)
+from tests.helpers import NoCommitConnection
 
 _DB_URL = os.environ["DATABASE_URL"]
 
 
+def pytest_addoption(parser):
+    parser.addoption(
+        "--update-benchmarks", action="store_true",
+        help="rewrite tests/benchmark_baselines.json from this run instead of gating on it",
+    )
+
+
 @pytest.fixture(scope="session", autouse=True)
 def init_test_db():
     """
     Ensure the test database schema exists. Runs once per session.
 
-    Uses CREATE TABLE IF NOT EXISTS (no DROP) so it is safe even if DATABASE_URL
+    Delegates to app.create_schema, which only uses CREATE ... IF NOT EXISTS /
+    ADD COLUMN IF NOT EXISTS (no DROP), so it is safe even if DATABASE_URL
     happens to point at a dev database — existing data is never destroyed.
     """
     conn = psycopg2.connect(_DB_URL)
     conn.autocommit = True
     with conn.cursor() as cur:
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id            SERIAL PRIMARY KEY,
-                email         TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                created_at    TIMESTAMPTZ DEFAULT NOW()
-            )
-        """)
-        cur.execute("ALTER TABLE users ALTER COLUMN password_hash DROP NOT NULL")
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS user_data (
-                user_id     INTEGER PRIMARY KEY REFERENCES users(id),
-                tasks_json  TEXT NOT NULL DEFAULT '{"tasks":[]}',
-                migrated_at TIMESTAMPTZ
-            )
-        """)
-        cur.execute(
-            "ALTER TABLE user_data ADD COLUMN IF NOT EXISTS migrated_at TIMESTAMPTZ"
-        )
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS tasks (
-                id      TEXT    NOT NULL,
-                user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-                name    TEXT    NOT NULL,
-                PRIMARY KEY (id, user_id)
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS sessions (
-                id       TEXT    NOT NULL PRIMARY KEY,
-                task_id  TEXT    NOT NULL,
-                user_id  INTEGER NOT NULL,
-                start_ts BIGINT  NOT NULL,
-                end_ts   BIGINT,
-                FOREIGN KEY (task_id, user_id) REFERENCES tasks(id, user_id) ON DELETE CASCADE,
-                UNIQUE (task_id, user_id, start_ts)
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS later_items (
-                id       TEXT    NOT NULL,
-                user_id  INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-                text     TEXT    NOT NULL,
-                position INTEGER NOT NULL DEFAULT 0,
-                PRIMARY KEY (id, user_id)
-            )
-        """)
+        create_schema(cur)
     conn.close()
 
 
@@ -96,12 +69,13 @@ def db_conn(init_test_db):
 @pytest.fixture
 def client(db_conn):
     """
-    A TestClient whose get_db dependency is overridden to use the per-test
-    transactional connection. Deliberately omits commit so the db_conn
-    fixture can roll everything back at teardown.
+    A TestClient whose database dependencies (get_db, get_read_db and the
+    per-user ones) are overridden to use the per-test transactional
+    connection. Deliberately omits commit so the db_conn fixture can roll
+    everything back at teardown.
 
     TestClient is intentionally used without the context manager so the app's
-    startup event (which has a retry loop) does not run — schema setup is
+    startup event (which connects to DATABASE_URL) does not run — schema setup is
     handled by init_test_db instead.
     """
     def override_get_db():
@@ -109,7 +83,30 @@ def client(db_conn):
         yield cur
         # No commit — db_conn fixture rolls the transaction back.
 
-    app.dependency_overrides[get_db] = override_get_db
+    for dependency in (get_db, get_read_db, get_bootstrap_db, get_user_db, get_user_read_db,
+                       get_home_db, get_home_read_db, get_bootstrap_home_db):
+        app.dependency_overrides[dependency] = override_get_db
+
+    # Streaming responses and background jobs open their own connections;
+    # hand them the test connection instead, with commit disabled.
+    @contextmanager
+    def open_test_conn():
+        yield NoCommitConnection(db_conn)
+
+    app.dependency_overrides[get_stream_db] = lambda: open_test_conn
+    app.dependency_overrides[get_job_db] = lambda: open_test_conn
+
+    # Handlers that call out between queries run them through get_db_runner.
+    async def run_in_test_db(fn, *args):
+        return fn(db_conn.cursor(), *args)
+
+    async def run_in_test_home(user_id, fn, *args):
+        return fn(db_conn.cursor(), *args)
+
+    app.dependency_overrides[get_db_runner] = lambda: run_in_test_db
+    app.dependency_overrides[get_home_runner] = lambda: run_in_test_home
+    app.dependency_overrides[get_home_read_runner] = lambda: run_in_test_home
+    rate_limiter.reset()  # every test signs up from the same address
     yield TestClient(app, raise_server_exceptions=True)
     app.dependency_overrides.clear()
 
@@ -1,2 +1,15 @@
 def auth_headers(token: str) -> dict[str, str]:
     return {"Authorization": f"Bearer {token}"}
+
+
+class NoCommitConnection:
+    """db_conn for code that manages its own connection: commit is a no-op, close is skipped."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def commit(self):
+        pass
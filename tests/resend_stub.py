@@ -0,0 +1,81 @@
+"""
+A local stand-in for Resend's batch endpoint, enough for DigestMailer.
+Failures are scripted per request with fail(), and every request is recorded
+with its JSON body and Idempotency-Key. A repeated key gets 409, as Resend
+answers once it has seen one.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class ResendStub:
+    def __init__(self):
+        self.requests: list[dict] = []
+        self._script: list = []  # status codes, (status, Retry-After) pairs, or seconds to stall
+        self._keys: set[str] = set()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_port}"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def fail(self, *steps: int | float | tuple[int, str]):
+        """Answer the next requests with these status codes, (status, Retry-After) pairs, or stall (float)."""
+        with self._lock:
+            self._script.extend(steps)
+
+    def delivered(self) -> list[str]:
+        """Recipients of the batches that were accepted, in order."""
+        return [to for r in self.requests if r["status"] == 200 for email in r["json"] for to in email["to"]]
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                key = self.headers.get("Idempotency-Key")
+                with stub._lock:
+                    record = {"path": self.path, "json": body, "idempotency_key": key,
+                              "authorization": self.headers.get("Authorization")}
+                    stub.requests.append(record)
+                    step = stub._script.pop(0) if stub._script else None
+                    if step is None and key in stub._keys:
+                        step = 409
+                if isinstance(step, float):
+                    time.sleep(step)
+                    step = None
+                status, retry_after = step if isinstance(step, tuple) else (step, None)
+                if status is None and self.path != "/emails/batch":
+                    status = 404
+                if status is not None:
+                    record["status"] = status
+                    return self._send(status, {"name": "stub_error", "message": f"stub {status}"}, retry_after)
+                with stub._lock:
+                    stub._keys.add(key)
+                record["status"] = 200
+                self._send(200, {"data": [{"id": f"email_{len(stub.requests)}_{i}"} for i in range(len(body))]})
+
+            def _send(self, code: int, payload: dict, retry_after: str | None = None):
+                data = json.dumps(payload).encode()
+                try:
+                    self.send_response(code)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    if retry_after is not None:
+                        self.send_header("Retry-After", retry_after)
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client gave up (timeout tests)
+
+        return Handler
@@ -0,0 +1,78 @@
+"""
+A local stand-in for the Stripe API, enough for BillingClient: customers,
+checkout sessions and billing portal sessions. Failures are scripted per
+request with fail(), and every request is recorded with its path, form body
+and Idempotency-Key.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+OBJECTS = {
+    "/v1/customers": "customer",
+    "/v1/checkout/sessions": "checkout.session",
+    "/v1/billing_portal/sessions": "billing_portal.session",
+}
+
+
+class StripeStub:
+    def __init__(self):
+        self.requests: list[dict] = []
+        self._script: list[int | float] = []  # status codes to answer with, or seconds to stall
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_port}"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def fail(self, *steps: int | float):
+        """Answer the next requests with these status codes (int) or stall for these seconds (float)."""
+        with self._lock:
+            self._script.extend(steps)
+
+    def paths(self) -> list[str]:
+        return [r["path"] for r in self.requests]
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+                with stub._lock:
+                    stub.requests.append({"path": self.path, "form": dict(parse_qsl(body)),
+                                          "idempotency_key": self.headers.get("Idempotency-Key")})
+                    step = stub._script.pop(0) if stub._script else None
+                if isinstance(step, float):
+                    time.sleep(step)
+                if isinstance(step, int):
+                    return self._send(step, {"error": {"type": "api_error", "message": f"stub {step}"}})
+                if self.path not in OBJECTS:
+                    return self._send(404, {"error": {"type": "invalid_request_error", "message": "no such path"}})
+                n = len(stub.requests)
+                obj = {"object": OBJECTS[self.path], "id": f"{OBJECTS[self.path].split('.')[0]}_{n}"}
+                if self.path != "/v1/customers":
+                    obj["url"] = f"https://stripe.test{self.path}/{n}"
+                self._send(200, obj)
+
+            def _send(self, code: int, payload: dict):
+                data = json.dumps(payload).encode()
+                try:
+                    self.send_response(code)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client gave up (timeout tests)
+
+        return Handler
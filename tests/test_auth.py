@@ -1,7 +1,15 @@
 import os
+import threading
+import time
 
+import psycopg2
+import psycopg2.extras
+from google.oauth2 import id_token
 from jose import jwt
 
+import app as app_module
+from app import GoogleAuthRequest, google_auth
+
 
 def test_signup_returns_token(client):
     r = client.post("/auth/signup", json={"email": "new@example.com", "password": "secret"})
@@ -47,3 +55,89 @@ def test_tokens_are_valid_jwts_with_correct_claims(client):
         assert "sub" in claims
         assert "exp" in claims
         assert claims["sub"].isdigit()
+
+
+def test_emails_match_regardless_of_case(client, db_conn):
+    assert client.post("/auth/signup", json={"email": " Mixed@Example.com ", "password": "pw"}).status_code == 200
+    assert client.post("/auth/signup", json={"email": "mixed@example.COM", "password": "pw"}).status_code == 409
+    assert client.post("/auth/login", json={"email": "MIXED@example.com", "password": "pw"}).status_code == 200
+    with db_conn.cursor() as cur:
+        cur.execute("SELECT email FROM users WHERE lower(email) = 'mixed@example.com'")
+        assert [r["email"] for r in cur.fetchall()] == ["mixed@example.com"]
+
+
+def test_reset_email_goes_to_the_stored_address(client, monkeypatch):
+    sent = []
+
+    class StubClient:
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            pass
+
+        async def post(self, url, **kwargs):
+            sent.append(kwargs["json"]["to"])
+
+    monkeypatch.setattr(app_module.httpx, "AsyncClient", StubClient)
+    client.post("/auth/signup", json={"email": "reset@example.com", "password": "secret123"})
+    r = client.post("/auth/forgot-password", json={"email": "  Reset@Example.COM "})
+    assert r.status_code == 200 and sent == [["reset@example.com"]]
+
+
+def test_taken_email_skips_bcrypt(client, monkeypatch):
+    client.post("/auth/signup", json={"email": "taken@example.com", "password": "pw"})
+
+    def fail(password):
+        raise AssertionError("hashed a password for a taken email")
+
+    monkeypatch.setattr(app_module, "hash_password", fail)
+    assert client.post("/auth/signup", json={"email": "Taken@example.com", "password": "pw"}).status_code == 409
+
+
+def test_email_lookups_use_the_lower_index(db_conn):
+    with db_conn.cursor() as cur:
+        cur.execute("SET LOCAL enable_seqscan = off")
+        cur.execute("EXPLAIN SELECT id, password_hash FROM users WHERE lower(email) = 'a@example.com'")
+        assert "users_email_lower" in " ".join(r["QUERY PLAN"] for r in cur.fetchall())
+
+
+def test_google_sign_in_creates_then_reuses_the_account(client, monkeypatch):
+    monkeypatch.setattr(app_module, "GOOGLE_CLIENT_ID", "client-id")
+    monkeypatch.setattr(id_token, "verify_oauth2_token", lambda *a: {"email": "G.User@example.com"})
+    subs = {jwt.get_unverified_claims(client.post("/auth/google", json={"credential": "x"}).json()["token"])["sub"]
+            for _ in range(2)}
+    assert len(subs) == 1
+    # An account made by a password signup is found too, and has no password to log in with.
+    signup = client.post("/auth/signup", json={"email": "pw.user@example.com", "password": "pw"}).json()
+    monkeypatch.setattr(id_token, "verify_oauth2_token", lambda *a: {"email": "PW.User@example.com"})
+    google = client.post("/auth/google", json={"credential": "x"}).json()
+    assert jwt.get_unverified_claims(google["token"])["sub"] == jwt.get_unverified_claims(signup["token"])["sub"]
+    r = client.post("/auth/login", json={"email": "g.user@example.com", "password": "pw"})
+    assert r.status_code == 401
+
+
+def test_concurrent_first_google_sign_ins_share_one_account(monkeypatch):
+    monkeypatch.setattr(app_module, "GOOGLE_CLIENT_ID", "client-id")
+    monkeypatch.setattr(id_token, "verify_oauth2_token", lambda *a: {"email": "race@example.com"})
+    first, second = (psycopg2.connect(os.environ["DATABASE_URL"], cursor_factory=psycopg2.extras.RealDictCursor)
+                     for _ in range(2))
+    req = GoogleAuthRequest(credential="x")
+    try:
+        winner = google_auth(req, None, db=first.cursor())  # inserted, not yet committed
+        results = []
+        loser = threading.Thread(target=lambda: results.append(google_auth(req, None, db=second.cursor())))
+        loser.start()
+        time.sleep(0.3)
+        assert loser.is_alive()  # its INSERT waits on the winner's row
+        first.commit()
+        loser.join(5)
+        assert [jwt.get_unverified_claims(r["token"])["sub"] for r in results] == \
+            [jwt.get_unverified_claims(winner["token"])["sub"]]
+    finally:
+        second.rollback()
+        with first.cursor() as cur:
+            cur.execute("DELETE FROM users WHERE email = 'race@example.com'")
+        first.commit()
+        first.close()
+        second.close()
@@ -0,0 +1,280 @@
+"""
+Benchmarks for the hot endpoints, gated against stored baselines.
+
+Each case seeds a user with a given amount of history inside the usual
+rolled-back transaction, then measures one endpoint three ways:
+
+  statements  SQL round-trips issued through the connection (exact — catches
+              an O(1) handler turning into O(sessions))
+  peak_kib    peak Python allocation during one request (tracemalloc)
+  median_ms   median wall time over ROUNDS requests
+
+Results are compared with tests/benchmark_baselines.json, using the
+tolerances stored in that file. After an intentional change, regenerate it
+with:
+
+    pytest tests/test_benchmarks.py --update-benchmarks
+
+Latency baselines are machine-dependent; record them on hardware comparable
+to CI, or loosen the median_ms tolerance.
+"""
+import hashlib
+import hmac
+import json
+import statistics
+import time
+import tracemalloc
+from pathlib import Path
+
+import psycopg2.extras
+import pytest
+
+import app as app_module
+from tests.helpers import auth_headers
+
+pytestmark = pytest.mark.benchmark
+
+BASELINES = Path(__file__).with_name("benchmark_baselines.json")
+HISTORY_SIZES = [0, 100, 1000]  # sessions per user
+ROUNDS = 5
+TASKS_PER_USER = 10
+DEFAULT_TOLERANCE = {"statements": 0, "peak_kib": 0.5, "median_ms": 1.0}
+LATENCY_SLACK_MS = 25  # absolute allowance so sub-millisecond baselines aren't flaky
+
+WEBHOOK_SECRET = "whsec_benchmark"
+
+
+def _load_baselines() -> dict:
+    if BASELINES.exists():
+        return json.loads(BASELINES.read_text())
+    return {"tolerance": DEFAULT_TOLERANCE, "results": {}}
+
+
+_baselines = _load_baselines()
+_measured: dict[str, dict] = {}
+
+
+@pytest.fixture(scope="module", autouse=True)
+def _write_baselines(request):
+    yield
+    if request.config.getoption("--update-benchmarks") and _measured:
+        results = {**_baselines["results"], **_measured}
+        out = {"tolerance": _baselines.get("tolerance", DEFAULT_TOLERANCE),
+               "results": dict(sorted(results.items()))}
+        BASELINES.write_text(json.dumps(out, indent=2) + "\n")
+
+
+# ---------------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------------
+
+@pytest.fixture
+def statement_counter(db_conn):
+    """Swap db_conn's cursor factory for one that counts execute/copy calls."""
+    counter = {"n": 0}
+
+    class CountingCursor(psycopg2.extras.RealDictCursor):
+        def execute(self, query, vars=None):
+            counter["n"] += 1
+            return super().execute(query, vars)
+
+        def executemany(self, query, vars_list):
+            counter["n"] += 1
+            return super().executemany(query, vars_list)
+
+        def copy_expert(self, sql, file, size=8192):
+            counter["n"] += 1
+            return super().copy_expert(sql, file, size)
+
+    db_conn.cursor_factory = CountingCursor
+    yield counter
+    db_conn.cursor_factory = psycopg2.extras.RealDictCursor
+
+
+def measure(call, counter) -> dict:
+    call()  # warm-up: first-request imports, prepared caches, JIT-ish paths
+
+    counter["n"] = 0
+    tracemalloc.start()
+    call()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    statements = counter["n"]
+
+    timings = []
+    for _ in range(ROUNDS):
+        t0 = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - t0) * 1000)
+
+    return {
+        "statements": statements,
+        "peak_kib": round(peak / 1024, 1),
+        "median_ms": round(statistics.median(timings), 2),
+    }
+
+
+def check_against_baseline(name: str, result: dict, update: bool):
+    if update:
+        _measured[name] = result
+        return
+    baseline = _baselines["results"].get(name)
+    if baseline is None:
+        pytest.skip(f"no baseline for {name}; run with --update-benchmarks")
+    tol = {**DEFAULT_TOLERANCE, **_baselines.get("tolerance", {})}
+    failures = []
+    for metric, value in result.items():
+        limit = baseline[metric] * (1 + tol[metric])
+        if metric == "median_ms":
+            limit += LATENCY_SLACK_MS
+        if value > limit:
+            failures.append(f"{metric}: {value} > {limit:g} (baseline {baseline[metric]})")
+    assert not failures, f"{name} regressed: " + "; ".join(failures)
+
+
+# ---------------------------------------------------------------------------
+# Fixtures: a user with history
+# ---------------------------------------------------------------------------
+
+def seed_history(db_conn, user_id: int, sessions: int):
+    """`sessions` half-hour sessions, one per hour, spread over TASKS_PER_USER tasks."""
+    cur = db_conn.cursor()
+    cur.execute("""
+        INSERT INTO tasks (id, user_id, name)
+        SELECT 'bench-' || g, %s, 'task ' || g FROM generate_series(1, %s) g
+    """, (user_id, TASKS_PER_USER))
+    seed_sessions(db_conn, user_id, 1, sessions)
+    cur.execute("""
+        INSERT INTO later_items (id, user_id, text, position)
+        SELECT 'later-' || g, %s, 'later ' || g, 'V' || g FROM generate_series(1, 3) g
+    """, (user_id,))
+
+
+def seed_sessions(db_conn, user_id: int, first: int, last: int):
+    """Sessions number first..last of seed_history's hourly series."""
+    db_conn.cursor().execute("""
+        INSERT INTO sessions (task_id, user_id, start_ts, end_ts)
+        SELECT 'bench-' || (1 + g %% %s), %s,
+               1700000000000 - g::bigint * 3600000,
+               1700000000000 - g::bigint * 3600000 + 1800000
+        FROM generate_series(%s, %s) g
+    """, (TASKS_PER_USER, user_id, first, last))
+
+
+@pytest.fixture(params=HISTORY_SIZES, ids=lambda n: f"{n}")
+def history(request, client, db_conn, alice):
+    cur = db_conn.cursor()
+    cur.execute("SELECT id FROM users WHERE email = %s", (alice["email"],))
+    seed_history(db_conn, cur.fetchone()["id"], request.param)
+    return {"size": request.param, "headers": auth_headers(alice["token"]), **alice}
+
+
+def _signed(payload: bytes) -> dict:
+    ts = int(time.time())
+    sig = hmac.new(WEBHOOK_SECRET.encode(), f"{ts}.".encode() + payload, hashlib.sha256).hexdigest()
+    return {"stripe-signature": f"t={ts},v1={sig}", "content-type": "application/json"}
+
+
+# ---------------------------------------------------------------------------
+# Benchmarks
+# ---------------------------------------------------------------------------
+
+def test_get_data(request, client, history, statement_counter):
+    def call():
+        assert client.get("/data", headers=history["headers"]).status_code == 200
+
+    result = measure(call, statement_counter)
+    check_against_baseline(f"get_data[{history['size']}]", result,
+                           request.config.getoption("--update-benchmarks"))
+
+
+def test_post_data_unchanged_state(request, client, history, statement_counter):
+    """The common autosave case: the full document comes back with nothing changed."""
+    body = client.get("/data", headers=history["headers"]).content
+
+    def call():
+        assert client.post("/data", content=body, headers=history["headers"]).status_code == 204
+
+    result = measure(call, statement_counter)
+    check_against_baseline(f"post_data[{history['size']}]", result,
+                           request.config.getoption("--update-benchmarks"))
+
+
+def test_session_start(request, client, history, statement_counter):
+    def call():
+        assert client.post("/sessions/start", headers=history["headers"]).status_code in (200, 402)
+
+    result = measure(call, statement_counter)
+    check_against_baseline(f"session_start[{history['size']}]", result,
+                           request.config.getoption("--update-benchmarks"))
+
+
+def test_login(request, client, history, statement_counter):
+    creds = {"email": history["email"], "password": "alicepw123"}
+
+    def call():
+        assert client.post("/auth/login", json=creds).status_code == 200
+
+    result = measure(call, statement_counter)
+    check_against_baseline(f"login[{history['size']}]", result,
+                           request.config.getoption("--update-benchmarks"))
+
+
+def test_billing_webhook(request, client, history, statement_counter, db_conn, monkeypatch):
+    monkeypatch.setattr(app_module, "STRIPE_WEBHOOK_SECRET", WEBHOOK_SECRET)
+    db_conn.cursor().execute(
+        "UPDATE users SET subscription_id = 'sub_bench' WHERE email = %s", (history["email"],)
+    )
+    payload = json.dumps({
+        "id": "evt_bench", "object": "event", "type": "customer.subscription.updated",
+        "data": {"object": {"id": "sub_bench", "object": "subscription",
+                            "status": "active", "current_period_end": 1900000000}},
+    }).encode()
+
+    def call():
+        r = client.post("/billing/webhook", content=payload, headers=_signed(payload))
+        assert r.status_code == 200
+
+    result = measure(call, statement_counter)
+    check_against_baseline(f"billing_webhook[{history['size']}]", result,
+                           request.config.getoption("--update-benchmarks"))
+
+
+def test_read_paths_are_constant_in_history_size(client, db_conn, alice, statement_counter, monkeypatch):
+    """Independent of stored baselines: these handlers must not issue per-session queries."""
+    monkeypatch.setattr(app_module, "STRIPE_WEBHOOK_SECRET", WEBHOOK_SECRET)
+    cur = db_conn.cursor()
+    cur.execute("UPDATE users SET subscription_id = 'sub_bench' WHERE email = %s RETURNING id",
+                (alice["email"],))
+    user_id = cur.fetchone()["id"]
+    headers = auth_headers(alice["token"])
+    payload = json.dumps({
+        "id": "evt_bench", "object": "event", "type": "customer.subscription.updated",
+        "data": {"object": {"id": "sub_bench", "object": "subscription",
+                            "status": "active", "current_period_end": 1900000000}},
+    }).encode()
+    calls = {
+        "get_data": lambda: client.get("/data", headers=headers),
+        "session_start": lambda: client.post("/sessions/start", headers=headers),
+        "login": lambda: client.post("/auth/login", json={"email": alice["email"], "password": "alicepw123"}),
+        "billing_webhook": lambda: client.post("/billing/webhook", content=payload, headers=_signed(payload)),
+    }
+
+    def count_statements() -> dict:
+        # The webhook activates the subscription, which would let session_start skip its quota check.
+        cur.execute("UPDATE users SET subscription_status = 'free' WHERE id = %s", (user_id,))
+        counts = {}
+        for endpoint, call in calls.items():
+            call()  # warm-up, as in measure()
+            statement_counter["n"] = 0
+            assert call().status_code < 500
+            counts[endpoint] = statement_counter["n"]
+        return counts
+
+    seed_history(db_conn, user_id, HISTORY_SIZES[0])
+    small = count_statements()
+    seed_sessions(db_conn, user_id, HISTORY_SIZES[0] + 1, HISTORY_SIZES[-1])
+    large = count_statements()
+    for endpoint in calls:
+        assert small[endpoint] == large[endpoint], \
+            f"{endpoint} statement count varies with history: {small[endpoint]} -> {large[endpoint]}"
@@ -0,0 +1,181 @@
+"""
+Tests for the Stripe client layer (billing.py) and the checkout and portal
+endpoints, against a local stub of the Stripe API.
+"""
+import os
+
+import anyio
+import pytest
+import stripe
+
+import app as app_module
+from app import ConnectionPool, get_db, run_in_db
+from billing import BillingClient, BillingUnavailable, CircuitBreaker
+from tests.helpers import auth_headers
+from tests.stripe_stub import StripeStub
+
+_DB_URL = os.environ["DATABASE_URL"]
+
+
+@pytest.fixture
+def stub():
+    s = StripeStub()
+    yield s
+    s.close()
+
+
+def make_client(stub, **kwargs) -> BillingClient:
+    options = {"timeout": 0.3, "retries": 2, "backoff": 0, "breaker": CircuitBreaker(threshold=2)}
+    return BillingClient("sk_test_stub", api_base=stub.url, **{**options, **kwargs})
+
+
+@pytest.fixture
+def billing(stub, monkeypatch):
+    client = make_client(stub)
+    monkeypatch.setattr(app_module, "billing_client", client)
+    return client
+
+
+def checkout(client, user, **body):
+    return client.post("/billing/checkout", json=body, headers=auth_headers(user["token"]))
+
+
+# ---------------------------------------------------------------------------
+# Endpoints
+# ---------------------------------------------------------------------------
+
+def test_checkout_creates_the_customer_once(client, alice, stub, billing):
+    r = checkout(client, alice)
+    assert r.status_code == 200
+    assert r.json()["url"].startswith("https://stripe.test/v1/checkout/sessions/")
+    assert checkout(client, alice).status_code == 200
+    assert stub.paths() == ["/v1/customers", "/v1/checkout/sessions", "/v1/checkout/sessions"]
+    customer, session = stub.requests[0], stub.requests[1]
+    assert customer["form"]["email"] == alice["email"] and customer["form"]["metadata[user_id]"].isdigit()
+    assert session["form"]["customer"] == stub.requests[2]["form"]["customer"] == "customer_1"
+    assert session["form"]["subscription_data[trial_period_days]"] == "30"
+
+
+def test_checkout_carries_over_the_guest_trial(client, alice, stub, billing):
+    started = int((app_module.datetime.now(app_module.timezone.utc).timestamp() - 86400) * 1000)
+    assert checkout(client, alice, guest_trial_start=started).status_code == 200
+    assert int(stub.requests[-1]["form"]["subscription_data[trial_end]"]) == started // 1000 + 30 * 86400
+
+
+def test_guest_trial_is_recorded_only_once_stripe_answers(client, db_conn, alice, stub, billing):
+    started = int((app_module.datetime.now(app_module.timezone.utc).timestamp() - 86400) * 1000)
+
+    def trial_started_at():
+        cur = db_conn.cursor()
+        cur.execute("SELECT trial_started_at FROM users WHERE email = %s", (alice["email"],))
+        return cur.fetchone()["trial_started_at"]
+
+    stub.fail(*[503] * 3)
+    assert checkout(client, alice, guest_trial_start=started).status_code == 503
+    assert trial_started_at() is None
+    assert checkout(client, alice, guest_trial_start=started).status_code == 200
+    assert int(trial_started_at().timestamp() * 1000) == started
+
+
+def test_transient_failures_are_retried_with_the_same_idempotency_key(client, alice, stub, billing):
+    stub.fail(500, 0.6)  # an error, then a response slower than the timeout
+    assert checkout(client, alice).status_code == 200
+    customers = [r for r in stub.requests if r["path"] == "/v1/customers"]
+    assert len(customers) == 3
+    assert len({r["idempotency_key"] for r in customers}) == 1
+    assert billing.breaker.state == "closed"
+
+
+def test_outage_answers_503_then_fails_fast(client, alice, stub, billing):
+    stub.fail(*[503] * 6)
+    for _ in range(2):  # threshold=2 calls of 3 attempts each
+        r = checkout(client, alice)
+        assert r.status_code == 503
+    assert len(stub.requests) == 6 and billing.breaker.state == "open"
+    assert checkout(client, alice).status_code == 503
+    assert len(stub.requests) == 6  # Stripe was not called
+
+
+def test_portal_needs_a_customer(client, alice, stub, billing):
+    r = client.get("/billing/portal", headers=auth_headers(alice["token"]))
+    assert r.status_code == 400
+    checkout(client, alice)
+    r = client.get("/billing/portal", headers=auth_headers(alice["token"]))
+    assert r.status_code == 200 and r.json()["url"].startswith("https://stripe.test/v1/billing_portal/")
+    assert stub.requests[-1]["form"] == {"customer": "customer_1", "return_url": f"{app_module.APP_URL}/"}
+
+
+def test_billing_handlers_hold_no_connection_while_calling_stripe(monkeypatch):
+    for path in ("/billing/checkout", "/billing/portal"):
+        route = next(r for r in app_module.app.routes if getattr(r, "path", None) == path)
+        assert get_db not in [d.call for d in route.dependant.dependencies]
+
+    pool = ConnectionPool(_DB_URL, size=1, timeout=0.2)
+    monkeypatch.setattr(app_module, "db_pool", pool)
+
+    def backend_pid(cur):
+        cur.execute("SELECT pg_backend_pid() AS pid")
+        return cur.fetchone()["pid"]
+
+    async def scenario():
+        assert await run_in_db(backend_pid)
+        async with pool.slot():  # the only connection is free again
+            pass
+
+    try:
+        anyio.run(scenario)
+    finally:
+        pool.close()
+
+
+# ---------------------------------------------------------------------------
+# BillingClient and CircuitBreaker
+# ---------------------------------------------------------------------------
+
+def test_refused_requests_are_not_retried_and_do_not_trip_the_breaker(stub):
+    client = make_client(stub)
+    stub.fail(400)
+    with pytest.raises(stripe.InvalidRequestError):
+        anyio.run(client.portal_url, "cus_x", "https://example.test/")
+    assert len(stub.requests) == 1 and client.breaker.state == "closed"
+
+
+def test_breaker_half_opens_for_one_trial_call():
+    now = [0.0]
+    breaker = CircuitBreaker(threshold=2, reset_seconds=10, clock=lambda: now[0])
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    now[0] = 10
+    assert breaker.allow() and not breaker.allow()  # one trial at a time
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    now[0] = 20
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.failures == 0
+
+
+def test_open_circuit_raises_without_a_request(stub):
+    client = make_client(stub, breaker=CircuitBreaker(threshold=1))
+    client.breaker.record_failure()
+    with pytest.raises(BillingUnavailable):
+        anyio.run(client.create_customer, "a@example.com", 1)
+    assert stub.requests == []
+
+
+def test_client_setup_failure_releases_the_trial_call(stub, monkeypatch):
+    now = [0.0]
+    client = make_client(stub, breaker=CircuitBreaker(threshold=1, reset_seconds=10, clock=lambda: now[0]))
+    client.breaker.record_failure()
+    now[0] = 10
+
+    def broken():
+        raise RuntimeError("no event loop")
+    monkeypatch.setattr(client, "_stripe", broken)
+    with pytest.raises(RuntimeError):
+        anyio.run(client.portal_url, "cus_x", "https://example.test/")
+    assert client.breaker.allow()  # the half-open trial is free again
@@ -0,0 +1,102 @@
+"""
+Tests for the inline bootstrap: GET / embedding the signed-in user's /data and
+billing state, selected by the tt_boot cookie.
+"""
+import json
+import os
+import re
+
+import pytest
+
+import app as app_module
+from tests.helpers import auth_headers
+
+BOOT_RE = re.compile(r'<script id="tt-bootstrap" type="application/json">(.*?)</script>', re.S)
+
+
+def bootstrap(html: str) -> dict | None:
+    m = BOOT_RE.search(html)
+    return json.loads(m.group(1)) if m else None
+
+
+def page(client, token: str | None = None, path: str = "/"):
+    client.cookies.clear()
+    if token is not None:
+        client.cookies.set(app_module.BOOTSTRAP_COOKIE, token)
+    r = client.get(path)
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/html")
+    assert r.headers["vary"] == "Cookie"
+    return r
+
+
+def save(client, user, payload: dict):
+    r = client.post("/data", content=json.dumps(payload), headers=auth_headers(user["token"]))
+    assert r.status_code == 204
+
+
+def test_page_without_cookie_is_the_static_template(client):
+    r = page(client)
+    with open("index.html") as f:
+        assert r.text == f.read()
+    assert r.headers["cache-control"] == "no-cache"
+
+
+@pytest.mark.parametrize("token", ["", "not-a-jwt", "a.b.c"])
+def test_bad_cookie_falls_back_to_the_static_page(client, token):
+    assert bootstrap(page(client, token).text) is None
+
+
+def test_page_embeds_data_and_billing_state(client, alice):
+    save(client, alice, {
+        "tasks": [{"id": "t1", "name": "writing", "sessions": [{"start": 1000, "end": 2000}]}],
+        "later": [{"id": "l1", "text": "read"}],
+    })
+    r = page(client, alice["token"])
+    boot = bootstrap(r.text)
+    headers = auth_headers(alice["token"])
+    assert boot["data"] == client.get("/data", headers=headers).json()
+    assert boot["billing"] == client.get("/billing/status", headers=headers).json()
+    assert boot["user"] == app_module.jwt.get_unverified_claims(alice["token"])["sub"]
+    assert r.headers["cache-control"] == "private, no-store"
+    # The bootstrap sits right before app.js, which reads it.
+    assert r.text.index("tt-bootstrap") < r.text.index('<script src="/static/app.js">')
+
+
+def test_billing_success_page_is_bootstrapped_too(client, alice):
+    assert bootstrap(page(client, alice["token"], "/billing/success").text)["billing"]["subscription_status"] == "free"
+
+
+def test_embedded_json_cannot_close_the_script(client, alice):
+    name = "</script><script>alert(1)</script>"
+    save(client, alice, {"tasks": [{"id": "t1", "name": name, "sessions": []}], "later": []})
+    html = page(client, alice["token"]).text
+    assert "</script><script>alert" not in html
+    assert bootstrap(html)["data"]["tasks"][0]["name"] == name
+
+
+def test_deleted_user_gets_the_static_page(client, alice, db_conn):
+    with db_conn.cursor() as cur:
+        cur.execute("DELETE FROM users WHERE email = %s", (alice["email"],))
+    assert bootstrap(page(client, alice["token"]).text) is None
+
+
+def test_bootstrap_can_be_turned_off(client, alice, monkeypatch):
+    monkeypatch.setattr(app_module, "INLINE_BOOTSTRAP", False)
+    assert bootstrap(page(client, alice["token"]).text) is None
+
+
+def test_template_is_cached_until_the_file_changes(client, tmp_path, monkeypatch):
+    (tmp_path / "index.html").write_text('<p>one</p><script src="/static/app.js"></script>')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(app_module, "_index_cache", {})
+    assert app_module.index_template() == (b"<p>one</p>", b'<script src="/static/app.js"></script>')
+    reads = []
+    real_open = open
+    monkeypatch.setattr("builtins.open", lambda *a, **k: reads.append(a) or real_open(*a, **k))
+    app_module.index_template()
+    assert reads == []
+
+    (tmp_path / "index.html").write_text('<p>two</p><script src="/static/app.js"></script>')
+    os.utime(tmp_path / "index.html", ns=(0, 10**18))
+    assert app_module.index_template()[0] == b"<p>two</p>"
@@ -0,0 +1,128 @@
+"""
+Tests for weekly share cards: rendering, the content-addressed disk cache,
+and the public /cards endpoint with its ETag handling.
+"""
+import asyncio
+import io
+import json
+import os
+import time
+
+import pytest
+from PIL import Image
+
+import app as app_module
+from cards import CardCache, CardRenderer, card_key, render_week
+from tests.helpers import auth_headers
+
+HOUR = 3_600_000
+
+SUMMARY = {
+    "week_start": "2026-10-13", "week_end": "2026-10-19", "total_ms": 9 * HOUR,
+    "top": [{"name": "deep work " * 10, "total_ms": 6 * HOUR}, {"name": "email", "total_ms": 3 * HOUR}],
+}
+
+
+@pytest.fixture
+def cards(tmp_path, monkeypatch):
+    """Render in a thread and cache under tmp_path for the duration of a test."""
+    cache = CardCache(tmp_path, max_bytes=10 * 1024 * 1024)
+    monkeypatch.setattr(app_module, "card_cache", cache)
+    monkeypatch.setattr(app_module, "card_renderer", CardRenderer(0))
+    return cache
+
+
+def save_recent(client, user, hours: dict[str, float]):
+    now = int(time.time() * 1000)
+    payload = {"tasks": [{"id": name, "name": name,
+                          "sessions": [{"start": now - HOUR - int(h * HOUR), "end": now - HOUR}]}
+                         for name, h in hours.items()], "later": []}
+    r = client.post("/data", content=json.dumps(payload), headers=auth_headers(user["token"]))
+    assert r.status_code == 204
+
+
+def share_path(client, user) -> str:
+    r = client.post("/share/card", headers=auth_headers(user["token"]))
+    assert r.status_code == 200
+    return "/cards/" + r.json()["url"].rsplit("/cards/", 1)[1]
+
+
+# ---------------------------------------------------------------------------
+# Rendering and cache
+# ---------------------------------------------------------------------------
+
+@pytest.mark.parametrize("summary", [SUMMARY, {**SUMMARY, "total_ms": 0, "top": []}])
+def test_render_week_is_a_share_sized_png(summary):
+    img = Image.open(io.BytesIO(render_week(summary)))
+    assert (img.format, img.size) == ("PNG", (1200, 630))
+
+
+def test_process_pool_renders_the_same_image_and_stops_when_idle():
+    renderer = CardRenderer(1, idle_seconds=0.05)
+    try:
+        assert asyncio.run(renderer.render(SUMMARY)) == render_week(SUMMARY)
+        deadline = time.monotonic() + 5
+        while renderer._executor is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert renderer._executor is None
+        assert asyncio.run(renderer.render(SUMMARY)) == render_week(SUMMARY)  # restarts on demand
+    finally:
+        renderer.close()
+
+
+def test_card_key_follows_content():
+    assert card_key(SUMMARY) == card_key(json.loads(json.dumps(SUMMARY)))
+    assert card_key(SUMMARY) != card_key({**SUMMARY, "total_ms": SUMMARY["total_ms"] + 1})
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = CardCache(tmp_path, max_bytes=250)
+    cache.put("a", b"x" * 100)
+    cache.put("b", b"x" * 100)
+    os.utime(cache.path("a"), (1, 1))
+    os.utime(cache.path("b"), (2, 2))
+    assert cache.get("a") is not None  # a is now the most recent
+    cache.put("c", b"x" * 100)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.png", "c.png"]
+
+
+# ---------------------------------------------------------------------------
+# Endpoints
+# ---------------------------------------------------------------------------
+
+def test_card_shows_the_week_and_revalidates_with_etag(client, alice, cards):
+    save_recent(client, alice, {"deep work": 2, "email": 0.5})
+    path = share_path(client, alice)
+    assert share_path(client, alice) == path  # stable until turned off
+
+    r = client.get(path)
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "image/png"
+    etag = r.headers["etag"]
+    assert Image.open(io.BytesIO(r.content)).size == (1200, 630)
+    assert len(list(cards.directory.glob("*.png"))) == 1
+
+    r2 = client.get(path)  # served from the disk cache
+    assert (r2.status_code, r2.headers["etag"], r2.content) == (200, etag, r.content)
+    assert client.get(path, headers={"If-None-Match": etag}).status_code == 304
+
+    save_recent(client, alice, {"deep work": 3, "email": 0.5})
+    assert client.get(path, headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_card_summary_ranks_tasks(client, alice, db_conn):
+    save_recent(client, alice, {"email": 0.5, "deep work": 2})
+    path = share_path(client, alice)
+    summary = app_module.card_summary(db_conn.cursor(), path.removeprefix("/cards/").removesuffix(".png"))
+    assert [t["name"] for t in summary["top"]] == ["deep work", "email"]
+    assert summary["total_ms"] == int(2.5 * HOUR)
+
+
+def test_turning_sharing_off_hides_the_card(client, alice, cards):
+    path = share_path(client, alice)
+    assert client.get(path).status_code == 200
+    assert client.delete("/share/card", headers=auth_headers(alice["token"])).status_code == 204
+    assert client.get(path).status_code == 404
+    assert client.get("/cards/not-a-token.png").status_code == 404
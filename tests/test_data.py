@@ -1,5 +1,10 @@
+import gzip
 import json
 
+import pytest
+
+import app as app_module
+from app import COLUMNAR_TYPE, POSITION_MAX_LEN, from_columnar, position_between, positions_between, to_columnar
 from tests.helpers import auth_headers
 
 
@@ -121,3 +126,175 @@ def test_session_end_update(client, alice):
     r = client.get("/data", headers=auth_headers(alice["token"]))
     session = r.json()["tasks"][0]["sessions"][0]
     assert session["end"] == now + 3600_000
+
+
+def test_tasks_carry_activity_summary(client, alice):
+    now = 1_700_000_000_000
+    payload = {"tasks": [{"id": "t1", "name": "Task", "sessions": [
+        {"start": now, "end": now + 1000},
+        {"start": now + 5000, "end": now + 7000},
+        {"start": now + 9000, "end": None},
+    ]}], "later": []}
+    client.post("/data", content=json.dumps(payload), headers=auth_headers(alice["token"]))
+    r = client.get("/tasks", headers=auth_headers(alice["token"]))
+    assert r.status_code == 200
+    assert r.json()["tasks"] == [{
+        "id": "t1", "name": "Task",
+        "last_started_at": now + 9000, "total_ms": 3000, "session_count": 3,
+    }]
+
+
+def test_activity_summary_follows_session_edits(client, alice):
+    now = 1_700_000_000_000
+    first = {"tasks": [{"id": "t1", "name": "Task", "sessions": [
+        {"start": now, "end": now + 1000},
+        {"start": now + 5000, "end": None},
+    ]}], "later": []}
+    # Latest session removed, earlier one extended.
+    second = {"tasks": [{"id": "t1", "name": "Task", "sessions": [
+        {"start": now, "end": now + 4000},
+    ]}], "later": []}
+    client.post("/data", content=json.dumps(first), headers=auth_headers(alice["token"]))
+    client.post("/data", content=json.dumps(second), headers=auth_headers(alice["token"]))
+    task = client.get("/tasks", headers=auth_headers(alice["token"])).json()["tasks"][0]
+    assert task["last_started_at"] == now
+    assert task["total_ms"] == 4000
+    assert task["session_count"] == 1
+
+
+def test_tasks_ordered_by_most_recent_session(client, alice):
+    now = 1_700_000_000_000
+    payload = {"tasks": [
+        {"id": "old", "name": "Old", "sessions": [{"start": now, "end": now + 1}]},
+        {"id": "idle", "name": "Idle", "sessions": []},
+        {"id": "new", "name": "New", "sessions": [{"start": now + 10, "end": now + 11}]},
+    ], "later": []}
+    client.post("/data", content=json.dumps(payload), headers=auth_headers(alice["token"]))
+    for path in ("/data", "/tasks"):
+        r = client.get(path, headers=auth_headers(alice["token"]))
+        assert [t["id"] for t in r.json()["tasks"]] == ["new", "old", "idle"]
+
+
+def _later_rows(db_conn):
+    cur = db_conn.cursor()
+    cur.execute("SELECT id, position, ctid::text AS ctid FROM later_items ORDER BY position")
+    return {r["id"]: (r["position"], r["ctid"]) for r in cur.fetchall()}
+
+
+def _save_later(client, alice, ids, text=lambda i: f"item {i}"):
+    payload = {"tasks": [], "later": [{"id": i, "text": text(i)} for i in ids]}
+    r = client.post("/data", content=json.dumps(payload), headers=auth_headers(alice["token"]))
+    assert r.status_code == 204
+
+
+def test_later_items_keep_order_through_edits(client, alice):
+    _save_later(client, alice, ["a", "b", "c", "d"])
+    for ids in (["d", "a", "b", "c"], ["d", "a", "x", "b", "c"], ["a", "x", "c"], ["c", "x", "a", "y"]):
+        _save_later(client, alice, ids)
+        r = client.get("/data", headers=auth_headers(alice["token"]))
+        assert [i["id"] for i in r.json()["later"]] == ids
+
+
+def test_moving_one_later_item_rewrites_only_that_row(client, alice, db_conn):
+    _save_later(client, alice, ["a", "b", "c", "d", "e"])
+    before = _later_rows(db_conn)
+    _save_later(client, alice, ["a", "d", "b", "c", "e"])
+    after = _later_rows(db_conn)
+    assert [k for k in before if before[k] != after[k]] == ["d"]
+
+
+def test_unchanged_later_list_is_not_rewritten(client, alice, db_conn):
+    _save_later(client, alice, ["a", "b", "c"])
+    before = _later_rows(db_conn)
+    _save_later(client, alice, ["a", "b", "c"])
+    assert _later_rows(db_conn) == before
+    _save_later(client, alice, ["a", "b", "c"], text=lambda i: "edited" if i == "b" else f"item {i}")
+    after = _later_rows(db_conn)
+    assert [k for k in before if before[k] != after[k]] == ["b"]
+    assert after["b"][0] == before["b"][0]  # text edit keeps the key
+
+
+def test_position_keys_stay_ordered_and_short():
+    keys = positions_between(None, None, 1000)
+    assert keys == sorted(keys) and len(set(keys)) == 1000
+    assert max(len(k) for k in keys) <= 3
+    a, b = keys[10], keys[11]
+    k = position_between(a, b)
+    assert a < k < b and not k.endswith("0")
+    assert position_between(None, keys[0]) < keys[0]
+    assert position_between(keys[-1], None) > keys[-1]
+    assert POSITION_MAX_LEN >= 8
+
+
+def test_long_keys_are_respaced(client, alice, db_conn):
+    ids = ["a"]
+    _save_later(client, alice, ids)
+    for n in range(200):  # always insert at the front: the worst case for key length
+        ids.insert(0, f"n{n}")
+        _save_later(client, alice, ids)
+    rows = _later_rows(db_conn)
+    assert max(len(pos) for pos, _ in rows.values()) <= POSITION_MAX_LEN
+    r = client.get("/data", headers=auth_headers(alice["token"]))
+    assert [i["id"] for i in r.json()["later"]] == ids
+
+
+# ---------------------------------------------------------------------------
+# Wire formats
+# ---------------------------------------------------------------------------
+
+NOW = 1_700_000_000_000
+DOC = {"tasks": [
+    {"id": "a", "name": "Write", "sessions": [{"start": NOW + i * 7_200_000, "end": NOW + i * 7_200_000 + 1_500_000}
+                                             for i in range(60)] + [{"start": NOW + 10**9, "end": None}]},
+    {"id": "b", "name": "Read", "sessions": []},
+], "later": [{"id": "l1", "text": "call"}]}
+
+
+def test_columnar_layout_round_trips():
+    col = to_columnar(DOC)
+    assert col["tasks"][0]["starts"][:3] == [NOW, 7_200_000, 7_200_000]
+    assert col["tasks"][0]["lengths"][-1] is None
+    assert from_columnar(json.loads(json.dumps(col))) == DOC
+
+
+def test_gzipped_columnar_post_and_get(client, alice, db_conn):
+    headers = {**auth_headers(alice["token"]), "Content-Type": COLUMNAR_TYPE, "Content-Encoding": "gzip"}
+    body = gzip.compress(json.dumps(to_columnar(DOC)).encode())
+    assert client.post("/data", content=body, headers=headers).status_code == 204
+
+    r = client.get("/data", headers={**auth_headers(alice["token"]), "Accept": COLUMNAR_TYPE})
+    assert r.headers["content-type"] == COLUMNAR_TYPE
+    assert r.headers["content-encoding"] == "gzip"  # httpx decompresses r.content
+    assert from_columnar(r.json()) == DOC
+    assert client.get("/data", headers=auth_headers(alice["token"])).json()["tasks"][0] == DOC["tasks"][0]
+
+    # The rollback blob stays in the row format.
+    with db_conn.cursor() as cur:
+        cur.execute("SELECT tasks_json FROM user_data")
+        assert json.loads(cur.fetchone()["tasks_json"]) == DOC
+
+
+def test_small_responses_are_not_gzipped(client, alice):
+    r = client.get("/data", headers=auth_headers(alice["token"]))
+    assert "content-encoding" not in r.headers and r.headers["vary"] == "Accept, Accept-Encoding"
+
+
+@pytest.mark.parametrize("headers,body,status", [
+    ({"Content-Encoding": "gzip"}, b"not gzip", 400),
+    ({"Content-Encoding": "br"}, b"{}", 415),
+    ({"Content-Type": COLUMNAR_TYPE}, b'{"tasks": [{"id": "a", "name": "x", "starts": [1], "lengths": []}]}', 400),
+    ({}, b"{not json", 400),
+    ({"Content-Type": COLUMNAR_TYPE}, b"[]", 400),
+    ({"Content-Type": COLUMNAR_TYPE}, b'{"tasks": [1]}', 400),
+    ({}, b"[]", 400),
+])
+def test_bad_bodies_are_rejected(client, alice, headers, body, status):
+    r = client.post("/data", content=body, headers={**auth_headers(alice["token"]), **headers})
+    assert r.status_code == status
+
+
+def test_decompressed_size_is_capped(client, alice, monkeypatch):
+    monkeypatch.setattr(app_module, "DATA_MAX_BYTES", 1000)
+    body = gzip.compress(json.dumps({"tasks": [], "later": [], "pad": "x" * 5000}).encode())
+    r = client.post("/data", content=body, headers={**auth_headers(alice["token"]), "Content-Encoding": "gzip"})
+    assert r.status_code == 413
@@ -0,0 +1,263 @@
+"""
+Tests for degraded mode (degraded.py): /data served from local snapshots and
+journaled saves while the database is unreachable, the pool's fail-fast
+circuit, and startup that doesn't wait for the database.
+"""
+import json
+import os
+import threading
+import time
+
+import anyio
+import pytest
+
+import app as app_module
+from app import ConnectionPool, load_data, replay_saved_data, save_data
+from degraded import DatabaseUnavailable, JournalFull, SnapshotCache, WriteJournal
+from shards import ShardMap
+from tests.helpers import auth_headers
+
+_DB_URL = os.environ["DATABASE_URL"]
+DEAD_URL = "postgresql://postgres@127.0.0.1:1/tt"  # nothing listens on port 1
+DOC = {"tasks": [{"id": "t1", "name": "Write", "sessions": [{"start": 1000, "end": 2000}]}],
+       "later": [{"id": "l1", "text": "read"}]}
+
+
+@pytest.fixture
+def stores(tmp_path, monkeypatch):
+    snapshots = SnapshotCache(tmp_path / "snapshots", max_bytes=1024 * 1024)
+    journal = WriteJournal(tmp_path / "journal", max_bytes=1024 * 1024)
+    monkeypatch.setattr(app_module, "snapshots", snapshots)
+    monkeypatch.setattr(app_module, "journal", journal)
+    return snapshots, journal
+
+
+@pytest.fixture
+def outage(client, stores, monkeypatch):
+    """Call it to take the database away: the client's overrides go and every pool points nowhere."""
+    def go_down() -> ConnectionPool:
+        pool = ConnectionPool(DEAD_URL, size=1, retry_seconds=60)
+        monkeypatch.setattr(app_module, "db_pool", pool)
+        monkeypatch.setattr(app_module, "shard_pools", [pool])
+        app_module.app.dependency_overrides.clear()
+        return pool
+    return go_down
+
+
+def user_id(user) -> int:
+    return int(app_module.jwt.get_unverified_claims(user["token"])["sub"])
+
+
+def save(client, user, doc: dict) -> int:
+    return client.post("/data", content=json.dumps(doc), headers=auth_headers(user["token"])).status_code
+
+
+def test_get_data_answers_from_the_snapshot(client, alice, outage):
+    headers = auth_headers(alice["token"])
+    assert save(client, alice, DOC) == 204
+    pool = outage()
+
+    r = client.get("/data", headers=headers)
+    assert r.status_code == 200 and r.json() == DOC
+    assert r.headers["cache-control"] == "no-store" and r.headers["x-snapshot-saved-at"].isdigit()
+    assert pool.breaker.state == "open"
+    r = client.get("/data", headers={**headers, "Accept": app_module.COLUMNAR_TYPE})
+    assert app_module.from_columnar(r.json()) == DOC
+
+    r = client.get("/billing/status", headers=headers)
+    assert r.status_code == 503 and r.headers["retry-after"] == "5"
+    assert client.get("/data?history=full", headers=headers).status_code == 503
+
+    client.cookies.set(app_module.BOOTSTRAP_COOKIE, alice["token"])
+    r = client.get("/")
+    assert r.status_code == 200 and "tt-bootstrap" not in r.text
+
+
+def test_get_data_fills_a_missing_snapshot(client, alice, stores, outage):
+    snapshots, _ = stores
+    client.get("/data", headers=auth_headers(alice["token"]))  # nothing saved yet: the empty document
+    assert snapshots.has(user_id(alice))
+    outage()
+    assert client.get("/data", headers=auth_headers(alice["token"])).json() == {"tasks": [], "later": []}
+
+
+def test_users_without_a_snapshot_get_503(client, alice, outage):
+    outage()
+    r = client.get("/data", headers=auth_headers(alice["token"]))
+    assert r.status_code == 503 and r.json()["detail"] == app_module.DB_UNAVAILABLE
+
+
+def test_saves_are_journaled_and_replayed(client, alice, stores, outage, db_conn):
+    _, journal = stores
+    assert save(client, alice, DOC) == 204
+    outage()
+
+    changed = {**DOC, "later": []}
+    assert save(client, alice, changed) == 202
+    assert client.get("/data", headers=auth_headers(alice["token"])).json() == changed
+    r = client.post("/data", content=b"{nope", headers=auth_headers(alice["token"]))
+    assert r.status_code == 400 and journal.pending() == 1
+    for bad in ({"tasks": [{"id": "x"}]},
+                {"tasks": [{"id": "x", "name": "X", "sessions": [{"end": 1}]}]},
+                {"tasks": [{"id": "x", "name": "X", "sessions": [{"start": "soon"}]}]},
+                {"tasks": [], "later": [{"id": "l1"}]}):
+        assert save(client, alice, bad) == 400  # would fail on replay, after a 202
+    assert client.get("/data", headers=auth_headers(alice["token"])).json() == changed
+
+    # The database is back.
+    uid = user_id(alice)
+    assert journal.replay(lambda uid, doc: replay_saved_data(db_conn.cursor(), uid, doc)) == 1
+    assert load_data(db_conn.cursor(), uid) == changed and journal.pending() == 0
+
+
+def test_a_later_save_wins_over_the_journal(client, alice, stores, db_conn):
+    _, journal = stores
+    uid = user_id(alice)
+    journal.put(uid, b'{"tasks":[]}', {}, saved_at=time.time() - 60)
+    stale = journal.get(uid)
+    assert save(client, alice, DOC) == 204
+    assert not journal.has(uid)  # the save superseded it
+    assert replay_saved_data(db_conn.cursor(), uid, stale) is None
+    assert load_data(db_conn.cursor(), uid) == DOC
+
+
+def save_elsewhere(db_conn, uid: int, doc: dict):
+    """A save through another machine, which leaves this one's snapshot alone."""
+    with db_conn.cursor() as cur:
+        save_data(cur, uid, json.dumps(doc).encode(), {})
+        # Every request here shares one transaction, and so one NOW().
+        cur.execute("UPDATE user_data SET updated_at = updated_at + interval '1 minute' WHERE user_id = %s",
+                    (uid,))
+
+
+def test_a_stale_snapshot_never_overwrites_a_save_made_elsewhere(client, alice, stores, outage, db_conn):
+    _, journal = stores
+    uid = user_id(alice)
+    assert save(client, alice, DOC) == 204
+    newer = {**DOC, "later": [{"id": "l2", "text": "newer"}]}
+    save_elsewhere(db_conn, uid, newer)
+    outage()
+
+    assert save(client, alice, {**DOC, "later": []}) == 202  # made over the snapshot's older version
+    assert journal.replay(lambda uid, doc: replay_saved_data(db_conn.cursor(), uid, doc)) == 1
+    assert load_data(db_conn.cursor(), uid) == newer
+
+
+def test_reads_refresh_a_stale_snapshot(client, alice, stores, db_conn):
+    snapshots, _ = stores
+    uid = user_id(alice)
+    assert save(client, alice, DOC) == 204
+    first = snapshots.header(uid)["version"]
+    newer = {**DOC, "later": []}
+    save_elsewhere(db_conn, uid, newer)
+
+    assert client.get("/data", headers=auth_headers(alice["token"])).json() == newer
+    held = snapshots.get(uid)
+    assert json.loads(held.body) == newer and held.version > first
+
+
+def test_saves_are_refused_without_a_journal_or_a_snapshot(client, alice, stores, outage, monkeypatch):
+    snapshots, _ = stores
+    assert save(client, alice, DOC) == 204
+    outage()
+    with monkeypatch.context() as m:
+        m.setattr(app_module, "journal", None)  # JOURNAL_DIR unset
+        r = client.post("/data", content=json.dumps(DOC), headers=auth_headers(alice["token"]))
+        assert r.status_code == 503 and r.headers["retry-after"] == "5"
+        assert client.get("/data", headers=auth_headers(alice["token"])).json() == DOC
+
+    snapshots.discard(user_id(alice))  # what would the save be made over?
+    assert save(client, alice, DOC) == 503
+
+
+def test_journal_replay_claims_restores_and_sets_aside(tmp_path):
+    journal = WriteJournal(tmp_path, max_bytes=1000)
+    journal.put(1, b'{"a":1}', {})
+    journal.put(2, b'{"b":2}', {"content-type": "text/plain"}, version="2026-10-19T09:00:00+00:00")
+    assert journal.get(2).version == "2026-10-19T09:00:00+00:00"
+    assert journal.get(2).headers == {"content-type": "text/plain", "content-encoding": "identity"}
+
+    def down(uid, doc):
+        raise DatabaseUnavailable("down")
+    with pytest.raises(DatabaseUnavailable):
+        journal.replay(down)
+    assert journal.pending() == 2 and sorted(os.listdir(tmp_path)) == ["1", "2"]
+
+    def apply(uid, doc):
+        if uid == 2:
+            raise ValueError("bad row")
+        seen.append(doc.body)
+    seen, log = [], []
+    assert journal.replay(apply, log=log.append) == 1
+    assert seen == [b'{"a":1}'] and sorted(os.listdir(tmp_path)) == [".failed-2"] and "user 2" in log[0]
+
+    os.rename(journal.path(1).with_name(".failed-2"), tmp_path / ".replaying-999999999-3")  # a dead worker's
+    assert journal.replay(lambda uid, doc: seen.append(uid)) == 1 and seen[-1] == 3
+
+    journal.put(4, bytes(800), {})
+    with pytest.raises(JournalFull):
+        journal.put(5, bytes(200), {})
+
+
+def test_snapshot_cache_evicts_the_least_recently_used(tmp_path):
+    cache = SnapshotCache(tmp_path, max_bytes=500, evict_every=0)  # two entries and their headers
+    for uid in (1, 2):
+        cache.put(uid, bytes(100), {})
+        os.utime(cache.path(uid), (uid, uid))
+    assert cache.get(1).body == bytes(100)  # 1 is now the most recently used
+    cache.put(3, bytes(100), {})
+    assert cache.has(1) and not cache.has(2) and cache.has(3)
+
+
+def test_pool_fails_fast_then_tries_again(monkeypatch):
+    pool = ConnectionPool(DEAD_URL, size=1, retry_seconds=0.2)
+
+    async def query():
+        async with pool.slot():
+            with pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1 AS one")
+                    return cur.fetchone()["one"]
+
+    with pytest.raises(DatabaseUnavailable):
+        anyio.run(query)
+    pool.url = _DB_URL  # the database comes back
+    with pytest.raises(DatabaseUnavailable, match="not retrying yet"):
+        anyio.run(query)
+    time.sleep(0.25)
+    try:
+        assert anyio.run(query) == 1 and pool.breaker.state == "closed"
+    finally:
+        pool.close()
+
+
+def test_lost_connections_retire_the_pool(db_conn):
+    pool = ConnectionPool(_DB_URL, size=2)
+    try:
+        with pool.connection() as a, pool.connection() as b:
+            pids = [conn.get_backend_pid() for conn in (a, b)]
+        with db_conn.cursor() as cur:  # the server restarts
+            cur.execute("SELECT pg_terminate_backend(pid) FROM unnest(%s) AS pid", (pids,))
+        with pytest.raises(DatabaseUnavailable):
+            with pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+        assert pool.breaker.state == "open"
+        with pool.connection() as conn:  # a new pool: the other dead connection isn't handed out
+            assert conn.get_backend_pid() not in pids
+    finally:
+        pool.close()
+
+
+def test_startup_does_not_wait_for_the_database(monkeypatch):
+    started = threading.Event()
+    monkeypatch.setattr(app_module, "shard_map", ShardMap(DEAD_URL))
+    monkeypatch.setattr(app_module, "prepare_db", started.set)
+    monkeypatch.setattr(app_module, "journal_replay_loop", lambda: None)
+    monkeypatch.setattr(app_module, "MAINTENANCE_INTERVAL_HOURS", 0)
+
+    async def start():
+        app_module.startup()
+    began = time.monotonic()
+    anyio.run(start)
+    assert started.wait(1) and time.monotonic() - began < 1
@@ -0,0 +1,223 @@
+"""
+Tests for the weekly digest (digest.py): opting in and out, weekly totals in
+each user's time zone, rendering, and the batched, checkpointed, paced
+sends through a local Resend stub.
+"""
+import json
+from datetime import date, datetime, timezone
+
+import pytest
+
+from app import SECRET_KEY
+from digest import (
+    DigestMailer, MailerError, digest_week, render_digest, send_digests, unsubscribe_sig, weekly_totals,
+)
+from tests.helpers import NoCommitConnection, auth_headers
+from tests.resend_stub import ResendStub
+
+HOUR = 3_600_000
+WEEK = date(2026, 10, 5)  # a Monday
+
+
+def ms(*args) -> int:
+    return int(datetime(*args, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def user_id(db_conn, user) -> int:
+    with db_conn.cursor() as cur:
+        cur.execute("SELECT id FROM users WHERE email = %s", (user["email"],))
+        return cur.fetchone()["id"]
+
+
+def save(client, user, tasks: dict[str, list[tuple[int, int]]]):
+    doc = {"tasks": [{"id": name, "name": name, "sessions": [{"start": s, "end": e} for s, e in sessions]}
+                     for name, sessions in tasks.items()], "later": []}
+    assert client.post("/data", content=json.dumps(doc), headers=auth_headers(user["token"])).status_code == 204
+
+
+def weekly_digest(db_conn, uid: int) -> bool:
+    with db_conn.cursor() as cur:
+        cur.execute("SELECT weekly_digest FROM users WHERE id = %s", (uid,))
+        return cur.fetchone()["weekly_digest"]
+
+
+def opt_in(client, user):
+    r = client.post("/settings/digest", json={"enabled": True}, headers=auth_headers(user["token"]))
+    assert r.json() == {"weekly_digest": True}
+
+
+@pytest.fixture
+def resend():
+    stub = ResendStub()
+    yield stub
+    stub.close()
+
+
+@pytest.fixture
+def mailer(resend):
+    m = DigestMailer("re_test", api_base=resend.url, rate=1000, backoff=0, sleep=lambda s: None)
+    yield m
+    m.close()
+
+
+def run(db_conn, mailer, **kw) -> dict:
+    conn = NoCommitConnection(db_conn)
+    return send_digests(conn, [conn], mailer, WEEK, "Doing It <digest@example.com>", "https://app.test",
+                        "secret", log=lambda _: None, **kw)
+
+
+def digest_users(client, n: int) -> list[dict]:
+    users = []
+    for i in range(n):
+        r = client.post("/auth/signup", json={"email": f"digest{i}@example.com", "password": "pw123456"})
+        user = {"email": f"digest{i}@example.com", "token": r.json()["token"]}
+        opt_in(client, user)
+        users.append(user)
+    return users
+
+
+# ---------------------------------------------------------------------------
+# Opting in and out
+# ---------------------------------------------------------------------------
+
+def test_unsubscribe_link_needs_the_signature_and_a_post(client, alice, db_conn):
+    opt_in(client, alice)
+    uid = user_id(db_conn, alice)
+    sig = unsubscribe_sig(SECRET_KEY, uid)
+    assert client.get(f"/digest/unsubscribe?user={uid}&sig={'0' * 32}").status_code == 404
+    assert client.post(f"/digest/unsubscribe?user={uid + 1}&sig={sig}").status_code == 404
+
+    r = client.get(f"/digest/unsubscribe?user={uid}&sig={sig}")
+    assert r.status_code == 200 and "<form method='post'" in r.text
+    assert weekly_digest(db_conn, uid) is True  # following the link changes nothing
+    assert client.post(f"/digest/unsubscribe?user={uid}&sig={sig}").status_code == 200
+    assert weekly_digest(db_conn, uid) is False
+
+
+# ---------------------------------------------------------------------------
+# Totals and rendering
+# ---------------------------------------------------------------------------
+
+def test_weekly_totals_use_the_users_time_zone(client, alice, db_conn):
+    r = client.post("/settings/time-zone", json={"time_zone": "Asia/Tokyo"}, headers=auth_headers(alice["token"]))
+    assert r.status_code == 200
+    save(client, alice, {
+        "write": [(ms(2026, 10, 4, 20), ms(2026, 10, 4, 22)),  # Monday 05:00 in Tokyo: this week
+                  (ms(2026, 10, 8, 9), ms(2026, 10, 8, 10))],
+        "read": [(ms(2026, 10, 6, 9), ms(2026, 10, 6, 10))],
+        "email": [(ms(2026, 10, 11, 16), ms(2026, 10, 11, 17)),  # Monday 01:00 in Tokyo: next week
+                  (ms(2026, 9, 30, 9), ms(2026, 9, 30, 13))],  # the week before
+    })
+    uid = user_id(db_conn, alice)
+    totals = weekly_totals(db_conn.cursor(), [uid], WEEK)
+    assert totals == {uid: {"total_ms": 4 * HOUR, "sessions": 3, "previous_ms": 4 * HOUR,
+                            "tasks": [("write", 3 * HOUR), ("read", HOUR)]}}
+
+
+def test_render_digest_escapes_task_names():
+    summary = {"total_ms": 5 * HOUR, "sessions": 4, "previous_ms": 3 * HOUR,
+               "tasks": [("<b>plan</b> & ship", 5 * HOUR)]}
+    email = render_digest(summary, date(2026, 9, 28), "https://app.test", "https://app.test/u")
+    assert email["subject"] == "Your week: 5.0h (Sep 28 – Oct 4)"
+    assert "&lt;b&gt;plan&lt;/b&gt; &amp; ship" in email["html"] and "<b>plan" not in email["html"]
+    assert "4 sessions, 2.0h more than the week before" in email["text"]
+    assert "<b>plan</b> & ship" in email["text"]
+
+
+@pytest.mark.parametrize("now, week", [
+    (datetime(2026, 10, 12, 11, 59, tzinfo=timezone.utc), date(2026, 9, 28)),  # still Sunday in UTC-12
+    (datetime(2026, 10, 12, 12, 0, tzinfo=timezone.utc), date(2026, 10, 5)),
+    (datetime(2026, 10, 18, 23, 0, tzinfo=timezone.utc), date(2026, 10, 5)),
+])
+def test_digest_week_waits_for_the_week_to_end_everywhere(now, week):
+    assert digest_week(now) == week
+
+
+# ---------------------------------------------------------------------------
+# Sending
+# ---------------------------------------------------------------------------
+
+def test_send_digests_batches_marks_and_skips_empty_weeks(client, db_conn, resend, mailer):
+    users = digest_users(client, 4)
+    for user in users[:3]:
+        save(client, user, {"write": [(ms(2026, 10, 6, 9), ms(2026, 10, 6, 10))]})
+
+    assert run(db_conn, mailer, batch=2) == {"sent": 3, "empty": 1, "failed": 0}
+    assert [len(r["json"]) for r in resend.requests] == [2, 1]
+    assert resend.delivered() == [u["email"] for u in users[:3]]
+    first = resend.requests[0]
+    assert first["path"] == "/emails/batch" and first["authorization"] == "Bearer re_test"
+    email = first["json"][0]
+    assert email["headers"]["List-Unsubscribe-Post"] == "List-Unsubscribe=One-Click"
+    assert email["headers"]["List-Unsubscribe"].startswith("<https://app.test/digest/unsubscribe?user=")
+
+    assert run(db_conn, mailer, batch=2) == {"sent": 0, "empty": 0, "failed": 0}  # everyone is marked
+    assert len(resend.requests) == 2
+
+
+def test_a_failed_batch_is_left_for_the_next_run_with_the_same_key(client, db_conn, resend, mailer):
+    users = digest_users(client, 3)
+    for user in users:
+        save(client, user, {"write": [(ms(2026, 10, 6, 9), ms(2026, 10, 6, 10))]})
+
+    resend.fail(500, 500, 500, 500)  # the first batch exhausts its retries
+    assert run(db_conn, mailer, batch=2) == {"sent": 1, "empty": 0, "failed": 2}
+    assert len({r["idempotency_key"] for r in resend.requests[:4]}) == 1
+
+    assert run(db_conn, mailer, batch=2) == {"sent": 2, "empty": 0, "failed": 0}
+    assert resend.requests[-1]["idempotency_key"] == resend.requests[0]["idempotency_key"]
+    assert sorted(resend.delivered()) == sorted(u["email"] for u in users)
+
+
+def test_a_batch_resend_has_seen_counts_as_sent(client, db_conn, resend, mailer):
+    user, = digest_users(client, 1)
+    save(client, user, {"write": [(ms(2026, 10, 6, 9), ms(2026, 10, 6, 10))]})
+    run(db_conn, mailer, mark=False)  # sent, but the run died before marking
+    assert run(db_conn, mailer) == {"sent": 1, "empty": 0, "failed": 0}
+    assert [r["status"] for r in resend.requests] == [200, 409] and resend.delivered() == [user["email"]]
+
+
+def test_a_sent_batch_is_not_delivered_again_after_its_membership_changes(client, db_conn, resend, mailer):
+    users = digest_users(client, 3)
+    for user in users[:2]:
+        save(client, user, {"write": [(ms(2026, 10, 6, 9), ms(2026, 10, 6, 10))]})
+    run(db_conn, mailer)
+    with db_conn.cursor() as cur:  # as if the run died before marking
+        cur.execute("UPDATE users SET digest_sent_for = NULL")
+    # Meanwhile one recipient opts out and another tracks time.
+    assert client.post("/settings/digest", json={"enabled": False},
+                       headers=auth_headers(users[1]["token"])).status_code == 200
+    save(client, users[2], {"write": [(ms(2026, 10, 7, 9), ms(2026, 10, 7, 10))]})
+
+    assert run(db_conn, mailer) == {"sent": 2, "empty": 0, "failed": 0}
+    first = resend.requests[0]["idempotency_key"]
+    assert [(r["idempotency_key"] == first, r["status"]) for r in resend.requests[1:]] == [(True, 409), (False, 200)]
+    assert resend.delivered() == [u["email"] for u in users]
+
+
+def test_mailer_retries_with_retry_after_and_refuses_bad_requests(resend):
+    waits = []
+    mailer = DigestMailer("re_test", api_base=resend.url, rate=1000, backoff=0.5, sleep=waits.append)
+    resend.fail((429, "7"), 502)
+    mailer.send([{"to": ["a@example.com"]}], "k1")
+    assert waits[:2] == [7.0, 1.0] and len(resend.requests) == 3
+
+    resend.fail(422)
+    with pytest.raises(MailerError, match="422"):
+        mailer.send([{"to": ["b@example.com"]}], "k2")
+    assert len(resend.requests) == 4
+    mailer.close()
+
+
+def test_mailer_paces_calls_to_the_rate(resend):
+    now, waits = [100.0], []
+
+    def sleep(seconds):
+        waits.append(round(seconds, 3))
+        now[0] += seconds
+    mailer = DigestMailer("re_test", api_base=resend.url, rate=2, sleep=sleep, clock=lambda: now[0])
+    for i in range(3):
+        mailer.send([{"to": ["a@example.com"]}], f"k{i}")
+        now[0] += 0.1  # the call itself
+    assert waits == [0.4, 0.4]
+    mailer.close()
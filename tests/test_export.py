@@ -0,0 +1,82 @@
+import csv
+import io
+import json
+
+from app import _export_columns
+from tests.helpers import auth_headers
+
+DAY = 86_400_000
+T0 = 1_700_006_400_000  # 2023-11-15 00:00 UTC
+
+
+def _seed(client, token):
+    payload = {"tasks": [
+        {"id": "a", "name": "Alpha", "sessions": [
+            {"start": T0, "end": T0 + 1000},
+            {"start": T0 + 2 * DAY, "end": None},
+        ]},
+        {"id": "b", "name": "Beta, with comma", "sessions": [{"start": T0 + DAY, "end": T0 + DAY + 500}]},
+    ], "later": []}
+    client.post("/data", content=json.dumps(payload), headers=auth_headers(token))
+
+
+def test_export_requires_auth(client):
+    assert client.get("/export").status_code == 403
+
+
+def test_export_csv(client, alice):
+    _seed(client, alice["token"])
+    r = client.get("/export?format=csv", headers=auth_headers(alice["token"]))
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/csv")
+    assert "attachment" in r.headers["content-disposition"]
+    rows = list(csv.reader(io.StringIO(r.text)))
+    assert rows == [
+        ["task_id", "task", "start", "end"],
+        ["a", "Alpha", str(T0), str(T0 + 1000)],
+        ["b", "Beta, with comma", str(T0 + DAY), str(T0 + DAY + 500)],
+        ["a", "Alpha", str(T0 + 2 * DAY), ""],
+    ]
+
+
+def test_export_ndjson_with_date_range(client, alice):
+    _seed(client, alice["token"])
+    r = client.get("/export?format=ndjson&since=2023-11-16&until=2023-11-16",
+                   headers=auth_headers(alice["token"]))
+    lines = [json.loads(line) for line in r.text.splitlines()]
+    assert lines == [{"task_id": "b", "task": "Beta, with comma", "start": T0 + DAY, "end": T0 + DAY + 500}]
+
+
+def test_export_columns_decodes_to_sessions(client, alice):
+    _seed(client, alice["token"])
+    r = client.get("/export?format=columns", headers=auth_headers(alice["token"]))
+    blocks = [json.loads(line) for line in r.text.splitlines()]
+    names, decoded, prev = {}, [], 0
+    for block in blocks:
+        names.update(block["tasks"])
+        for task_id, delta, duration in zip(block["task_id"], block["start"], block["duration"]):
+            prev += delta
+            decoded.append((names[task_id], prev, None if duration is None else prev + duration))
+    assert decoded == [
+        ("Alpha", T0, T0 + 1000),
+        ("Beta, with comma", T0 + DAY, T0 + DAY + 500),
+        ("Alpha", T0 + 2 * DAY, None),
+    ]
+
+
+def test_all_users_export_columns_keep_task_names_per_user():
+    rows = [(1, "t1", "Write", T0, T0 + 1), (2, "t1", "Read", T0 + 1, None)]
+    block, = [json.loads(line) for line in _export_columns(rows, with_user=True)]
+    assert block["tasks"] == {"1": {"t1": "Write"}, "2": {"t1": "Read"}}
+    assert block["user_id"] == [1, 2] and block["task_id"] == ["t1", "t1"]
+
+
+def test_export_is_isolated_between_users(client, alice, bob):
+    _seed(client, alice["token"])
+    r = client.get("/export?format=ndjson", headers=auth_headers(bob["token"]))
+    assert r.text == ""
+
+
+def test_export_rejects_unknown_format(client, alice):
+    r = client.get("/export?format=xml", headers=auth_headers(alice["token"]))
+    assert r.status_code == 400
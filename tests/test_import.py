@@ -0,0 +1,111 @@
+import json
+
+import app as app_module
+from tests.helpers import auth_headers
+
+T0 = 1_700_000_000_000
+
+
+def _import(client, token, body, fmt="csv"):
+    r = client.post(f"/import?format={fmt}", content=body, headers=auth_headers(token))
+    assert r.status_code == 202
+    status = client.get(r.json()["status_url"], headers=auth_headers(token))
+    assert status.status_code == 200
+    return status.json()
+
+
+def _tasks(client, token):
+    return client.get("/data", headers=auth_headers(token)).json()["tasks"]
+
+
+def test_csv_import_creates_tasks_by_name(client, alice):
+    body = (
+        "task,start,end\n"
+        f"Reading,{T0},{T0 + 1000}\n"
+        f"Reading,{T0 + 5000},\n"
+        "Writing,2023-11-14T22:13:20Z,2023-11-14T22:13:21Z\n"
+    )
+    job = _import(client, alice["token"], body)
+    assert job["status"] == "done"
+    assert job["rows_parsed"] == 3
+    assert job["rows_inserted"] == 3
+    assert job["tasks_created"] == 2
+    tasks = {t["name"]: t["sessions"] for t in _tasks(client, alice["token"])}
+    assert tasks["Reading"] == [{"start": T0, "end": T0 + 1000}, {"start": T0 + 5000, "end": None}]
+    assert tasks["Writing"] == [{"start": T0, "end": T0 + 1000}]
+
+
+def test_import_merges_into_existing_tasks_and_skips_duplicates(client, alice):
+    payload = {"tasks": [{"id": "t1", "name": "Reading", "sessions": [{"start": T0, "end": T0 + 1000}]}],
+               "later": []}
+    client.post("/data", content=json.dumps(payload), headers=auth_headers(alice["token"]))
+    body = (
+        "task,start,end\n"
+        f"Reading,{T0},{T0 + 1000}\n"        # already stored
+        f"Reading,{T0 + 9000},{T0 + 9500}\n"
+        f"Reading,{T0 + 9000},{T0 + 9500}\n"  # repeated in file
+    )
+    job = _import(client, alice["token"], body)
+    assert job["rows_inserted"] == 1
+    assert job["rows_duplicate"] == 2
+    assert job["tasks_created"] == 0
+    tasks = _tasks(client, alice["token"])
+    assert [t["id"] for t in tasks] == ["t1"]
+    assert len(tasks[0]["sessions"]) == 2
+
+
+def test_export_round_trips_through_ndjson_import(client, alice, bob):
+    payload = {"tasks": [{"id": "t1", "name": "Reading", "sessions": [
+        {"start": T0, "end": T0 + 1000}, {"start": T0 + 2000, "end": None},
+    ]}], "later": []}
+    client.post("/data", content=json.dumps(payload), headers=auth_headers(alice["token"]))
+    exported = client.get("/export?format=ndjson", headers=auth_headers(alice["token"])).text
+
+    job = _import(client, bob["token"], exported, fmt="ndjson")
+    assert job["rows_inserted"] == 2
+    assert _tasks(client, bob["token"]) == _tasks(client, alice["token"])
+
+
+def test_bad_rows_are_counted_and_skipped(client, alice):
+    body = "\n".join([
+        json.dumps({"task": "Ok", "start": T0, "end": T0 + 1}),
+        "not json",
+        json.dumps({"task": "", "start": T0}),
+        json.dumps({"task": "Backwards", "start": T0, "end": T0 - 1}),
+    ])
+    job = _import(client, alice["token"], body, fmt="ndjson")
+    assert job["status"] == "done"
+    assert job["rows_parsed"] == 1
+    assert job["rows_rejected"] == 3
+    assert job["error"].startswith("row 2:")
+
+
+def test_import_status_is_private(client, alice, bob):
+    r = client.post("/import", content="task,start,end\n", headers=auth_headers(alice["token"]))
+    assert client.get(r.json()["status_url"], headers=auth_headers(bob["token"])).status_code == 404
+
+
+def test_oversized_upload_is_rejected(client, alice, monkeypatch):
+    monkeypatch.setattr(app_module, "IMPORT_MAX_BYTES", 10)
+    r = client.post("/import", content="task,start,end\n" * 5, headers=auth_headers(alice["token"]))
+    assert r.status_code == 413
+
+
+def test_imported_sessions_older_than_the_archive_survive_a_save(client, alice, db_conn):
+    with db_conn.cursor() as cur:
+        cur.execute("INSERT INTO app_state (key, value) VALUES ('sessions_archived_before', %s) "
+                    "ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value", (str(T0 + 10_000),))
+    body = f"task,start,end\nReading,{T0},{T0 + 1000}\nReading,{T0 + 20_000},{T0 + 21_000}\n"
+    assert _import(client, alice["token"], body)["rows_inserted"] == 2
+
+    # The client saves back what it loaded, minus the newer session.
+    tasks = _tasks(client, alice["token"])
+    tasks[0]["sessions"] = [s for s in tasks[0]["sessions"] if s["start"] < T0 + 10_000]
+    r = client.post("/data", content=json.dumps({"tasks": tasks, "later": []}),
+                    headers=auth_headers(alice["token"]))
+    assert r.status_code == 204
+    assert _tasks(client, alice["token"])[0]["sessions"] == [{"start": T0, "end": T0 + 1000}]
+
+    tasks[0]["sessions"] = []
+    client.post("/data", content=json.dumps({"tasks": tasks, "later": []}), headers=auth_headers(alice["token"]))
+    assert _tasks(client, alice["token"])[0]["sessions"] == [{"start": T0, "end": T0 + 1000}]
@@ -0,0 +1,62 @@
+"""
+Tests for loadtest.py. populate runs inside the per-test transaction; replay
+is pointed at the app in-process through httpx's ASGI transport.
+"""
+import asyncio
+import random
+
+import httpx
+
+from app import app, verify_daily_totals
+from loadtest import Replayer, clean, email_for, percentile, populate
+
+
+def test_percentile_nearest_rank():
+    samples = [float(i) for i in range(1, 101)]
+    assert percentile(samples, 50) == 50
+    assert percentile(samples, 99) == 99
+    assert percentile([3.0], 95) == 3
+    assert percentile([], 50) == 0
+
+
+def test_populate_writes_consistent_history(db_conn):
+    random.seed(1)
+    cur = db_conn.cursor()
+    totals = populate(cur, users=3, weeks=2, tasks_per_user=3)
+    assert totals["users"] == 3
+    assert totals["tasks"] == 9
+    assert totals["sessions"] > 0
+
+    # Stats written by populate must match what the trigger would maintain.
+    cur.execute("""
+        SELECT t.total_ms, t.session_count, t.last_started_at,
+               COALESCE(SUM(s.end_ts - s.start_ts), 0) AS sum_ms,
+               COUNT(s.start_ts) AS n, MAX(s.start_ts) AS last
+        FROM tasks t LEFT JOIN sessions s ON s.task_id = t.id AND s.user_id = t.user_id
+        JOIN users u ON u.id = t.user_id
+        WHERE u.email LIKE '%%@loadtest.invalid'
+        GROUP BY t.id, t.user_id
+    """)
+    for row in cur.fetchall():
+        assert (row["total_ms"], row["session_count"], row["last_started_at"]) == \
+               (row["sum_ms"], row["n"], row["last"])
+
+    assert verify_daily_totals(cur) == []
+    assert populate(cur, users=3, weeks=2)["users"] == 0  # existing users are skipped
+    assert clean(cur) == 3
+
+
+def test_replay_reports_every_route(client, db_conn):
+    populate(db_conn.cursor(), users=2, weeks=1)
+
+    async def go():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as http:
+            # One request at a time: every handler shares the test connection.
+            return await Replayer(http, users=2, concurrency=1).run(rps=40, duration=0.5)
+
+    report = asyncio.run(go())
+    assert sum(r["requests"] for r in report.values()) == 20
+    assert all(r["errors"] == 0 for r in report.values())
+    assert set(report) == {"get_data", "post_data", "session_start", "login"}
+    assert email_for(0) == "load000000@loadtest.invalid"
@@ -0,0 +1,261 @@
+"""
+Tests for maintenance.py. Partition DDL is transactional in Postgres, so each
+test converts sessions inside the per-test transaction and it is rolled back.
+"""
+import json
+import os
+import uuid
+from datetime import datetime, timezone
+
+import psycopg2
+import psycopg2.extras
+import pytest
+
+from maintenance import (
+    HOUSEKEEPING_LOCK, archive_sessions, column_type, compact_keys, current_month,
+    ensure_partitions, has_surrogate_session_id, housekeep, is_partitioned, measure,
+    month_partitions, partition_sessions, prune_rollback_blobs, purge_reset_tokens,
+    purge_stale_rows, vacuum_analyze,
+)
+from tests.helpers import auth_headers
+
+OLD = 1_700_000_000_000  # 2023-11-14
+NOW = int(datetime.now(timezone.utc).timestamp() * 1000)
+
+
+def _payload():
+    return {"tasks": [{"id": "t1", "name": "Task", "sessions": [
+        {"start": OLD, "end": OLD + 1000},
+        {"start": NOW - 5000, "end": NOW - 3000},
+    ]}], "later": []}
+
+
+def test_partition_preserves_rows_and_stats(client, db_conn, alice):
+    client.post("/data", content=json.dumps(_payload()), headers=auth_headers(alice["token"]))
+    cur = db_conn.cursor()
+    assert partition_sessions(cur) > 0
+    assert is_partitioned(cur)
+    assert (2023, 11) in month_partitions(cur)
+    assert partition_sessions(cur) == 0  # idempotent
+
+    r = client.get("/data", headers=auth_headers(alice["token"]))
+    assert [s["start"] for s in r.json()["tasks"][0]["sessions"]] == [OLD, NOW - 5000]
+    task = client.get("/tasks", headers=auth_headers(alice["token"])).json()["tasks"][0]
+    assert task["total_ms"] == 3000
+    assert task["session_count"] == 2
+
+
+def test_ensure_creates_missing_future_partitions(db_conn):
+    cur = db_conn.cursor()
+    partition_sessions(cur, ahead=0)
+    created = ensure_partitions(cur, ahead=2)
+    assert len(created) == 2
+    assert current_month() in month_partitions(cur)
+    assert ensure_partitions(cur, ahead=2) == []
+
+
+def test_archive_moves_old_months_out_of_hot_path(client, db_conn, alice):
+    headers = auth_headers(alice["token"])
+    client.post("/data", content=json.dumps(_payload()), headers=headers)
+    cur = db_conn.cursor()
+    partition_sessions(cur)
+    assert archive_sessions(cur, (2024, 1)) == ["sessions_p2023_11", "sessions_p2023_12"]
+
+    recent = client.get("/data", headers=headers).json()["tasks"][0]["sessions"]
+    assert [s["start"] for s in recent] == [NOW - 5000]
+    full = client.get("/data?history=full", headers=headers).json()["tasks"][0]["sessions"]
+    assert full == [{"start": OLD, "end": OLD + 1000}, {"start": NOW - 5000, "end": NOW - 3000}]
+
+    # Re-posting full history must not copy archived sessions back into the hot table.
+    client.post("/data", content=json.dumps({"tasks": [{"id": "t1", "name": "Task", "sessions": full}],
+                                             "later": []}), headers=headers)
+    recent = client.get("/data", headers=headers).json()["tasks"][0]["sessions"]
+    assert [s["start"] for s in recent] == [NOW - 5000]
+
+    task = client.get("/tasks", headers=headers).json()["tasks"][0]
+    assert task["total_ms"] == 3000
+    assert task["session_count"] == 2
+
+
+def _legacy_session_keys(cur):
+    """Rebuild the pre-compact layout: a surrogate TEXT id primary key plus a UNIQUE natural key."""
+    if has_surrogate_session_id(cur):
+        return  # a database created before compact_keys existed
+    cur.execute("ALTER TABLE sessions DROP CONSTRAINT sessions_pkey")
+    cur.execute("ALTER TABLE sessions ADD COLUMN id TEXT NOT NULL DEFAULT gen_random_uuid()::text")
+    cur.execute("ALTER TABLE sessions ADD PRIMARY KEY (id)")
+    cur.execute("ALTER TABLE sessions ADD UNIQUE (task_id, user_id, start_ts)")
+
+
+def test_compact_keys_drops_surrogate_id_and_keeps_sync_working(client, db_conn, alice):
+    headers = auth_headers(alice["token"])
+    cur = db_conn.cursor()
+    _legacy_session_keys(cur)
+    client.post("/data", content=json.dumps(_payload()), headers=headers)
+    assert has_surrogate_session_id(cur)
+
+    assert compact_keys(cur) == ["sessions: dropped surrogate id, primary key is (task_id, user_id, start_ts)"]
+    assert not has_surrogate_session_id(cur)
+    cur.execute("""
+        SELECT pg_get_constraintdef(oid) AS def FROM pg_constraint
+        WHERE conrelid = 'sessions'::regclass AND contype IN ('p', 'u')
+    """)
+    assert [r["def"] for r in cur.fetchall()] == ["PRIMARY KEY (task_id, user_id, start_ts)"]
+    assert compact_keys(cur) == []
+
+    ended = _payload()
+    ended["tasks"][0]["sessions"][1]["end"] = NOW
+    client.post("/data", content=json.dumps(ended), headers=headers)
+    sessions = client.get("/data", headers=headers).json()["tasks"][0]["sessions"]
+    assert sessions[1] == {"start": NOW - 5000, "end": NOW}
+
+
+def test_compact_keys_converts_task_ids_to_uuid(client, db_conn, alice):
+    headers = auth_headers(alice["token"])
+    tid = str(uuid.uuid4())
+    payload = {"tasks": [
+        {"id": tid, "name": "Keep", "sessions": [{"start": OLD, "end": OLD + 1}]},
+        {"id": str(uuid.uuid4()), "name": "Drop", "sessions": []},
+    ], "later": []}
+    client.post("/data", content=json.dumps(payload), headers=headers)
+    cur = db_conn.cursor()
+    compact_keys(cur, uuid_task_ids=True)
+    assert column_type(cur, "tasks", "id") == "uuid"
+    assert column_type(cur, "sessions", "task_id") == "uuid"
+
+    payload["tasks"].pop()
+    client.post("/data", content=json.dumps(payload), headers=headers)
+    tasks = client.get("/data", headers=headers).json()["tasks"]
+    assert tasks == [{"id": tid, "name": "Keep", "sessions": [{"start": OLD, "end": OLD + 1}]}]
+
+
+def test_compact_keys_refuses_non_uuid_task_ids(client, db_conn, alice):
+    client.post("/data", content=json.dumps(_payload()), headers=auth_headers(alice["token"]))
+    with pytest.raises(SystemExit):
+        compact_keys(db_conn.cursor(), uuid_task_ids=True)
+
+
+def test_measure_reports_sizes_and_upsert_rate(db_conn):
+    m = measure(db_conn.cursor(), probe_rows=50)
+    assert m["table_bytes"] >= 0
+    assert m["index_bytes"] > 0
+    assert m["upserts_per_s"] > 0
+
+
+def test_archive_keeps_daily_totals(client, db_conn, alice):
+    from app import verify_daily_totals
+
+    client.post("/data", content=json.dumps(_payload()), headers=auth_headers(alice["token"]))
+    cur = db_conn.cursor()
+    partition_sessions(cur)
+    archive_sessions(cur, current_month())
+    cur.execute("SELECT day, total_ms FROM daily_task_totals ORDER BY day")
+    assert [r["total_ms"] for r in cur.fetchall()][0] == 1000
+    assert verify_daily_totals(cur) == []
+
+
+def _user_id(db_conn, email):
+    cur = db_conn.cursor()
+    cur.execute("SELECT id FROM users WHERE email = %s", (email,))
+    return cur.fetchone()["id"]
+
+
+def test_purge_reset_tokens_in_batches(db_conn, alice):
+    cur = db_conn.cursor()
+    uid = _user_id(db_conn, alice["email"])
+    for i in range(5):
+        cur.execute("INSERT INTO password_reset_tokens (token, user_id, expires_at) "
+                    "VALUES (%s, %s, NOW() - INTERVAL '1 hour')", (f"old{i}", uid))
+    cur.execute("INSERT INTO password_reset_tokens (token, user_id, expires_at) "
+                "VALUES ('live', %s, NOW() + INTERVAL '1 hour')", (uid,))
+    assert purge_reset_tokens(cur, batch=2) == 5
+    cur.execute("SELECT token FROM password_reset_tokens WHERE user_id = %s", (uid,))
+    assert [r["token"] for r in cur.fetchall()] == ["live"]
+
+
+def test_prune_only_stale_migrated_blobs(client, db_conn, alice, bob):
+    client.post("/data", content=json.dumps(_payload()), headers=auth_headers(alice["token"]))
+    client.post("/data", content=json.dumps(_payload()), headers=auth_headers(bob["token"]))
+    cur = db_conn.cursor()
+    cur.execute("UPDATE user_data SET updated_at = NOW() - INTERVAL '400 days'")
+    cur.execute("UPDATE user_data SET migrated_at = NULL WHERE user_id = %s", (_user_id(db_conn, bob["email"]),))
+    assert prune_rollback_blobs(cur, days=180) == 1
+    cur.execute("SELECT user_id FROM user_data WHERE user_id IN (%s, %s)",
+                (_user_id(db_conn, alice["email"]), _user_id(db_conn, bob["email"])))
+    assert [r["user_id"] for r in cur.fetchall()] == [_user_id(db_conn, bob["email"])]
+
+    # A save refreshes the blob, so active users keep theirs.
+    client.post("/data", content=json.dumps(_payload()), headers=auth_headers(alice["token"]))
+    assert prune_rollback_blobs(cur, days=180) == 0
+
+
+def test_housekeep_runs_steps_and_repairs_rollup(client, db_conn, alice):
+    client.post("/data", content=json.dumps(_payload()), headers=auth_headers(alice["token"]))
+    cur = db_conn.cursor()
+    cur.execute("UPDATE daily_task_totals SET total_ms = 0")
+    lines = []
+    stats = housekeep(cur, log=lines.append)
+    steps = {s["step"]: s["result"] for s in stats}
+    assert steps["rollup users rebuilt"] == 1
+    assert "vacuum/analyze" not in steps  # not possible inside the test transaction
+    assert all(line.startswith("[maintenance] ") for line in lines)
+    assert housekeep(cur, min_interval_hours=1, log=lines.append) is None  # ran just now
+
+
+def test_background_housekeeping_checks_only_users_active_since_the_last_run(client, db_conn, alice, bob):
+    for user in (alice, bob):
+        client.post("/data", content=json.dumps(_payload()), headers=auth_headers(user["token"]))
+    cur = db_conn.cursor()
+    cur.execute("UPDATE daily_task_totals SET total_ms = 0")
+    cur.execute("UPDATE user_data SET updated_at = NOW() - INTERVAL '2 days' WHERE user_id = %s",
+                (_user_id(db_conn, bob["email"]),))
+    cur.execute("""
+        INSERT INTO app_state (key, value) VALUES ('housekeeping_last_run', extract(epoch FROM NOW()) - 3600)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+    """)
+
+    stats = housekeep(cur, full_rollup_check=False, log=lambda _: None)
+    assert {s["step"]: s["result"] for s in stats}["rollup users rebuilt"] == 1  # alice saved since
+    stats = housekeep(cur, log=lambda _: None)
+    assert {s["step"]: s["result"] for s in stats}["rollup users rebuilt"] == 1  # and now bob
+
+
+def test_stuck_imports_are_marked_interrupted(db_conn, alice):
+    cur = db_conn.cursor()
+    uid = _user_id(db_conn, alice["email"])
+    cur.execute("""
+        INSERT INTO import_jobs (id, user_id, format, status, created_at) VALUES
+            ('stuck', %(uid)s, 'csv', 'parsing', NOW() - INTERVAL '2 days'),
+            ('merging', %(uid)s, 'csv', 'merging', NOW() - INTERVAL '1 hour')
+    """, {"uid": uid})
+    purge_stale_rows(cur)
+    cur.execute("SELECT id, status, error, finished_at IS NOT NULL AS finished FROM import_jobs "
+                "WHERE user_id = %s ORDER BY id", (uid,))
+    assert cur.fetchall() == [
+        {"id": "merging", "status": "merging", "error": None, "finished": False},
+        {"id": "stuck", "status": "failed", "error": "interrupted", "finished": True},
+    ]
+
+
+def test_housekeep_skips_when_another_instance_holds_the_lock(db_conn):
+    other = psycopg2.connect(os.environ["DATABASE_URL"])
+    try:
+        with other.cursor() as oc:
+            oc.execute("SELECT pg_advisory_lock(%s)", (HOUSEKEEPING_LOCK,))
+        lines = []
+        assert housekeep(db_conn.cursor(), log=lines.append) is None
+        assert "skipped" in lines[0]
+    finally:
+        other.close()
+
+
+def test_vacuum_analyze_targets_changed_tables():
+    conn = psycopg2.connect(os.environ["DATABASE_URL"], cursor_factory=psycopg2.extras.RealDictCursor)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            actions = vacuum_analyze(cur, min_changed=0, ratio=0)
+            assert any(a.endswith(" tasks") for a in actions)
+            assert vacuum_analyze(cur, min_changed=10**12) == []
+    finally:
+        conn.close()
@@ -0,0 +1,135 @@
+"""
+Tests for CanonicalHostMiddleware: redirects, static cache headers, streaming
+pass-through, and its per-request cost against the @app.middleware("http")
+version it replaced.
+"""
+import time
+
+import anyio
+import pytest
+from fastapi.responses import RedirectResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from app import CANONICAL_HOST, LOCAL_HOSTS, CanonicalHostMiddleware
+
+REQUESTS = 2000
+
+
+def scope(path="/data", host=b"doingit.online", query=b""):
+    return {"type": "http", "http_version": "1.1", "method": "GET", "scheme": "https",
+            "path": path, "raw_path": path.encode(), "query_string": query, "root_path": "",
+            "headers": [(b"host", host)], "client": ("127.0.0.1", 1), "server": ("127.0.0.1", 443)}
+
+
+async def ok_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-length", b"2")]})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+async def receive():
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+
+def call(asgi, s) -> list[dict]:
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    anyio.run(asgi, s, receive, send)
+    return sent
+
+
+def headers(start: dict) -> dict:
+    return {k.decode(): v.decode() for k, v in start["headers"]}
+
+
+# ---------------------------------------------------------------------------
+# Behaviour
+# ---------------------------------------------------------------------------
+
+@pytest.mark.parametrize("host,location", [
+    (b"tkdoro.fly.dev", "https://doingit.online/data?history=full"),
+    (b"tkdoro.fly.dev:8080", "https://doingit.online:8080/data?history=full"),
+])
+def test_other_hosts_are_redirected(host, location):
+    sent = call(CanonicalHostMiddleware(ok_app, CANONICAL_HOST), scope(host=host, query=b"history=full"))
+    assert sent[0]["status"] == 301
+    assert headers(sent[0])["location"] == location
+
+
+@pytest.mark.parametrize("host", [CANONICAL_HOST.encode(), b"localhost:8000", *(h.encode() for h in LOCAL_HOSTS)])
+def test_canonical_and_local_hosts_pass_through(host):
+    sent = call(CanonicalHostMiddleware(ok_app, CANONICAL_HOST), scope(host=host))
+    assert sent[0]["status"] == 200 and "cache-control" not in headers(sent[0])
+
+
+def test_static_responses_are_revalidated(client):
+    r = client.get("/static/app.js")
+    assert r.status_code == 200 and r.headers["cache-control"] == "no-cache"
+    assert "cache-control" not in client.get("/favicon-local.png").headers
+
+
+def test_redirect_through_the_app(client):
+    r = client.get("/data", headers={"host": "tkdoro.fly.dev"}, follow_redirects=False)
+    assert (r.status_code, r.headers["location"]) == (301, "http://doingit.online/data")
+
+
+def test_streamed_chunks_are_passed_on_as_they_are_sent():
+    """Each body chunk must reach the server before the app produces the next one."""
+    sent = []
+
+    async def streaming_app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        for chunk in (b"a", b"b", b"c"):
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            assert sent[-1]["body"] == chunk
+        await send({"type": "http.response.body", "body": b""})
+
+    async def send(message):
+        sent.append(message)
+
+    anyio.run(CanonicalHostMiddleware(streaming_app, CANONICAL_HOST), scope(path="/export"), receive, send)
+    assert b"".join(m.get("body", b"") for m in sent) == b"abc"
+
+
+# ---------------------------------------------------------------------------
+# Overhead
+# ---------------------------------------------------------------------------
+
+async def redirect_to_canonical(request, call_next):
+    """The @app.middleware("http") version, kept as the benchmark reference."""
+    host = request.headers.get("host", "").split(":")[0]
+    if host and host != CANONICAL_HOST and host not in LOCAL_HOSTS:
+        url = str(request.url).replace(f"://{host}", f"://{CANONICAL_HOST}", 1)
+        return RedirectResponse(url, status_code=301)
+    response = await call_next(request)
+    if request.url.path.startswith("/static/"):
+        response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def per_request_us(asgi) -> float:
+    async def send(message):
+        pass
+
+    async def run():
+        s = scope()
+        for _ in range(50):
+            await asgi(dict(s), receive, send)
+        t0 = time.perf_counter()
+        for _ in range(REQUESTS):
+            await asgi(dict(s), receive, send)
+        return (time.perf_counter() - t0) / REQUESTS * 1e6
+
+    return anyio.run(run)
+
+
+@pytest.mark.benchmark
+def test_middleware_overhead_is_a_fraction_of_base_http_middleware():
+    bare = per_request_us(ok_app)
+    raw = per_request_us(CanonicalHostMiddleware(ok_app, CANONICAL_HOST))
+    base = per_request_us(BaseHTTPMiddleware(ok_app, dispatch=redirect_to_canonical))
+    print(f"\nper request: app {bare:.1f} µs, CanonicalHostMiddleware +{raw - bare:.1f} µs, "
+          f"BaseHTTPMiddleware +{base - bare:.1f} µs")
+    assert raw - bare < (base - bare) / 5
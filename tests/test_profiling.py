@@ -0,0 +1,105 @@
+"""
+Tests for the opt-in profiling surface: stack sampling, tracemalloc
+snapshots and diffs, and per-request allocation logging.
+"""
+import re
+import threading
+import tracemalloc
+from collections import Counter
+
+import anyio
+import pytest
+
+import app as app_module
+from profiling import AllocationLogMiddleware, MemoryProfiler, folded, sample
+
+ADMIN = {"Authorization": "Bearer pr0file"}
+FOLDED_LINE = re.compile(r"^\S.*(;[^;]+)* \d+$")
+_kept = []
+
+
+@pytest.fixture
+def profiling(monkeypatch):
+    monkeypatch.setattr(app_module, "PROFILING_TOKEN", "pr0file")
+    yield app_module.memory_profiler
+    if tracemalloc.is_tracing():
+        app_module.memory_profiler.stop()
+    _kept.clear()
+
+
+def spin_for_profile(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_endpoints_are_hidden_without_a_token(client):
+    assert client.post("/admin/profile/cpu?seconds=0.1").status_code == 404
+    assert client.get("/admin/profile/memory").status_code == 404
+
+
+def test_endpoints_need_the_token(client, profiling):
+    assert client.post("/admin/profile/cpu?seconds=0.1").status_code == 401
+    assert client.get("/admin/profile/memory", headers={"Authorization": "Bearer nope"}).status_code == 401
+
+
+def test_cpu_profile_is_folded_stacks_of_busy_threads(client, profiling):
+    stop = threading.Event()
+    worker = threading.Thread(target=spin_for_profile, args=(stop,), name="spinner")
+    worker.start()
+    try:
+        r = client.post("/admin/profile/cpu?seconds=0.3&interval_ms=5", headers=ADMIN)
+    finally:
+        stop.set()
+        worker.join()
+    assert r.status_code == 200 and r.headers["x-profile-pid"].isdigit()
+    lines = r.text.splitlines()
+    assert lines and all(FOLDED_LINE.match(line) for line in lines)
+    assert any(line.startswith("spinner;") and "spin_for_profile (test_profiling.py:" in line for line in lines)
+    assert client.post("/admin/profile/cpu?seconds=600", headers=ADMIN).status_code == 400
+
+
+def test_idle_threads_are_left_out_unless_asked_for():
+    stop = threading.Event()
+    waiter = threading.Thread(target=stop.wait, name="waiter")
+    waiter.start()
+    try:
+        assert not any(s.startswith("waiter;") for s in sample(0.05, 0.005))
+        assert any(s.startswith("waiter;") for s in sample(0.05, 0.005, include_idle=True))
+    finally:
+        stop.set()
+        waiter.join()
+    assert folded(Counter({"a;b": 2, "a": 5})) == "a 5\na;b 2\n"
+
+
+def test_memory_snapshot_and_diff(client, profiling):
+    assert client.post("/admin/profile/memory/snapshot", headers=ADMIN).status_code == 409  # not tracing
+    r = client.post("/admin/profile/memory/start?frames=5", headers=ADMIN)
+    assert r.status_code == 200 and r.json()["tracing"] is True
+    assert client.get("/admin/profile/memory/diff", headers=ADMIN).status_code == 409  # no baseline
+    assert client.post("/admin/profile/memory/snapshot", headers=ADMIN).status_code == 200
+
+    _kept.append([bytes(1000) for _ in range(2000)])  # about 2 MB, attributed to this line
+    diff = client.get("/admin/profile/memory/diff", headers=ADMIN).json()["diff"]
+    assert "test_profiling.py" in diff[0]
+
+    r = client.post("/admin/profile/memory/stop", headers=ADMIN)
+    assert r.json()["tracing"] is False and not tracemalloc.is_tracing()
+
+
+def test_requests_over_the_threshold_are_logged(capsys):
+    memory = MemoryProfiler()
+
+    async def hungry(scope, receive, send):
+        _kept.append(bytearray(256 * 1024))
+        _kept.clear()
+
+    asgi = AllocationLogMiddleware(hungry, memory)
+    scope = {"type": "http", "method": "POST", "path": "/data"}
+    anyio.run(asgi, scope, None, None)  # off: nothing traced, nothing logged
+    memory.start(frames=1, log_over_kib=100)
+    try:
+        anyio.run(asgi, scope, None, None)
+    finally:
+        memory.stop()
+    out = capsys.readouterr().out.strip().splitlines()
+    assert len(out) == 1 and re.match(r"\[alloc\] POST /data peaked \d+ KiB above its start \(1 in flight\)", out[0])
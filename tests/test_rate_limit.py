@@ -0,0 +1,152 @@
+"""
+Tests for auth rate limiting: the bucket backends in isolation, then the
+limits as seen through the auth endpoints.
+"""
+import asyncio
+import os
+import time
+import uuid
+
+import pytest
+
+import app as app_module
+from app import MemoryBuckets, PostgresBuckets, RateLimit, get_db, rate_limiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+# ---------------------------------------------------------------------------
+# Backends
+# ---------------------------------------------------------------------------
+
+def test_memory_bucket_spends_and_refills():
+    clock = FakeClock()
+    buckets = MemoryBuckets(clock)
+    limit = RateLimit("ip", 3, 60)  # one token every 20s
+    assert [buckets.take("k", limit) for _ in range(3)] == [0, 0, 0]
+    assert buckets.take("k", limit) == pytest.approx(20)
+    clock.now += 20
+    assert buckets.take("k", limit) == 0
+    assert buckets.take("k", limit) > 0
+    assert buckets.take("other", limit) == 0
+
+
+def test_memory_buckets_keep_long_period_buckets_when_pruning():
+    clock = FakeClock()
+    buckets = MemoryBuckets(clock, max_period=3600, max_keys=2)
+    hourly = RateLimit("email", 1, 3600)
+    assert buckets.take("hourly", hourly) == 0
+    clock.now += 120
+    for key in ("a", "b"):
+        buckets.take(key, RateLimit("ip", 30, 60))  # the second take sweeps
+    assert buckets.take("hourly", hourly) > 0  # still drained, not dropped as "older than 60 s"
+
+
+def test_postgres_bucket_fails_fast_while_the_database_is_down():
+    buckets = PostgresBuckets("postgresql://postgres@127.0.0.1:1/tt", retry_seconds=60)
+    limit = RateLimit("ip", 3, 60)
+    with pytest.raises(app_module.psycopg2.OperationalError):
+        buckets.take("k", limit)
+    began = time.monotonic()
+    with pytest.raises(app_module.psycopg2.OperationalError, match="not retrying yet"):
+        buckets.take("k", limit)
+    assert time.monotonic() - began < 0.1
+
+
+def test_postgres_bucket_is_shared_between_instances():
+    url = os.environ["DATABASE_URL"]
+    key = f"test:{uuid.uuid4()}"
+    limit = RateLimit("email", 2, 3600)
+    a, b = PostgresBuckets(url), PostgresBuckets(url)
+    try:
+        assert a.take(key, limit) == 0
+        assert b.take(key, limit) == 0
+        assert a.take(key, limit) == pytest.approx(1800, rel=0.01)
+    finally:
+        with a._cursor() as cur:
+            cur.execute("DELETE FROM rate_limit_buckets WHERE key = %s", (key,))
+        a._conn.close()
+        b._conn.close()
+
+
+# ---------------------------------------------------------------------------
+# Endpoints
+# ---------------------------------------------------------------------------
+
+def test_login_is_limited_per_email(client, alice):
+    creds = {"email": alice["email"], "password": "wrong"}
+    statuses = [client.post("/auth/login", json=creds).status_code for _ in range(11)]
+    assert statuses == [401] * 10 + [429]
+    r = client.post("/auth/login", json={**creds, "email": "ALICE@example.com "})
+    assert r.status_code == 429  # same bucket however the email is typed
+    assert int(r.headers["retry-after"]) >= 1
+    assert client.post("/auth/login", json={"email": "bob@example.com", "password": "x"}).status_code == 401
+
+
+def test_login_is_limited_per_ip(client):
+    for i in range(30):
+        client.post("/auth/login", json={"email": f"u{i}@example.com", "password": "x"})
+    assert client.post("/auth/login", json={"email": "new@example.com", "password": "x"}).status_code == 429
+    other_ip = {"Fly-Client-IP": "203.0.113.9"}
+    assert client.post("/auth/login", json={"email": "new@example.com", "password": "x"},
+                       headers=other_ip).status_code == 401
+
+
+def test_throttled_requests_never_reach_the_database(client, db_conn):
+    opened = []
+
+    def counting_get_db():
+        opened.append(1)
+        yield db_conn.cursor()
+
+    app_module.app.dependency_overrides[get_db] = counting_get_db
+    for _ in range(10):
+        client.post("/auth/forgot-password", json={"email": "victim@example.com"})
+    assert len(opened) == 3  # the email's bucket holds 3 per hour
+    assert client.post("/auth/forgot-password", json={"email": "victim@example.com"}).status_code == 429
+    assert len(opened) == 3
+
+
+def test_metrics_export_counters(client, monkeypatch):
+    assert client.get("/metrics").status_code == 404
+    monkeypatch.setattr(app_module, "METRICS_TOKEN", "t0ken")
+    assert client.get("/metrics").status_code == 401
+
+    for _ in range(11):
+        client.post("/auth/login", json={"email": "someone@example.com", "password": "x"})
+    body = client.get("/metrics", headers={"Authorization": "Bearer t0ken"}).text
+    assert 'rate_limit_checks_total{endpoint="login",scope="email",outcome="allowed"} 10' in body
+    assert 'rate_limit_checks_total{endpoint="login",scope="email",outcome="limited"} 1' in body
+
+
+def test_backend_errors_fail_open(client, monkeypatch):
+    class Broken:
+        def take(self, key, limit):
+            raise app_module.psycopg2.OperationalError("down")
+
+    monkeypatch.setattr(rate_limiter, "backend", Broken())
+    assert client.post("/auth/login", json={"email": "a@example.com", "password": "x"}).status_code == 401
+    assert rate_limiter.counters[("login", "ip", "error")] == 1
+
+
+def test_database_backends_are_checked_off_the_event_loop(client, monkeypatch):
+    seen = []
+
+    class Blocking:
+        def take(self, key, limit):
+            try:
+                asyncio.get_running_loop()
+                seen.append("event loop")
+            except RuntimeError:
+                seen.append("thread")
+            return 0.0
+
+    monkeypatch.setattr(rate_limiter, "backend", Blocking())
+    client.post("/auth/login", json={"email": "a@example.com", "password": "x"})
+    assert seen and set(seen) == {"thread"}
@@ -0,0 +1,128 @@
+"""
+Unit tests for ReplicaRouter. The lag probe is injected, so no replica
+databases are needed.
+"""
+import threading
+
+import psycopg2
+from fastapi.responses import Response
+from fastapi.testclient import TestClient
+
+from app import READ_PIN_COOKIE, ReadPinMiddleware, ReplicaRouter
+
+
+def _router(lags, **kwargs):
+    def probe(url):
+        lag = lags[url]
+        if isinstance(lag, Exception):
+            raise lag
+        return lag
+    return ReplicaRouter(list(lags), max_lag=5, pin_seconds=60, probe=probe, **kwargs)
+
+
+def test_no_replicas_uses_primary():
+    assert ReplicaRouter([]).choose(1) is None
+
+
+def test_healthy_replicas_are_used_round_robin():
+    router = _router({"r1": 0, "r2": 1})
+    assert [router.choose(1) for _ in range(3)] == ["r1", "r2", "r1"]
+
+
+def test_lagging_replica_is_skipped():
+    router = _router({"r1": 30, "r2": 0})
+    assert {router.choose(1) for _ in range(4)} == {"r2"}
+
+
+def test_all_replicas_lagging_falls_back_to_primary():
+    router = _router({"r1": 30, "r2": psycopg2.OperationalError()})
+    assert router.choose(1) is None
+
+
+def test_writer_is_pinned_to_primary():
+    router = _router({"r1": 0})
+    router.pin(1)
+    assert router.choose(1) is None
+    assert router.choose(2) == "r1"
+
+
+def test_pin_expires():
+    router = _router({"r1": 0})
+    router.pin_seconds = 0
+    router.pin(1)
+    assert router.choose(1) == "r1"
+
+
+def test_lag_is_probed_at_most_once_per_interval():
+    calls = []
+    router = ReplicaRouter(["r1"], check_interval=60, probe=lambda url: calls.append(url) or 0)
+    for _ in range(5):
+        router.choose(1)
+    assert calls == ["r1"]
+
+
+def test_replica_marked_down_is_skipped_until_next_probe():
+    router = _router({"r1": 0}, check_interval=60)
+    assert router.choose(1) == "r1"
+    router.mark_down("r1")
+    assert router.choose(1) is None
+
+
+def _pin_client(handler):
+    """A TestClient for a bare ASGI app wrapped in ReadPinMiddleware."""
+    async def asgi(scope, receive, send):
+        handler()
+        await Response(status_code=204)(scope, receive, send)
+    return TestClient(ReadPinMiddleware(asgi))
+
+
+def test_pin_reaches_other_workers_in_a_cookie():
+    worker_a, worker_b = _router({"r1": 0}), _router({"r1": 0})
+    response = _pin_client(lambda: worker_a.pin(7)).post("/")
+    cookie = response.cookies[READ_PIN_COOKIE]
+    assert "HttpOnly" in response.headers["set-cookie"]
+
+    seen = []
+    reader = _pin_client(lambda: seen.extend([worker_b.choose(7), worker_b.choose(8)]))
+    reader.cookies.set(READ_PIN_COOKIE, cookie)
+    reader.get("/")
+    assert seen == [None, "r1"]
+
+
+def test_forged_pin_cookie_is_ignored():
+    router = _router({"r1": 0})
+    seen = []
+    reader = _pin_client(lambda: seen.append(router.choose(7)))
+    reader.cookies.set(READ_PIN_COOKIE, "7.99999999999999.0000")
+    reader.get("/")
+    assert seen == ["r1"]
+
+
+def test_probe_runs_outside_the_lock():
+    started, release = threading.Event(), threading.Event()
+
+    def slow_probe(url):
+        started.set()
+        release.wait(5)
+        return 0
+
+    router = ReplicaRouter(["r1"], pin_seconds=60, probe=slow_probe)
+    prober = threading.Thread(target=router.choose, args=(1,))
+    prober.start()
+    assert started.wait(5)
+    try:
+        router.pin(2)
+        assert router.choose(2) is None
+        assert router.choose(3) is None  # r1 is still being probed: primary, not a second probe
+    finally:
+        release.set()
+        prober.join()
+    assert router.choose(3) == "r1"
+
+
+def test_expired_pins_are_pruned():
+    router = _router({"r1": 0}, max_pins=10)
+    router.pin_seconds = 0
+    for user_id in range(100):
+        router.pin(user_id)
+    assert len(router._pins) <= 20
@@ -0,0 +1,116 @@
+"""
+Tests for the daily_task_totals rollup: the trigger keeps it in step with
+every way sessions change, and readers (quota, /stats/daily) use it.
+"""
+import json
+from datetime import datetime, timezone
+
+from app import rebuild_daily_totals, verify_daily_totals
+from tests.helpers import auth_headers
+
+DAY = 86_400_000
+T0 = 1_700_000_000_000  # 2023-11-14 22:13 UTC — 23:13 in Berlin, 17:13 in New York
+
+
+def save(client, user, tasks):
+    payload = {"tasks": [{"id": tid, "name": tid, "sessions": sessions} for tid, sessions in tasks.items()],
+               "later": []}
+    r = client.post("/data", content=json.dumps(payload), headers=auth_headers(user["token"]))
+    assert r.status_code == 204
+
+
+def stats(client, user, **params):
+    r = client.get("/stats/daily", params=params, headers=auth_headers(user["token"]))
+    assert r.status_code == 200
+    return [(d["day"], d["task_id"], d["total_ms"], d["session_count"]) for d in r.json()["days"]]
+
+
+def test_rollup_follows_inserts_edits_and_deletes(client, alice, db_conn):
+    save(client, alice, {"a": [{"start": T0, "end": T0 + 1000}, {"start": T0 + DAY, "end": T0 + DAY + 500}]})
+    assert stats(client, alice) == [("2023-11-14", "a", 1000, 1), ("2023-11-15", "a", 500, 1)]
+
+    # End extended, second session removed, a running session added.
+    save(client, alice, {"a": [{"start": T0, "end": T0 + 4000}, {"start": T0 + 10, "end": None}]})
+    assert stats(client, alice) == [("2023-11-14", "a", 4000, 2)]
+
+    save(client, alice, {})
+    assert stats(client, alice) == []
+    assert verify_daily_totals(db_conn.cursor()) == []
+
+
+def test_rollup_follows_moved_sessions(client, alice, db_conn):
+    save(client, alice, {"a": [{"start": T0, "end": T0 + 1000}], "b": []})
+    cur = db_conn.cursor()
+    cur.execute(
+        "UPDATE sessions SET task_id = 'b', start_ts = start_ts + %s, end_ts = end_ts + %s "
+        "WHERE task_id = 'a'", (DAY, DAY),
+    )
+    assert stats(client, alice) == [("2023-11-15", "b", 1000, 1)]
+    assert verify_daily_totals(cur) == []
+
+
+def test_stats_range_is_inclusive(client, alice):
+    save(client, alice, {"a": [{"start": T0 + i * DAY, "end": T0 + i * DAY + 1} for i in range(5)]})
+    days = [d for d, *_ in stats(client, alice, since="2023-11-15", until="2023-11-17")]
+    assert days == ["2023-11-15", "2023-11-16", "2023-11-17"]
+
+
+def test_time_zone_change_rebuckets_days(client, alice):
+    save(client, alice, {"a": [{"start": T0, "end": T0 + 1000}]})
+    headers = auth_headers(alice["token"])
+    assert client.post("/settings/time-zone", json={"time_zone": "Mars/Olympus"}, headers=headers).status_code == 400
+
+    assert client.post("/settings/time-zone", json={"time_zone": "Europe/Berlin"}, headers=headers).status_code == 200
+    assert stats(client, alice) == [("2023-11-14", "a", 1000, 1)]
+    save(client, alice, {"a": [{"start": T0, "end": T0 + 1000}, {"start": T0 + 3_600_000, "end": T0 + 3_601_000}]})
+    # 23:13 + 1h in Berlin is already the 15th.
+    assert stats(client, alice) == [("2023-11-14", "a", 1000, 1), ("2023-11-15", "a", 1000, 1)]
+
+
+def test_free_quota_counts_todays_sessions_from_rollup(client, alice):
+    now = int(datetime.now(timezone.utc).replace(hour=12, minute=0).timestamp() * 1000)
+    headers = auth_headers(alice["token"])
+    save(client, alice, {"a": [{"start": now + i * 1000, "end": now + i * 1000 + 500} for i in range(4)]})
+    assert client.post("/sessions/start", headers=headers).status_code == 200
+    save(client, alice, {"a": [{"start": now + i * 1000, "end": now + i * 1000 + 500} for i in range(5)]})
+    assert client.post("/sessions/start", headers=headers).status_code == 402
+
+
+def etc_zone(local_hour: int) -> str:
+    """A whole-hour zone where it is local_hour o'clock now (Etc/GMT signs are inverted)."""
+    offset = (local_hour - datetime.now(timezone.utc).hour) % 24
+    offset -= 24 if offset > 14 else 0
+    return f"Etc/GMT{'-' if offset > 0 else '+'}{abs(offset)}" if offset else "Etc/GMT"
+
+
+def test_switching_zones_does_not_reopen_the_free_quota(client, alice, db_conn):
+    headers = auth_headers(alice["token"])
+    two_hours_ago = int(datetime.now(timezone.utc).timestamp() * 1000) - 2 * 3_600_000
+    # 23:xx here, so sessions two hours ago are today's.
+    assert client.post("/settings/time-zone", json={"time_zone": etc_zone(23)}, headers=headers).status_code == 200
+    save(client, alice, {"a": [{"start": two_hours_ago + i * 1000, "end": two_hours_ago + i * 1000 + 500}
+                               for i in range(5)]})
+    assert client.post("/sessions/start", headers=headers).status_code == 402
+
+    # An hour later, off to where it is 00:xx and those sessions were yesterday.
+    db_conn.cursor().execute("UPDATE users SET time_zone_changed_at = NOW() - INTERVAL '2 hours'")
+    assert client.post("/settings/time-zone", json={"time_zone": etc_zone(0)}, headers=headers).status_code == 200
+    assert client.post("/sessions/start", headers=headers).status_code == 402  # the quota day stays put
+
+
+def test_time_zone_changes_are_throttled(client, alice):
+    headers = auth_headers(alice["token"])
+    assert client.post("/settings/time-zone", json={"time_zone": "Europe/Berlin"}, headers=headers).status_code == 200
+    r = client.post("/settings/time-zone", json={"time_zone": "Asia/Tokyo"}, headers=headers)
+    assert r.status_code == 429 and 3500 <= int(r.headers["retry-after"]) <= 3600
+    # Re-sending the current zone (every page load does) is always fine.
+    assert client.post("/settings/time-zone", json={"time_zone": "Europe/Berlin"}, headers=headers).status_code == 200
+
+
+def test_rebuild_repairs_drift(client, alice, db_conn):
+    save(client, alice, {"a": [{"start": T0, "end": T0 + 1000}]})
+    cur = db_conn.cursor()
+    cur.execute("UPDATE daily_task_totals SET total_ms = 1")
+    assert len(verify_daily_totals(cur)) == 1
+    rebuild_daily_totals(cur)
+    assert verify_daily_totals(cur) == []
@@ -0,0 +1,64 @@
+import json
+
+from tests.helpers import auth_headers
+
+
+def save(client, user, tasks, later=()):
+    payload = {
+        "tasks": [{"id": tid, "name": name, "sessions": [{"start": s, "end": s + 60_000} for s in starts]}
+                  for tid, name, starts in tasks],
+        "later": [{"id": f"l{i}", "text": text} for i, text in enumerate(later)],
+    }
+    r = client.post("/data", content=json.dumps(payload), headers=auth_headers(user["token"]))
+    assert r.status_code == 204
+
+
+def search(client, user, **params):
+    r = client.get("/search", params=params, headers=auth_headers(user["token"]))
+    assert r.status_code == 200
+    return r.json()
+
+
+def test_search_requires_auth(client):
+    assert client.get("/search", params={"q": "x"}).status_code == 403
+
+
+def test_search_is_case_insensitive_substring(client, alice):
+    save(client, alice, [("a", "Code Review", [1000]), ("b", "email", [2000]), ("c", "decoding", [])])
+    body = search(client, alice, q="COD")
+    assert {t["name"] for t in body["tasks"]} == {"Code Review", "decoding"}
+
+
+def test_search_ranks_prefix_then_recency(client, alice):
+    save(client, alice, [
+        ("a", "old review", [1000]),
+        ("b", "new review", [5000]),
+        ("c", "review board", [100]),
+        ("d", "never started review", []),
+    ])
+    names = [t["name"] for t in search(client, alice, q="review")["tasks"]]
+    assert names == ["review board", "new review", "old review", "never started review"]
+
+
+def test_empty_query_returns_most_recent_tasks(client, alice):
+    save(client, alice, [(str(i), f"task {i}", [i * 1000]) for i in range(1, 6)])
+    body = search(client, alice, limit=2)
+    assert [t["id"] for t in body["tasks"]] == ["5", "4"]
+    assert body["tasks"][0]["session_count"] == 1
+
+
+def test_search_covers_later_items(client, alice):
+    save(client, alice, [], later=["read the paper", "paper review", "call mom"])
+    assert [i["text"] for i in search(client, alice, q="paper")["later"]] == ["paper review", "read the paper"]
+
+
+def test_wildcards_in_query_match_literally(client, alice):
+    save(client, alice, [("a", "100% done", [1]), ("b", "1000 things", [2]), ("c", "snake_case", [3]),
+                         ("d", "snakeXcase", [4])])
+    assert [t["name"] for t in search(client, alice, q="0%")["tasks"]] == ["100% done"]
+    assert [t["name"] for t in search(client, alice, q="e_c")["tasks"]] == ["snake_case"]
+
+
+def test_search_is_scoped_to_user(client, alice, bob):
+    save(client, alice, [("a", "secret project", [1])])
+    assert search(client, bob, q="secret") == {"tasks": [], "later": []}
@@ -0,0 +1,117 @@
+"""
+Tests for the local-mode server (server.py): both stores, and the threaded
+HTTP server under concurrent saves.
+"""
+import json
+import threading
+import urllib.request
+
+import pytest
+
+from server import JsonStore, Server, SqliteStore
+
+
+def doc(*tasks, later=()):
+    return json.dumps({
+        "tasks": [{"id": tid, "name": name, "sessions": [{"start": s, "end": e} for s, e in sessions]}
+                  for tid, name, sessions in tasks],
+        "later": [{"id": f"l{i}", "text": text} for i, text in enumerate(later)],
+    }).encode()
+
+
+# ---------------------------------------------------------------------------
+# JsonStore
+# ---------------------------------------------------------------------------
+
+def test_json_store_batches_saves_into_one_atomic_write(tmp_path):
+    path = tmp_path / "data.json"
+    store = JsonStore(path, flush_interval=60)
+    for i in range(5):
+        store.put(doc(("a", f"name {i}", [])))
+    assert json.loads(store.get())["tasks"][0]["name"] == "name 4"
+    assert not path.exists()  # still batching
+
+    store.close()
+    assert json.loads(path.read_bytes())["tasks"][0]["name"] == "name 4"
+    assert [p.name for p in tmp_path.iterdir()] == ["data.json"]  # no temp files left
+
+
+def test_json_store_rejects_invalid_json(tmp_path):
+    path = tmp_path / "data.json"
+    path.write_bytes(doc(("a", "kept", [])))
+    store = JsonStore(path, flush_interval=0)
+    with pytest.raises(ValueError):
+        store.put(b'{"tasks": [')
+    store.close()
+    assert json.loads(path.read_bytes())["tasks"][0]["name"] == "kept"
+
+
+# ---------------------------------------------------------------------------
+# SqliteStore
+# ---------------------------------------------------------------------------
+
+def test_sqlite_store_roundtrips_and_keeps_task_stats(tmp_path):
+    path = tmp_path / "tt.sqlite3"
+    store = SqliteStore(path)
+    store.put(doc(("a", "deep work", [(1000, 4000), (9000, 10000)]), ("b", "email", [(5000, 6000)]),
+                  later=["read paper"]))
+    store.put(doc(("a", "deep work", [(1000, 4000)]), ("b", "email", [(5000, 6000)]),
+                  later=["read paper"]))
+    store.close()
+
+    reopened = SqliteStore(path)
+    body = json.loads(reopened.get())
+    # Reloaded documents are ordered by most recent start, like GET /data.
+    assert [t["id"] for t in body["tasks"]] == ["b", "a"]
+    assert body["tasks"][1]["sessions"] == [{"start": 1000, "end": 4000}]
+    assert body["later"] == [{"id": "l0", "text": "read paper"}]
+    stats = reopened.conn.execute(
+        "SELECT id, last_started_at, total_ms, session_count FROM tasks ORDER BY id"
+    ).fetchall()
+    assert stats == [("a", 1000, 3000, 1), ("b", 5000, 1000, 1)]
+
+    reopened.put(doc(("b", "email", [(5000, 6000)])))
+    assert reopened.conn.execute("SELECT COUNT(*) FROM sessions").fetchone() == (1,)
+    reopened.close()
+
+
+def test_sqlite_store_imports_existing_json(tmp_path):
+    seed = tmp_path / "data.json"
+    seed.write_bytes(doc(("a", "imported", [(1, 2)])))
+    store = SqliteStore(tmp_path / "tt.sqlite3", seed=seed)
+    assert json.loads(store.get())["tasks"][0]["name"] == "imported"
+    store.close()
+
+
+# ---------------------------------------------------------------------------
+# HTTP
+# ---------------------------------------------------------------------------
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_concurrent_saves_leave_a_consistent_document(tmp_path, backend):
+    store = (JsonStore(tmp_path / "data.json", flush_interval=0.01) if backend == "json"
+             else SqliteStore(tmp_path / "tt.sqlite3"))
+    server = Server(("127.0.0.1", 0), store)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/data"
+
+    def save(i):
+        body = doc(*[(f"t{j}", f"task {j}", [(k, k + 1) for k in range(i)]) for j in range(3)])
+        req = urllib.request.Request(url, data=body, method="POST")
+        assert urllib.request.urlopen(req).status == 204
+
+    threads = [threading.Thread(target=save, args=(i,)) for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    body = json.loads(urllib.request.urlopen(url).read())
+    n = len(body["tasks"][0]["sessions"])
+    assert all(len(t["sessions"]) == n for t in body["tasks"])  # one whole save, not a mix
+    server.shutdown()
+    server.server_close()
+    store.close()
+
+    if backend == "json":
+        assert json.loads((tmp_path / "data.json").read_bytes()) == body
@@ -0,0 +1,127 @@
+"""
+Tests for the serving profile: per-worker pool sizing, the connection pool
+behind get_db, and the gunicorn config.
+"""
+import os
+import runpy
+import time
+from pathlib import Path
+
+import anyio
+import psycopg2
+import pytest
+from fastapi import HTTPException
+
+import app as app_module
+from app import ConnectionPool, db_pool_size
+
+_DB_URL = os.environ["DATABASE_URL"]
+
+
+# ---------------------------------------------------------------------------
+# Sizing
+# ---------------------------------------------------------------------------
+
+def test_pool_size_splits_the_budget_across_workers():
+    assert db_pool_size(workers=2, threads=8, budget=20) == 8   # 10 each, 2 reserved
+    assert db_pool_size(workers=4, threads=8, budget=20) == 3   # budget-bound
+    assert db_pool_size(workers=1, threads=4, budget=100) == 4  # thread-bound
+    assert db_pool_size(workers=8, threads=8, budget=10) == 1   # never zero
+
+
+# ---------------------------------------------------------------------------
+# ConnectionPool
+# ---------------------------------------------------------------------------
+
+@pytest.fixture
+def pool():
+    p = ConnectionPool(_DB_URL, size=2, timeout=0.05)
+    yield p
+    p.close()
+
+
+def backend_pid(conn) -> int:
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_backend_pid() AS pid")
+        return cur.fetchone()["pid"]
+
+
+def test_pool_reuses_connections_and_rolls_back_leftovers(pool):
+    with pool.connection() as conn:
+        first = backend_pid(conn)
+        with conn.cursor() as cur:
+            cur.execute("CREATE TEMP TABLE leftover (x int)")  # never committed
+    with pool.connection() as conn:
+        assert backend_pid(conn) == first
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('pg_temp.leftover') AS t")
+            assert cur.fetchone()["t"] is None
+
+
+def test_pool_slots_wait_on_the_event_loop_then_answer_503(pool):
+    async def scenario():
+        async with pool.slot(), pool.slot():
+            with pytest.raises(HTTPException) as exc:
+                async with pool.slot():
+                    pass
+            assert exc.value.status_code == 503
+        async with pool.slot():  # both slots came back
+            with pool.connection() as conn:
+                assert backend_pid(conn)
+
+    anyio.run(scenario)
+
+
+def test_more_requests_than_connections_and_threads_all_complete(pool):
+    """Waiting for a slot must not hold the thread a connection holder needs next."""
+    pool.timeout = 5
+    threads = anyio.CapacityLimiter(1)
+    done = []
+
+    def handler():
+        with pool.connection() as conn:
+            time.sleep(0.01)
+            done.append(backend_pid(conn))
+
+    async def request():
+        async with pool.slot():
+            await anyio.to_thread.run_sync(handler, limiter=threads)
+
+    async def scenario():
+        async with anyio.create_task_group() as tg:
+            for _ in range(12):
+                tg.start_soon(request)
+
+    anyio.run(scenario)
+    assert len(done) == 12 and len(set(done)) <= pool.size
+
+
+def test_pool_drops_broken_connections(pool):
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection() as conn:
+            broken = backend_pid(conn)
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_terminate_backend(pg_backend_pid())")
+    with pool.connection() as conn:
+        assert backend_pid(conn) != broken
+
+
+def test_pool_is_reopened_in_a_forked_child(pool, monkeypatch):
+    with pool.connection() as conn:
+        parent = backend_pid(conn)
+    monkeypatch.setattr(os, "getpid", lambda: -1)  # as seen from a freshly forked worker
+    with pool.connection() as conn:
+        assert backend_pid(conn) != parent
+
+
+# ---------------------------------------------------------------------------
+# gunicorn.conf.py
+# ---------------------------------------------------------------------------
+
+def test_gunicorn_config_preloads_and_shares_worker_count(monkeypatch):
+    monkeypatch.delenv("WEB_CONCURRENCY", raising=False)
+    conf = runpy.run_path(str(Path(app_module.__file__).with_name("gunicorn.conf.py")))
+    assert conf["preload_app"] is True
+    assert conf["workers"] == int(os.environ["WEB_CONCURRENCY"]) == 2
+    module, _, cls = conf["worker_class"].rpartition(".")
+    assert hasattr(__import__(module), cls)
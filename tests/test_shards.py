@@ -0,0 +1,253 @@
+"""
+Tests for sharded user data (shards.py): placement, routing, and moving users
+between shards while the app serves them.
+
+Shards need committed data in several databases, so these tests don't use the
+transactional client fixture. They create <test db>_shard0 (the primary),
+_shard1 and _shard2 on the test server and empty them before each test.
+Point TEST_SHARD_URLS (three comma-separated URLs) at separate Postgres
+instances to run them across servers instead.
+"""
+import json
+import os
+import threading
+import time
+
+import psycopg2
+import psycopg2.extras
+import pytest
+from fastapi.testclient import TestClient
+
+import app as app_module
+from app import ConnectionPool, create_schema, rate_limiter
+from cards import CardCache, CardRenderer
+from shards import MOVE_LOCK, MoveRefused, ShardMap, fence, move_user, shard_counts
+from tests.helpers import auth_headers
+
+_DB_URL = os.environ["DATABASE_URL"]
+DAY = 86_400_000
+NOW = int(time.time() * 1000)
+
+
+def _shard_urls() -> list[str]:
+    if os.getenv("TEST_SHARD_URLS"):
+        return [u.strip() for u in os.environ["TEST_SHARD_URLS"].split(",")]
+    base, _, name = _DB_URL.rpartition("/")
+    return [f"{base}/{name}_shard{i}" for i in range(3)]
+
+
+@pytest.fixture(scope="module")
+def shard_urls():
+    urls = _shard_urls()
+    if not os.getenv("TEST_SHARD_URLS"):
+        conn = psycopg2.connect(_DB_URL)
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            for url in urls:
+                name = url.rpartition("/")[2]
+                cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (name,))
+                if cur.fetchone() is None:
+                    try:
+                        cur.execute(f'CREATE DATABASE "{name}"')
+                    except psycopg2.Error as e:
+                        pytest.skip(f"cannot create shard databases: {e}")
+        conn.close()
+    for url in urls:
+        conn = psycopg2.connect(url)
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            create_schema(cur)
+        conn.close()
+    return urls
+
+
+def sql(url: str, query: str, params=()) -> list[dict]:
+    conn = psycopg2.connect(url, cursor_factory=psycopg2.extras.RealDictCursor)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            rows = cur.fetchall() if cur.description else []
+        conn.commit()
+        return rows
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def sharded(shard_urls, monkeypatch):
+    """A TestClient for an app configured with three shards and no dependency overrides."""
+    for url in shard_urls:
+        sql(url, "TRUNCATE users, user_shards, moved_users, app_state RESTART IDENTITY CASCADE")
+    shard_map = ShardMap(shard_urls[0], shard_urls[1:])
+    pools = [ConnectionPool(url, size=2) for url in shard_urls]
+    monkeypatch.setattr(app_module, "shard_map", shard_map)
+    monkeypatch.setattr(app_module, "shard_pools", pools)
+    monkeypatch.setattr(app_module, "db_pool", pools[0])
+    rate_limiter.reset()
+    yield TestClient(app_module.app)
+    for pool in pools:
+        pool.close()
+    shard_map.close()
+
+
+def signup(client, email: str) -> dict:
+    r = client.post("/auth/signup", json={"email": email, "password": "pw123456"})
+    assert r.status_code == 200
+    return auth_headers(r.json()["token"])
+
+
+def save(client, headers, *names: str):
+    doc = {"tasks": [{"id": name, "name": name.title(), "sessions": [
+        {"start": NOW - 40 * DAY, "end": NOW - 40 * DAY + 60_000},
+        {"start": NOW - 60_000, "end": NOW},
+    ]} for name in names], "later": [{"id": "l1", "text": "read"}]}
+    assert client.post("/data", content=json.dumps(doc), headers=headers).status_code == 204
+
+
+def user_rows(url: str, user_id: int) -> dict:
+    return {table: sql(url, f"SELECT count(*) AS n FROM {table} WHERE user_id = %s", (user_id,))[0]["n"]
+            for table in ("tasks", "sessions", "later_items", "daily_task_totals", "user_data")}
+
+
+# ---------------------------------------------------------------------------
+# Placement and routing
+# ---------------------------------------------------------------------------
+
+def test_new_users_are_placed_round_robin_and_served_from_their_shard(sharded, shard_urls):
+    headers = [signup(sharded, f"u{i}@example.com") for i in range(1, 4)]  # ids 1, 2, 3
+    assert shard_counts(shard_urls[0], 3) == [1, 1, 1]
+    save(sharded, headers[0], "write")  # user 1 lives on shard 1
+
+    assert user_rows(shard_urls[1], 1)["sessions"] == 2
+    assert set(user_rows(shard_urls[0], 1).values()) == set(user_rows(shard_urls[2], 1).values()) == {0}
+    assert sql(shard_urls[1], "SELECT email FROM users WHERE id = 1") == [{"email": "u1@example.com"}]
+
+    data = sharded.get("/data", headers=headers[0]).json()
+    assert [t["name"] for t in data["tasks"]] == ["Write"] and data["later"] == [{"id": "l1", "text": "read"}]
+    assert sharded.get("/data", headers=headers[1]).json() == {"tasks": [], "later": []}
+    assert sharded.get("/tasks", headers=headers[0]).json()["tasks"][0]["session_count"] == 2
+    assert sharded.post("/sessions/start", headers=headers[0]).status_code == 200
+
+
+def test_time_zone_reaches_the_shard_copy_and_its_rollup(sharded, shard_urls):
+    headers = signup(sharded, "tz@example.com")  # id 1: shard 1
+    save(sharded, headers, "write")
+    r = sharded.post("/settings/time-zone", json={"time_zone": "Asia/Tokyo"}, headers=headers)
+    assert r.status_code == 200
+    for url in shard_urls[:2]:
+        assert sql(url, "SELECT time_zone FROM users WHERE id = 1")[0]["time_zone"] == "Asia/Tokyo"
+    days = sharded.get("/stats/daily", headers=headers).json()["days"]
+    assert sum(d["session_count"] for d in days) == 2
+
+
+def test_share_card_reads_the_owner_on_the_primary_and_the_week_on_the_shard(sharded, shard_urls, tmp_path,
+                                                                            monkeypatch):
+    monkeypatch.setattr(app_module, "card_cache", CardCache(tmp_path, max_bytes=1024 * 1024))
+    monkeypatch.setattr(app_module, "card_renderer", CardRenderer(0))
+    headers = signup(sharded, "card@example.com")
+    save(sharded, headers, "write")
+    url = sharded.post("/share/card", headers=headers).json()["url"]
+    r = sharded.get(url.removeprefix(app_module.APP_URL))
+    assert r.status_code == 200 and r.headers["content-type"] == "image/png"
+    assert sql(shard_urls[1], "SELECT share_token FROM users") == [{"share_token": None}]  # primary only
+
+
+# ---------------------------------------------------------------------------
+# Moving users
+# ---------------------------------------------------------------------------
+
+def test_move_copies_everything_and_stale_workers_follow(sharded, shard_urls):
+    headers = signup(sharded, "mover@example.com")  # id 1: shard 1
+    save(sharded, headers, "write", "read")
+    before = sharded.get("/data", headers=headers).json()
+    tasks_before = sharded.get("/tasks", headers=headers).json()
+    rows = user_rows(shard_urls[1], 1)
+
+    counts = move_user(shard_urls, 1, 2, log=lambda _: None)
+    assert counts["sessions"] == 4 and counts["tasks"] == 2
+    assert user_rows(shard_urls[2], 1) == rows
+    assert set(user_rows(shard_urls[1], 1).values()) == {0}
+    assert sql(shard_urls[1], "SELECT shard FROM moved_users WHERE user_id = 1") == [{"shard": 2}]
+    assert sql(shard_urls[1], "SELECT 1 FROM users WHERE id = 1") == []  # the shard copy went too
+    assert sql(shard_urls[0], "SELECT shard, previous FROM user_shards") == [{"shard": 2, "previous": None}]
+
+    # This worker still has shard 1 cached: the tombstone turns it away once.
+    r = sharded.get("/data", headers=headers)
+    assert r.status_code == 503 and r.headers["retry-after"] == "1"
+    assert sharded.get("/data", headers=headers).json() == before
+    assert sharded.get("/tasks", headers=headers).json() == tasks_before  # stats carried over
+
+    save(sharded, headers, "write")
+    assert user_rows(shard_urls[2], 1)["tasks"] == 1
+    assert move_user(shard_urls, 1, 2, log=lambda _: None) is None
+
+
+def test_move_back_to_the_primary_keeps_the_account(sharded, shard_urls):
+    headers = signup(sharded, "home@example.com")  # id 1: shard 1
+    save(sharded, headers, "write")
+    move_user(shard_urls, 1, 0, log=lambda _: None)
+    move_user(shard_urls, 1, 1, log=lambda _: None)  # and out again: the old tombstone is cleared
+    move_user(shard_urls, 1, 0, log=lambda _: None)
+    assert user_rows(shard_urls[0], 1)["sessions"] == 2
+    assert sql(shard_urls[0], "SELECT email FROM users WHERE id = 1") == [{"email": "home@example.com"}]
+    assert sharded.post("/auth/login", json={"email": "home@example.com", "password": "pw123456"}).status_code == 200
+    sharded.get("/data", headers=headers)  # forget the stale entry
+    assert len(sharded.get("/data", headers=headers).json()["tasks"]) == 1
+
+
+def test_move_waits_for_writes_in_flight(sharded, shard_urls):
+    signup(sharded, "busy@example.com")  # id 1: shard 1
+    writer = psycopg2.connect(shard_urls[1])
+    with writer.cursor() as cur:
+        assert fence(cur, 1, write=True) is False
+        cur.execute("INSERT INTO tasks (id, user_id, name) VALUES ('late', 1, 'Late')")
+    mover = threading.Thread(target=move_user, args=(shard_urls, 1, 2), kwargs={"log": lambda _: None})
+    mover.start()
+    time.sleep(0.3)
+    assert mover.is_alive()  # blocked on the move lock
+    writer.commit()
+    mover.join(5)
+    writer.close()
+    assert sql(shard_urls[2], "SELECT id FROM tasks WHERE user_id = 1") == [{"id": "late"}]
+
+
+def test_move_is_refused_during_an_import(sharded, shard_urls):
+    signup(sharded, "importer@example.com")  # id 1: shard 1
+    sql(shard_urls[1], "INSERT INTO import_jobs (id, user_id, format) VALUES ('j', 1, 'csv')")
+    with pytest.raises(MoveRefused, match="import"):
+        move_user(shard_urls, 1, 2, log=lambda _: None)
+    assert shard_counts(shard_urls[0], 3) == [0, 1, 0]
+
+
+def test_half_finished_move_is_completed_on_rerun(sharded, shard_urls):
+    headers = signup(sharded, "crash@example.com")  # id 1: shard 1
+    save(sharded, headers, "write")
+    # As if the mover died after switching the directory, before cleaning up.
+    move_user(shard_urls, 1, 2, log=lambda _: None)
+    sql(shard_urls[1], "DELETE FROM moved_users")
+    sql(shard_urls[0], "UPDATE user_shards SET previous = 1")
+    assert move_user(shard_urls, 1, 2, log=lambda _: None) == {}
+    assert sql(shard_urls[1], "SELECT shard FROM moved_users") == [{"shard": 2}]
+    assert sql(shard_urls[0], "SELECT previous FROM user_shards") == [{"previous": None}]
+
+
+def test_shard_map_caches_lookups_until_forgotten(sharded, shard_urls):
+    assert ShardMap(_DB_URL).cached(42) == 0  # unsharded: no lookup at all
+    shard_map = ShardMap(shard_urls[0], shard_urls[1:])
+    signup(sharded, "cache@example.com")
+    assert shard_map.cached(1) is None and shard_map.home(1) == 1
+    sql(shard_urls[0], "UPDATE user_shards SET shard = 2")
+    assert shard_map.home(1) == 1
+    shard_map.forget(1)
+    assert shard_map.home(1) == 2
+    shard_map.close()
+
+
+def test_fence_lock_is_the_move_lock(shard_urls):
+    conn = psycopg2.connect(shard_urls[1])
+    with conn.cursor() as cur:
+        fence(cur, 7, write=True)
+        cur.execute("SELECT classid, objid, mode FROM pg_locks WHERE locktype = 'advisory' "
+                    "AND pid = pg_backend_pid()")
+        assert cur.fetchall() == [(MOVE_LOCK, 7, "ShareLock")]
+    conn.close()